@@ -89,6 +89,9 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        # tests use a file rather than the default shared in-memory database, whose table locks
+        # fail at once instead of waiting, so that concurrent uploads can be tested
+        'TEST': {'NAME': os.path.join(BASE_DIR, 'test_db.sqlite3')},
     }
 }
 
@@ -134,3 +137,69 @@ STATIC_URL = '/static/'
 STATICFILES_DIRS = [
     os.path.join(BASE_DIR, "static"),
 ]
+
+
+# ABCdb settings
+
+# The number of canonicized lines of music code to remember between uploads (see
+# main.abcparser.music_code_cache). Zero disables the cache.
+ABCDB_MUSIC_CODE_CACHE_SIZE = 65536
+
+# The music code parser to use for uploads: 'rust', 'python', or 'auto' (Rust if the library
+# below can be loaded, else Python).
+ABCDB_MUSIC_CODE_BACKEND = 'auto'
+
+# The Rust music code parser library, as built by ``cargo build --release``.
+ABCDB_RUST_LIBRARY = os.path.join(BASE_DIR, 'target', 'release', 'libabcparser_peg.so')
+
+# The number of threads canonicizing music code during an upload, while parsing continues; this
+# only helps with the Rust parser, which runs without holding the GIL. 0 disables the threads.
+ABCDB_MUSIC_CODE_THREADS = 0
+
+# The budget for canonicizing one line of music code during an upload: lines longer than
+# ABCDB_MUSIC_CODE_MAX_LENGTH characters aren't parsed, and the Python parser gives up on a line
+# after ABCDB_MUSIC_CODE_MAX_STEPS backtracking steps or ABCDB_MUSIC_CODE_TIME_LIMIT seconds.
+# Lines over the budget are logged as errors and stored uncanonicized. None means no limit.
+ABCDB_MUSIC_CODE_MAX_LENGTH = 1000
+ABCDB_MUSIC_CODE_MAX_STEPS = 100000
+ABCDB_MUSIC_CODE_TIME_LIMIT = 1.0
+
+# Whether to time each phase of parsing an upload, and count its log messages, for the upload
+# results page (see main.abcparser.ParseStats), how many of the slowest tunes to list there, and
+# whether to trace memory allocation during the upload (which slows it down considerably). The
+# statistics are only collected by default in development.
+ABCDB_PARSE_STATS = ABCDB_DEPLOYMENT == 'development'
+ABCDB_PARSE_STATS_SLOWEST_TUNES = 5
+ABCDB_PARSE_STATS_TRACE_MEMORY = False
+
+# The largest file, in bytes, which a URL fetch will download. The whole file is downloaded
+# before it is parsed.
+ABCDB_MAX_FETCH_SIZE = 512 * 1024
+
+# The number of tunes an upload saves to the database at a time (see
+# main.upload.UploadParser.flush_tunes).
+ABCDB_UPLOAD_BATCH_SIZE = 200
+
+# The number of Song, Title and Instance ids remembered between uploads (see
+# main.upload.id_cache), sparing the database lookups of common titles. Zero disables it; each
+# upload still remembers the ids it has seen itself.
+ABCDB_UPLOAD_ID_CACHE_SIZE = 10000
+
+# A Bloom filter of the Song, Instance and raw tune digests in the database, which lets uploads
+# skip looking up digests which are certainly new (see main.bloom). It is only used once built by
+# ``manage.py rebuild_digest_filter``, which must be run again if the database is restored from
+# a backup, and should be run when ``manage.py rebuild_digest_filter --show`` says the estimated
+# false positive rate has grown too high. The capacity and error rate size new filters.
+ABCDB_DIGEST_FILTER = os.path.join(BASE_DIR, 'digests.bloom')
+ABCDB_DIGEST_FILTER_CAPACITY = 1000000
+ABCDB_DIGEST_FILTER_ERROR_RATE = 0.001
+
+# Whether uploads and URL fetches are queued as jobs, to be parsed by ``manage.py upload_worker``
+# (any number of which may run at once) rather than during the request, in which case URL fetch is
+# available to all users who may upload. ABCDB_UPLOAD_WORKER_POLL_INTERVAL is the number of
+# seconds an idle worker waits before looking for new jobs again. A running job whose worker
+# hasn't reported progress for ABCDB_UPLOAD_JOB_TIMEOUT seconds is taken to have been abandoned
+# by a worker which died, and is marked failed.
+ABCDB_UPLOAD_JOBS = False
+ABCDB_UPLOAD_WORKER_POLL_INTERVAL = 1.0
+ABCDB_UPLOAD_JOB_TIMEOUT = 600
@@ -0,0 +1,10 @@
+# ABCdb benchmarks
+#
+# Stand-alone performance measurements, run from the top-level directory, e.g.:
+#
+#     python -m benchmarks.corpus [tunes] [seed] > corpus.abc
+#     python -m benchmarks.lexer [file.abc ...]
+#     python -m benchmarks.music_code [file.abc ...]
+#     python -m benchmarks.parser [--output new.json] [--compare old.json]
+#     python -m benchmarks.startup [runs] [url]
+#     python -m benchmarks.tune [count]
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+# ABCdb benchmarks/corpus.py
+#
+# Copyright © 2017 Sean Bolton.
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Generate a synthetic ABC corpus, the same for the same arguments, for benchmarks. Tunes have
+varied header fields, text strings with backslash escapes and non-ASCII characters, comments and
+stylesheet directives, lines of music code with chords, decorations, inline fields and line
+continuations, and, now and then, a line which fails to parse. Runs of tunes are switched
+between UTF-8 and ISO-8859-1 with '%%abc-charset' directives. Run as a script, the corpus is
+written to standard output:
+
+    python -m benchmarks.corpus [tunes] [seed] > corpus.abc
+"""
+
+import random
+import sys
+
+
+TITLE_WORDS = ('The', 'Reel', 'Jig', 'Lass', 'of', 'Glen', 'Hornpipe', 'Polka', 'Waltz', 'Mill',
+               'Old', 'Road', 'to', 'Lisdoonvarna', 'Kesh', 'Maid', 'Harvest', 'Home', 'Cooley\'s',
+               'Señor', 'Müller', 'Fête', 'Ålesund', 'Bj\\"ork', 'Caf\\\'e', 'na', 'h-Éireann')
+COMPOSERS = ('Trad.', 'Turlough O\'Carolan', 'J. S. Bach', 'Ed Reavy', 'Ole Bull', 'Dvo\\vrák',
+             'Niel Gow', 'Anon.')
+METERS = (('6/8', '1/8', 6), ('9/8', '1/8', 9), ('4/4', '1/8', 8), ('2/4', '1/16', 8),
+          ('3/4', '1/8', 6), ('C|', '1/8', 8), ('C', '1/4', 4))
+KEYS = ('G', 'D', 'Amix', 'Edor', 'Bm', 'F', 'C', 'Gm clef=bass', 'Ador', 'A')
+RHYTHMS = ('reel', 'jig', 'hornpipe', 'polka', 'waltz', 'slip jig', 'march')
+NOTES = ('C', 'D', 'E', 'F', 'G', 'A', 'B', 'c', 'd', 'e', 'f', 'g', 'a', 'b', "c'", 'B,', 'A,')
+ACCIDENTALS = ('',) * 12 + ('^', '_', '=')
+LENGTHS = ('',) * 8 + ('2', '/', '3', '/2', '3/2', '4')
+DECORATIONS = ('~', '.', 'T', 'H', '!trill!', '!fermata!', 'u', 'v')
+CHORD_SYMBOLS = ('"G"', '"D7"', '"Am"', '"Em/B"', '"C"', '"F#m"', '"^fine"', '"_D.C."')
+# lines which the parser rejects
+BROKEN_LINES = ('abc|{{d}e>f|', '[CEG]2 abc|', '"Am abc|', 'ab +accent+c|', 'abc|2/3/4 d|',
+                '[V:1 abc|')
+
+
+def title(rnd):
+    return ' '.join(rnd.choice(TITLE_WORDS) for _ in range(rnd.randint(2, 5)))
+
+
+def note(rnd, ornate):
+    text = rnd.choice(ACCIDENTALS) + rnd.choice(NOTES) + rnd.choice(LENGTHS)
+    roll = rnd.random()
+    if roll < 0.02:
+        return rnd.choice(('z', 'x', 'z2', 'z/'))
+    if not ornate:
+        return text
+    if roll < 0.07:
+        return rnd.choice(DECORATIONS) + text
+    if roll < 0.08:
+        length = rnd.choice(LENGTHS)
+        return '[' + ''.join(rnd.choice(NOTES[:12]) + length for _ in range(3)) + ']'
+    if roll < 0.12:
+        return text + '>' + rnd.choice(NOTES)
+    return text
+
+
+def bar(rnd, notes, ornate):
+    text = ''.join(note(rnd, ornate) + (' ' if rnd.random() < 0.3 else '') for _ in range(notes))
+    if ornate and rnd.random() < 0.3:
+        text = rnd.choice(CHORD_SYMBOLS) + text
+    if ornate and rnd.random() < 0.1:
+        text = '(3' + text
+    return text.rstrip()
+
+
+def music_code_line(rnd, notes):
+    """Return a line of music code, of four bars of ``notes`` notes or so. Lines are plain (notes,
+    accidentals, lengths, rests and bar lines) unless they are ornate, a third of the time, with
+    decorations, chords, chord symbols, broken rhythms, tuplets and inline fields."""
+    if rnd.random() < 0.02:
+        return rnd.choice(BROKEN_LINES)
+    ornate = rnd.random() < 0.33
+    bars = [bar(rnd, notes, ornate) for _ in range(4)]
+    if ornate and rnd.random() < 0.1:
+        bars[2] = '[M:' + rnd.choice(METERS)[0] + '] ' + bars[2]
+    line = rnd.choice(('|', '|:', '', '')) + '|'.join(bars) + rnd.choice(('|', ':|', '|]', '||'))
+    roll = rnd.random()
+    if roll < 0.05:
+        line += ' \\'
+    elif roll < 0.10:
+        line += ' % ' + title(rnd).lower()
+    return line
+
+
+def tune(rnd, number):
+    """Return the lines of a tune with reference number ``number``."""
+    meter, unit, notes = rnd.choice(METERS)
+    lines = ['X:%d' % number, 'T:' + title(rnd)]
+    if rnd.random() < 0.3:
+        lines.append('T:' + title(rnd))
+    if rnd.random() < 0.6:
+        lines.append('C:' + rnd.choice(COMPOSERS))
+    if rnd.random() < 0.4:
+        lines.append('R:' + rnd.choice(RHYTHMS))
+    if rnd.random() < 0.2:
+        lines.append('%%MIDI program ' + str(rnd.randint(0, 127)))
+    lines.extend(('M:' + meter, 'L:' + unit))
+    if rnd.random() < 0.3:
+        lines.append('Q:1/4=' + str(rnd.randint(60, 200)))
+    lines.append('K:' + rnd.choice(KEYS))
+    for i in range(rnd.randint(2, 16)):
+        if rnd.random() < 0.05:
+            lines.append('% ' + title(rnd))
+        if rnd.random() < 0.03:
+            lines.append('K:' + rnd.choice(KEYS))
+        if rnd.random() < 0.03:
+            lines.append('W:' + title(rnd))
+        lines.append(music_code_line(rnd, notes))
+    return lines
+
+
+def generate_corpus(tunes=1000, seed=0):
+    """Return a corpus of ``tunes`` tunes, as bytes."""
+    rnd = random.Random(seed)
+    chunks = [b'%abc-2.1\n\n']
+    encoding = 'utf-8'
+    for number in range(1, tunes + 1):
+        if rnd.random() < 0.05:
+            encoding = 'iso-8859-1' if encoding == 'utf-8' else 'utf-8'
+            chunks.append(('%%abc-charset ' + encoding + '\n').encode('ascii'))
+        if rnd.random() < 0.1:
+            chunks.append(title(rnd).encode(encoding) + b'\n\n')  # free text
+        lines = tune(rnd, number)
+        chunks.append(('\n'.join(lines) + '\n\n').encode(encoding))
+    return b''.join(chunks)
+
+
+if __name__ == '__main__':
+    sys.stdout.buffer.write(generate_corpus(*(int(arg) for arg in sys.argv[1:3])))
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+# ABCdb benchmarks/lexer.py
+#
+# Copyright © 2017 Sean Bolton.
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Compare the line classification rate of ``lex_line`` and ``split_field`` with that of the
+per-line regular expressions they replaced. Input lines come from the ABC files named on the
+command line, or from ``docs/Cast_A_Bell.abc``."""
+
+import re
+import sys
+import time
+
+from main.abcparser import lex_line, split_field
+
+
+def regex_split_off_comment(line):
+    """``split_off_comment`` as it was before the lexer."""
+    def escape(s):
+        return re.sub(rb'\\(.)', lambda m: b'\\%03d' % ord(m.group(1)[0:1]), s)
+    def unescape(s):
+        return re.sub(rb'\\(\d{3})',
+                      lambda m: b'\\' + chr(int(m.group(1))).encode('raw_unicode_escape'), s)
+    m = re.match(rb'^([^%]*?)\s*(%.*)$', escape(line))
+    if m:
+        return unescape(m.group(1)), unescape(m.group(2))
+    else:
+        return line, None
+
+
+def regex_classify(line):
+    """Classify a line the way ``ABCParser`` did before the lexer."""
+    line = line.rstrip()
+    if re.match(b'^%%', line):
+        return 'directive'
+    if re.match(rb'^\s*%', line):
+        return 'comment'
+    if line == b'':
+        return 'blank'
+    if b'\t' in line:
+        line = line.expandtabs()
+    if b'%' in line:
+        line, comment = regex_split_off_comment(line)
+    m = re.match(r'([A-Za-z+]):\s*(.*)', line.decode('utf-8', errors='backslashreplace'))
+    return m.group(1) if m else 'text'
+
+
+def lexer_classify(line):
+    """Classify a line using ``lex_line`` and ``split_field``."""
+    kind, line, comment = lex_line(line)
+    if kind != 'text':
+        return kind
+    field_type, field_data = split_field(line.decode('utf-8', errors='backslashreplace'))
+    return field_type or 'text'
+
+
+def lines_per_second(classify, lines, repeat=5):
+    """Return the best rate, over ``repeat`` runs, at which ``classify`` handles ``lines``."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for line in lines:
+            classify(line)
+        best = min(best, time.perf_counter() - start)
+    return len(lines) / best
+
+
+def main(filenames):
+    lines = []
+    for fn in filenames or ['docs/Cast_A_Bell.abc']:
+        with open(fn, 'rb') as fh:
+            lines.extend(fh.readlines())
+    # repeat short inputs, so that each timed run is long enough to be meaningful
+    lines *= max(1, 100000 // max(1, len(lines)))
+    assert list(map(regex_classify, lines)) == list(map(lexer_classify, lines))
+    before = lines_per_second(regex_classify, lines)
+    after = lines_per_second(lexer_classify, lines)
+    print('{:d} lines'.format(len(lines)))
+    print('regular expressions: {:12,.0f} lines/sec'.format(before))
+    print('lex_line:            {:12,.0f} lines/sec  ({:.2f}x)'.format(after, after / before))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+# ABCdb benchmarks/music_code.py
+#
+# Copyright © 2017 Sean Bolton.
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Compare the rate at which lines of music code are canonicized by the Python PEG parser alone,
+by ``canonify_music_code`` with its fast path for simple lines, and by the Rust parser (if it has
+been built), with and without the fast path in front of it. Input lines are the music code found
+in the ABC files named on the command line, or in ``docs/Cast_A_Bell.abc`` (including the tunes
+commented out there)."""
+
+import io
+import sys
+import time
+
+from arpeggio import NoMatch
+
+from main.abcparser import ABCParser, get_rust_backend
+from main.abcparser_peg import (ABCVisitor, canonify_music_code, canonify_simple_music_code,
+                                get_parser, visit_parse_tree)
+
+
+class MusicCodeCollector(ABCParser):
+    """Collects the lines of music code, rather than canonicizing them."""
+    def __init__(self):
+        super().__init__(backend='python')
+        self.lines = []
+
+    def canonify_music_code_python(self, line):
+        self.lines.append(line)
+        return 0, line
+
+
+def peg_only(line):
+    try:
+        return visit_parse_tree(get_parser().parse(line), ABCVisitor())
+    except NoMatch:
+        return None
+
+
+def python_with_fast_path(line):
+    try:
+        return canonify_music_code(line)
+    except NoMatch:
+        return None
+
+
+def lines_per_second(canonify, lines, repeat=3):
+    """Return the best rate, over ``repeat`` runs, at which ``canonify`` handles ``lines``."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for line in lines:
+            canonify(line)
+        best = min(best, time.perf_counter() - start)
+    return len(lines) / best
+
+
+def main(filenames):
+    collector = MusicCodeCollector()
+    if filenames:
+        for fn in filenames:
+            with open(fn, 'rb') as fh:
+                collector.parse(fh)
+            collector.reset()
+    else:
+        with open('docs/Cast_A_Bell.abc', 'rb') as fh:
+            collector.parse(io.BytesIO(b''.join(line[2:] if line.startswith(b'% ') else line
+                                                for line in fh)))
+    # repeat short inputs, so that each timed run is long enough to be meaningful
+    lines = collector.lines * max(1, 500 // max(1, len(collector.lines)))
+    simple = sum(canonify_simple_music_code(line) is not None for line in lines)
+    print('{:d} lines of music code, {:.0%} simple enough for the fast path'.format(
+        len(lines), simple / max(1, len(lines))))
+
+    get_parser()  # don't time building the grammar
+    rates = [('Python parser:', lines_per_second(peg_only, lines)),
+             ('Python, fast path:', lines_per_second(python_with_fast_path, lines))]
+    try:
+        rust = get_rust_backend()
+    except OSError as err:
+        print('Rust parser not available: {}'.format(err))
+    else:
+        def rust_with_fast_path(line):
+            text = canonify_simple_music_code(line)
+            return rust.canonify_music_code(line) if text is None else (0, text)
+        rates.append(('Rust parser:', lines_per_second(rust.canonify_music_code, lines)))
+        rates.append(('Rust, fast path:', lines_per_second(rust_with_fast_path, lines)))
+    for name, rate in rates:
+        print('{:20s} {:10,.0f} lines/sec  ({:.2f}x)'.format(name, rate, rate / rates[0][1]))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
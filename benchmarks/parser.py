@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+
+# ABCdb benchmarks/parser.py
+#
+# Copyright © 2017 Sean Bolton.
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Measure the throughput of ``ABCParser`` on a synthetic corpus (see ``benchmarks.corpus``),
+with each music code parser: the Python PEG parser alone, the Python parser with its fast path
+for simple lines, and the Rust parser (if it has been built), with and without a thread pool.
+Lines and tunes per second are the best of several runs; peak memory is taken from a further run
+traced by ``tracemalloc``. The music code cache is disabled unless ``--cache`` is given, so that
+every line is parsed.
+
+Results may be saved as JSON, and compared with an earlier run; the exit status is 1 if anything
+got slower, or used more memory, by more than the threshold:
+
+    python -m benchmarks.parser [--tunes N] [--seed S] [--output new.json] [--compare old.json]
+"""
+
+import argparse
+import io
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+from arpeggio import NoMatch
+
+from benchmarks.corpus import generate_corpus
+from main.abcparser import ABCParser, decode_abc_text_string, get_rust_backend, music_code_cache
+from main.abcparser_peg import ABCVisitor, get_parser, visit_parse_tree
+
+
+class BenchmarkParser(ABCParser):
+    """Counts tunes and errors, and otherwise does nothing with them."""
+    def __init__(self, backend='python', threads=0):
+        super().__init__(backend=backend, music_code_threads=threads)
+        self.tunes = 0
+        self.errors = 0
+
+    def log(self, severity, message, text):
+        if severity == 'error':
+            self.errors += 1
+
+    def process_tune(self, tune):
+        self.tunes += 1
+
+
+class PEGOnlyParser(BenchmarkParser):
+    """Canonicizes every line of music code with the Python PEG parser, bypassing the fast
+    path."""
+    def canonify_music_code_python(self, line):
+        try:
+            visitor = ABCVisitor(text_string_decoder=decode_abc_text_string)
+            return 0, visit_parse_tree(get_parser().parse(line), visitor)
+        except NoMatch as err:
+            return 1, str(err)
+
+
+def configurations():
+    """Return a list of ``(name, factory)`` tuples, one for each way of parsing available."""
+    configs = [('Python parser', PEGOnlyParser),
+               ('Python, fast path', BenchmarkParser)]
+    try:
+        get_rust_backend()
+    except OSError as err:
+        print('Rust parser not available: {}'.format(err), file=sys.stderr)
+    else:
+        configs.append(('Rust parser', lambda: BenchmarkParser('rust')))
+        configs.append(('Rust, 4 threads', lambda: BenchmarkParser('rust', threads=4)))
+    return configs
+
+
+def run(factory, data, cache):
+    """Parse ``data`` with a new parser from ``factory``, returning the parser."""
+    music_code_cache.clear()
+    music_code_cache.resize(music_code_cache.maxsize if cache else 0)
+    p = factory()
+    p.parse(io.BytesIO(data))
+    return p
+
+
+def measure(factory, data, repeat, cache):
+    """Return a dict of measurements of parsing ``data`` with parsers from ``factory``."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        p = run(factory, data, cache)
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    run(factory, data, cache)
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'seconds': best,
+            'lines_per_second': p.line_number / best,
+            'tunes_per_second': p.tunes / best,
+            'peak_memory': peak_memory,
+            'lines': p.line_number,
+            'tunes': p.tunes,
+            'errors': p.errors}
+
+
+def compare(old, new, threshold):
+    """Print the change in each measurement from ``old`` results to ``new``, returning the
+    number of regressions greater than ``threshold`` (a fraction)."""
+    regressions = 0
+    if old['corpus'] != new['corpus']:
+        print('Warning: the corpora differ: {} and {}'.format(old['corpus'], new['corpus']))
+    for name, result in new['results'].items():
+        before = old['results'].get(name)
+        if before is None:
+            continue
+        for key, higher_is_better in (('lines_per_second', True), ('tunes_per_second', True),
+                                      ('peak_memory', False)):
+            ratio = result[key] / before[key] if before[key] else 1.0
+            worse = ratio < 1 - threshold if higher_is_better else ratio > 1 + threshold
+            regressions += worse
+            print('{:20s} {:17s} {:14,.0f} -> {:14,.0f} ({:+6.1%}){}'.format(
+                name, key, before[key], result[key], ratio - 1, '  REGRESSION' if worse else ''))
+    return regressions
+
+
+def main(argv):
+    ap = argparse.ArgumentParser(description='Measure ABCParser throughput on a synthetic corpus.')
+    ap.add_argument('--tunes', type=int, default=200, help='tunes in the corpus')
+    ap.add_argument('--seed', type=int, default=0, help='corpus random seed')
+    ap.add_argument('--repeat', type=int, default=3, help='timed runs of each parser')
+    ap.add_argument('--cache', action='store_true', help='leave the music code cache enabled')
+    ap.add_argument('--output', help='save the results to this JSON file')
+    ap.add_argument('--compare', help='compare the results with this earlier JSON file')
+    ap.add_argument('--threshold', type=float, default=0.1,
+                    help='the fractional change counted as a regression (default 0.1)')
+    args = ap.parse_args(argv)
+
+    data = generate_corpus(args.tunes, args.seed)
+    get_parser()  # don't time building the grammar
+    results = {'corpus': {'tunes': args.tunes, 'seed': args.seed, 'bytes': len(data),
+                          'cache': args.cache},
+               'python': platform.python_version(),
+               'results': {}}
+    for name, factory in configurations():
+        result = measure(factory, data, args.repeat, args.cache)
+        results['results'][name] = result
+        print('{:20s} {:10,.0f} lines/sec {:8,.0f} tunes/sec {:8.1f} MB peak ({:d} errors)'.format(
+            name, result['lines_per_second'], result['tunes_per_second'],
+            result['peak_memory'] / 1e6, result['errors']))
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(results, fh, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as fh:
+            old = json.load(fh)
+        return 1 if compare(old, results, args.threshold) else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+# ABCdb benchmarks/startup.py
+#
+# Copyright © 2017 Sean Bolton.
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Measure the start-up cost of a web worker: ``django.setup()``, loading the URLconf (which
+imports the views, and through them the parser), the first request, and the first line of music
+code parsed by the Python parser, which is when its grammar is compiled. Each run is made in a
+fresh interpreter, so nothing is already imported; the median of the runs is reported. The
+environment must hold the usual ABCDB_SECRET_KEY and ABCDB_DEPLOYMENT settings.
+
+    python -m benchmarks.startup [runs] [url]
+"""
+
+import json
+import statistics
+import subprocess
+import sys
+
+# run in a fresh interpreter for each measurement
+PROBE = r'''
+import json, os, sys, time
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'abcdb.settings')
+times = {}
+start = time.perf_counter()
+import django
+django.setup()
+times['django.setup()'] = time.perf_counter() - start
+
+start = time.perf_counter()
+from django.urls import get_resolver
+get_resolver().url_patterns
+times['URLconf load'] = time.perf_counter() - start
+
+from django.test import Client
+start = time.perf_counter()
+Client().get(sys.argv[1])
+times['first request'] = time.perf_counter() - start
+
+from main.abcparser_peg import canonify_music_code
+start = time.perf_counter()
+canonify_music_code('abc|')
+times['first Python parse'] = time.perf_counter() - start
+
+times['modules loaded'] = len(sys.modules)
+print(json.dumps(times))
+'''
+
+
+def main(runs=5, url='/upload/'):
+    results = []
+    for _ in range(runs):
+        output = subprocess.check_output([sys.executable, '-c', PROBE, url])
+        results.append(json.loads(output.decode('utf-8').splitlines()[-1]))
+    print('{:d} runs, first request to {}'.format(runs, url))
+    for phase in results[0]:
+        value = statistics.median(result[phase] for result in results)
+        if phase == 'modules loaded':
+            print('{:20s} {:8.0f}'.format(phase, value))
+        else:
+            print('{:20s} {:8.1f} ms'.format(phase, value * 1000))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) if arg.isdigit() else arg for arg in sys.argv[1:]])
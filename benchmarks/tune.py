@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+# ABCdb benchmarks/tune.py
+#
+# Copyright © 2017 Sean Bolton.
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Compare the time and memory taken to build, and canonicize, many tunes using ``Tune`` with
+those taken by the sort-key-based representation it replaced."""
+
+import sys
+import time
+import tracemalloc
+
+from main.abcparser import Tune
+
+
+class SortKeyTune(object):
+    """``Tune`` as it was before its canonical lines were bucketed."""
+
+    def __init__(self):
+        self.full_tune = []
+        self.X = None
+        self.line_number = 0
+        self.T = []
+        self.canonical = []
+
+    def full_tune_append(self, line):
+        self.full_tune.append(line)
+
+    def canonical_append(self, field, line):
+        n = '%06d' % len(self.canonical)
+        if field in 'XT':
+            key = '1' + field + n
+        elif field in 'LMmPUV':
+            key = '2' + field + n
+        elif field == 'K':
+            key = '3' + field + n
+        elif field != 'body':
+            key = '4' + field + n
+        else:
+            key = '5_' + n
+        self.canonical.append({ 'sort': key, 'line': line})
+
+    def canonical_lines(self):
+        self.canonical.sort(key=lambda l: l['sort'])
+        return [l['line'] for l in self.canonical]
+
+
+# A typical tune: header fields, then 16 lines of music code with a key change in the middle.
+TUNE = ([('M', 'M:6/8'), ('L', 'L:1/8'), ('K', 'K:G')] +
+        [('body', 'GAB c2d|e2f gfe|d2B G2A|B3 A3|')] * 8 + [('body', 'K:D')] +
+        [('body', 'fga b2a|g2e f2d|e2c A2B|c3 d3|')] * 8 + [('body', '')])
+
+
+def build(cls, count):
+    """Build ``count`` tunes of class ``cls``, returning them."""
+    tunes = []
+    for i in range(count):
+        tune = cls()
+        tune.X = i
+        for field, line in TUNE:
+            tune.full_tune_append(line)
+            tune.canonical_append(field, line)
+        tunes.append(tune)
+    return tunes
+
+
+def measure(cls, canonical, count):
+    """Return the time taken, and the memory held, by ``count`` tunes of class ``cls``, and the
+    canonical lines of the last one."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    tunes = build(cls, count)
+    for tune in tunes:
+        lines = canonical(tune)
+    elapsed = time.perf_counter() - start
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return elapsed, memory, lines
+
+
+def main(count):
+    before = measure(SortKeyTune, SortKeyTune.canonical_lines, count)
+    after = measure(Tune, lambda tune: tune.canonical, count)
+    assert before[2] == after[2]
+    print('{:d} tunes'.format(count))
+    for name, (elapsed, memory, _) in (('sort keys', before), ('Tune', after)):
+        print('{:10s} {:7.3f} seconds {:8.1f} bytes/tune'.format(name, elapsed, memory / count))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
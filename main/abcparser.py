@@ -25,14 +25,24 @@
 
 import abc
 import codecs
+import collections
+import concurrent.futures
+import hashlib
+import heapq
+import io
+import math
+import mmap
 import os
 import re
+import stat
+import threading
 import time
+import tracemalloc
 import unicodedata
 
 from arpeggio import NoMatch
 
-from .abcparser_peg import canonify_music_code
+from .abcparser_peg import ParseBudgetExceeded, canonify_music_code
 
 
 class Tune(object):
@@ -40,6 +50,9 @@ class Tune(object):
     in the input, and the canonicized tune, or 'song', by which deduplication is done. All
     string data in a Tune instance must already have been converted to Unicode."""
 
+    __slots__ = ('full_tune', 'X', 'line_number', 'T', 'raw_digest', 'header', 'body',
+                 '_full_hash', '_full_count', '_song_hash', '_song_count')
+
     def __init__(self):
         self.full_tune = []   # The full text of the tune instance. Aside from some whitespace
                               # normalization, this is the tune as found in the input. This is
@@ -47,49 +60,160 @@ class Tune(object):
         self.X = None         # The tune number, i.e. the numeric value of the X field.
         self.line_number = 0  # The line number in the input file at which this tune started.
         self.T = []           # A list of titles, in order of appearance.
-        self.canonical = []   # The canonicized song, containing only those header fields which
-                              # effect the music itself (K, L, M, m, P, U, and V), plus the body
+        self.raw_digest = None  # When ``ABCParser.use_raw_digests`` is set, the digest of the
+                                # tune's raw input (see ``ABCParser.find_known_tune``), unless
+                                # a line of its music code panicked or went over budget.
+        self.header = {}      # The canonicized song is made up of those header fields which
+        self.body = []        # effect the music itself (K, L, M, m, P, U, and V), plus the body
                               # of the tune (music code) with the following stripped: comments,
                               # stylesheet directives, and (non-inline) fields other than K, L,
-                              # M, m, P, s, U, V, W, and w. This is a list of dicts of the form:
-                              #    { 'sort': sortkey, 'line': line}
+                              # M, m, P, s, U, V, W, and w. The header fields are kept in
+                              # ``header``, a dict of lists of lines keyed by the field's bucket
+                              # name (see ``canonical_append``), and the body lines in ``body``.
+
+        # Running hashes of the instance and song, updated as lines are appended, with the number
+        # of lines of ``full_tune`` and ``body`` they include. A count which doesn't match (e.g.
+        # None before the first body line, or -1 after unpickling) means the hash must be
+        # recomputed from scratch.
+        self._full_hash = hashlib.sha1()
+        self._full_count = 0
+        self._song_hash = None
+        self._song_count = None
 
 
     def __str__(self):
         r = 'X: ' + str(self.X) + '\n'
         r += ''.join(['T: %s\n' % x for x in self.T])
         r += ''.join(['F| %s\n' % x for x in self.full_tune])
-        self.sort_canonical()
-        for l in self.canonical:
-            r += 'D| %s %s\n' % (l['sort'], l['line'])
+        r += ''.join(['D| %s\n' % x for x in self.canonical])
         return r
 
 
+    def __getstate__(self):
+        # hash objects can't be pickled, so leave them to be recomputed
+        return {slot: getattr(self, slot) for slot in self.__slots__ if slot[0] != '_'}
+
+
+    def __setstate__(self, state):
+        for slot, value in state.items():
+            setattr(self, slot, value)
+        self._full_hash = self._song_hash = None
+        self._full_count = self._song_count = -1
+
+
+    @property
+    def canonical(self):
+        """The canonicized song, as a list of lines in the canonical field ordering."""
+        lines = self.canonical_header()
+        lines.extend(self.body)
+        return lines
+
+
+    def canonical_header(self):
+        """Return the header lines of the canonicized song, in the canonical field ordering."""
+        lines = []
+        for bucket in sorted(self.header):
+            lines.extend(self.header[bucket])
+        return lines
+
+
+    @property
+    def digest(self):
+        """The SHA1 hex digest of the full tune instance, with its first ('X:') line replaced by
+        'X:1', and each line terminated by a newline, for deduplication of instances."""
+        if self._full_count != len(self.full_tune):
+            self._full_hash = hashlib.sha1()
+            self._full_count = 0
+            for line in self.full_tune:
+                self._full_hash_update(line)
+        return self._full_hash.hexdigest()
+
+
+    @property
+    def song_digest(self):
+        """The SHA1 hex digest of the canonicized song, each line terminated by a newline, for
+        deduplication of songs."""
+        if self._song_count == len(self.body):
+            return self._song_hash.hexdigest()
+        song_hash = hashlib.sha1()
+        for line in self.canonical:
+            song_hash.update(line.encode('utf-8'))
+            song_hash.update(b'\n')
+        if not self.header and not self.body:
+            song_hash.update(b'\n')  # as though joined from a single empty line
+        return song_hash.hexdigest()
+
+
     def full_tune_append(self, line):
         assert(isinstance(line, str))
         self.full_tune.append(line)
+        if self._full_count == len(self.full_tune) - 1:
+            self._full_hash_update(line)
+
+
+    def _full_hash_update(self, line):
+        self._full_hash.update(line.encode('utf-8') if self._full_count else b'X:1')
+        self._full_hash.update(b'\n')
+        self._full_count += 1
 
 
     def canonical_append(self, field, line):
-        # The ``sort`` field is constructed so that self.canonical will sort() into the canonical
-        # field ordering.
+        # Header lines go into a bucket per field, named so that the buckets sort into the
+        # canonical field ordering: first X and T (which should never happen), then L, M, m, P, U
+        # and V, then K, then any others, each in order of appearance. The body follows. The
+        # parser appends all header lines before any body lines, so the song hash is started
+        # with the header at the first body line, and then updated line by line.
         assert(isinstance(line, str))
-        n = '%06d' % len(self.canonical)
+        if field == 'body':
+            self.body.append(line)
+            self._song_hash_advance()
+            return
+        if self._song_count is not None:  # header after body; ``song_digest`` must start over
+            self._song_count = -1
         if field in 'XT':          # pragma: no branch -- these should never happen
-            key = '1' + field + n  # pragma: no cover
+            bucket = '1' + field   # pragma: no cover
         elif field in 'LMmPUV':
-            key = '2' + field + n
+            bucket = '2' + field
         elif field == 'K':
-            key = '3' + field + n
-        elif field != 'body':      # pragma: no branch
-            key = '4' + field + n  # pragma: no cover
+            bucket = '3K'
+        else:                      # pragma: no cover
+            bucket = '4' + field   # pragma: no cover
+        lines = self.header.get(bucket)
+        if lines is None:
+            self.header[bucket] = [line]
         else:
-            key = '5_' + n
-        self.canonical.append({ 'sort': key, 'line': line})
-
-
-    def sort_canonical(self):
-        self.canonical.sort(key=lambda l: l['sort'])
+            lines.append(line)
+
+
+    def canonical_append_pending(self):
+        """Append a placeholder body line, to be filled in later with ``canonical_resolve``, and
+        return its index. The song hash advances no further than the first placeholder."""
+        self.body.append(None)
+        self._song_hash_advance()
+        return len(self.body) - 1
+
+
+    def canonical_resolve(self, index, line):
+        """Replace the placeholder body line at ``index`` with ``line``."""
+        assert(isinstance(line, str) and self.body[index] is None)
+        self.body[index] = line
+        self._song_hash_advance()
+
+
+    def _song_hash_advance(self):
+        if self._song_count is None:
+            self._song_hash = hashlib.sha1()
+            self._song_count = 0
+            for header_line in self.canonical_header():
+                self._song_hash.update(header_line.encode('utf-8'))
+                self._song_hash.update(b'\n')
+        while 0 <= self._song_count < len(self.body):
+            line = self.body[self._song_count]
+            if line is None:
+                break
+            self._song_hash.update(line.encode('utf-8'))
+            self._song_hash.update(b'\n')
+            self._song_count += 1
 
 
 ABC_CHARACTER_MNEMONICS = {
@@ -222,9 +346,249 @@ RE_ABC_CHARACTER_ENCODINGS = re.compile(r"""
     """, re.VERBOSE | re.UNICODE)
 
 
-def decode_abc_text_string(text):
+class LRUCache(object):
+    """A thread-safe mapping of bounded size, which discards the least recently used entry when it
+    is full, and counts its hits, misses, and evictions. A ``maxsize`` of zero disables it."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.clear()
+
+
+    def __len__(self):
+        return len(self.data)
+
+
+    def clear(self):
+        """Remove all entries and reset the counters."""
+        with self.lock:
+            self.data = collections.OrderedDict()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+
+    def get(self, key, default=None):
+        """Return the value for ``key``, marking it most recently used, or ``default`` if it isn't
+        cached."""
+        with self.lock:
+            try:
+                value = self.data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self.data.move_to_end(key)
+            self.hits += 1
+            return value
+
+
+    def put(self, key, value):
+        """Cache ``value`` for ``key``, evicting the least recently used entries if needed."""
+        with self.lock:
+            if self.maxsize <= 0:
+                return
+            self.data[key] = value
+            self.data.move_to_end(key)
+            self._evict()
+
+
+    def resize(self, maxsize):
+        """Change the maximum size, evicting entries if the cache is now too full."""
+        with self.lock:
+            self.maxsize = maxsize
+            self._evict()
+
+
+    def _evict(self):
+        while len(self.data) > max(self.maxsize, 0):
+            self.data.popitem(last=False)
+            self.evictions += 1
+
+
+class LatencyHistogram(object):
+    """Counts of durations, in buckets of powers of two microseconds, for finding the tail of a
+    latency distribution without keeping every sample."""
+
+    def __init__(self):
+        self.counts = collections.Counter()  # bucket upper bound, in microseconds: count
+        self.total = 0
+        self.max = 0.0
+
+    def add(self, seconds, count=1):
+        """Record ``count`` durations of ``seconds``."""
+        self.counts[1 << int(seconds * 1e6).bit_length()] += count
+        self.total += count
+        self.max = max(self.max, seconds)
+
+    def merge(self, other):
+        """Add the durations recorded by another ``LatencyHistogram``."""
+        self.counts.update(other.counts)
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, percent):
+        """Return the upper bound, in seconds, of the bucket holding the ``percent``th percentile,
+        or 0 if nothing has been recorded."""
+        target = self.total * percent / 100
+        seen = 0
+        for bound in sorted(self.counts):
+            seen += self.counts[bound]
+            if seen >= target:
+                return bound / 1e6
+        return 0.0
+
+    def __str__(self):
+        return ', '.join('< {:g} ms: {:d}'.format(bound / 1000, self.counts[bound])
+                         for bound in sorted(self.counts))
+
+
+class ParseStats(object):
+    """Time spent in each phase of parsing, counts of ``log`` calls by severity, and optionally
+    the slowest tunes, for seeing where the time goes. Set an ``ABCParser``'s ``stats`` attribute
+    to one of these to have it filled in. The phases are:
+
+    'read'
+        getting the input and splitting it into lines (with ``feed``, this includes waiting
+        between chunks)
+    'lex'
+        classifying lines and splitting off comments, and handling directives, comments and
+        blank lines
+    'decode'
+        decoding lines to str
+    'fields'
+        handling information fields
+    'music code'
+        canonicizing music code (with ``music_code_threads``, only handing it to the thread pool)
+    'process_tune'
+        ``process_tune`` and ``process_known_tune``, or, with ``iter_tunes``, the caller's
+        handling of each tune
+
+    Switching phases costs one ``time.perf_counter`` call. Phases aren't timed in the worker
+    processes of ``parse_parallel``."""
+
+    PHASES = ('read', 'lex', 'decode', 'fields', 'music code', 'process_tune')
+
+    def __init__(self, slowest_tunes=0):
+        self.times = dict.fromkeys(self.PHASES, 0.0)   # phase: seconds
+        self.log_counts = collections.Counter()        # severity: count
+        self.slowest_tunes = slowest_tunes
+        self.slowest = []   # min-heap of (seconds, line number, X, first title), see ``slowest``
+        self.tune_starts = {}   # id(tune): start time, for tunes being parsed
+        self.peak_memory = None   # peak traced memory, if ``tracemalloc`` was tracing
+        self.phase = 'read'
+        self.mark = time.perf_counter()
+
+    def enter(self, phase):
+        """Charge the time since the last change of phase to the current one, and change to
+        ``phase``. Returns the previous phase."""
+        now = time.perf_counter()
+        self.times[self.phase] += now - self.mark
+        previous, self.phase, self.mark = self.phase, phase, now
+        return previous
+
+    def start_tune(self, tune):
+        """Note the start of parsing ``tune``."""
+        if self.slowest_tunes:
+            self.tune_starts[id(tune)] = time.perf_counter()
+
+    def finish_tune(self, tune):
+        """Note that ``tune`` has been processed, and remember it if it's among the slowest."""
+        start = self.tune_starts.pop(id(tune), None)
+        if start is not None:
+            title = tune.T[0] if tune.T else ''
+            entry = (time.perf_counter() - start, tune.line_number, tune.X, title)
+            if len(self.slowest) < self.slowest_tunes:
+                heapq.heappush(self.slowest, entry)
+            else:
+                heapq.heappushpop(self.slowest, entry)
+
+    def finish(self):
+        """Charge the time so far to the current phase, and note the peak traced memory."""
+        self.enter(self.phase)
+        if tracemalloc.is_tracing():
+            self.peak_memory = tracemalloc.get_traced_memory()[1]
+
+    @property
+    def total(self):
+        return sum(self.times.values())
+
+    def report(self):
+        """Return a list of (plain text) lines describing the statistics."""
+        total = self.total or 1.0
+        lines = ['Time by phase: ' + ', '.join(
+                     '{} {:.2f} s ({:.0%})'.format(phase, self.times[phase],
+                                                   self.times[phase] / total)
+                     for phase in self.PHASES)]
+        lines.append('Log messages: ' + (', '.join(
+                         '{:d} {}'.format(self.log_counts[severity], severity)
+                         for severity in ('error', 'warn', 'info', 'ignore')
+                         if self.log_counts[severity]) or 'none'))
+        if self.slowest:
+            lines.append('Slowest tunes: ' + ', '.join(
+                             "X:{} '{}' at line {:d} ({:.3f} s)".format(x, title, line_number,
+                                                                        seconds)
+                             for seconds, line_number, x, title in sorted(self.slowest,
+                                                                          reverse=True)))
+        if self.peak_memory is not None:
+            lines.append('Peak traced memory: {:.1f} MB'.format(self.peak_memory / 1e6))
+        return lines
+
+
+# Text strings without these need neither decoding nor normalization.
+RE_ABC_TEXT_NEEDS_DECODING = re.compile(r'[\\&\x80-\U0010ffff]')
+
+# The number of decoded text strings (titles, composers, origins, and so on) to remember.
+TEXT_STRING_CACHE_SIZE = 4096
+
+text_string_cache = LRUCache(TEXT_STRING_CACHE_SIZE)
+
+
+def decode_abc_text_string(text, decode_batch=None):
     """Decode ABC character replacements (TeX-style mnemonics, named HTML entities, or
-    \\uxxxx or \\Uxxxxxxxx escapes)."""
+    \\uxxxx or \\Uxxxxxxxx escapes), and normalize the result to NFC. Plain ASCII strings are
+    returned as is, and the results for others are remembered in ``text_string_cache``.
+
+    ``decode_batch``, if given, is a function doing the actual decoding of a list of strings,
+    e.g. ``RustBackend.decode_text_strings``, which must agree with ``_decode_abc_text_string``."""
+    if RE_ABC_TEXT_NEEDS_DECODING.search(text) is None:
+        return text
+    decoded = text_string_cache.get(text)
+    if decoded is None:
+        decoded = decode_batch([text])[0] if decode_batch else _decode_abc_text_string(text)
+        text_string_cache.put(text, decoded)
+    return decoded
+
+
+def decode_abc_text_strings(texts, decode_batch=None):
+    """Decode a sequence of text strings, such as all the text fields of a tune, as
+    ``decode_abc_text_string`` does, returning a list of the results. Repeated strings are
+    decoded only once, and those not already in ``text_string_cache`` with one call to
+    ``decode_batch``, if given."""
+    decoded = {}
+    misses = []
+    for text in texts:
+        if text in decoded:
+            continue
+        if RE_ABC_TEXT_NEEDS_DECODING.search(text) is None:
+            decoded[text] = text
+        else:
+            decoded[text] = text_string_cache.get(text)
+            if decoded[text] is None:
+                misses.append(text)
+    if misses:
+        if decode_batch:
+            results = decode_batch(misses)
+        else:
+            results = [_decode_abc_text_string(text) for text in misses]
+        for text, result in zip(misses, results):
+            text_string_cache.put(text, result)
+            decoded[text] = result
+    return [decoded[text] for text in texts]
+
+
+def _decode_abc_text_string(text):
+    """The uncached implementation of ``decode_abc_text_string``."""
     def decode(match):
         m = match.group(0)
         if m.startswith('&'):  # HTML named entity
@@ -233,9 +597,11 @@ def decode_abc_text_string(text):
             c = int(m[2:], 16)
             if c == 160:
                 return ' '  # sub regular space for non-breaking-space
-            if c in range(0, 32) or c in range(128, 160) or c in range(0xdb00, 0xe000):
-                # don't sub control characters or invalid code points, instead return the original
-                # escape sequence with '\' replaced by '^'
+            if c in range(0, 32) or c in range(128, 160) or c in range(0xd800, 0xe000) or \
+                    c > 0x10ffff:
+                # don't sub control characters or invalid code points (surrogates, or beyond the
+                # Unicode range), instead return the original escape sequence with '\' replaced
+                # by '^'
                 return '^' + m[1:]
             else:
                 return codecs.decode(match.group(0), "unicode_escape")
@@ -248,74 +614,375 @@ def decode_abc_text_string(text):
 
 
 def split_off_comment(line):
-    """Split a line (of bytes) on the comment character '%', but allow for escaping with '\\%'."""
-    def escape(s):
-        """
-        Replace any backslash-escaped sequence '\\x' with '\\ddd', where 'ddd' is the decimal
-        value of 'x'.
-        """
-        return re.sub(rb'\\(.)', lambda m: b'\\%03d' % ord(m.group(1)[0:1]), s)
-    def unescape(s):
-        """
-        Replace any backslash-escaped sequence '\\ddd' with '\\x', where 'x' is the ASCCI
-        character whose value is decimal 'ddd'.
-        """
-        return re.sub(rb'\\(\d{3})',
-                      lambda m: b'\\' + chr(int(m.group(1))).encode('raw_unicode_escape'), s)
-    m = re.match(rb'^([^%]*?)\s*(%.*)$', escape(line))
-    if m:
-        return unescape(m.group(1)), unescape(m.group(2))
-    else:
-        return line, None
-
+    """Split a line (of bytes, without end-of-line characters) on the comment character '%', but
+    allow for escaping with '\\%'. Returns the text before the comment, with trailing whitespace
+    removed, and the comment, or the line and ``None`` if there is no comment."""
+    start = 0
+    while True:
+        percent = line.find(b'%', start)
+        if percent < 0:
+            return line, None
+        backslash = line.find(b'\\', start, percent)
+        if backslash < 0:
+            # escaped characters (before ``start``) aren't stripped, even if they're whitespace
+            return line[:start] + line[start:percent].rstrip(), line[percent:]
+        start = backslash + 2  # skip the escaped character, which may be this '%'
+
+
+LexedLine = collections.namedtuple('LexedLine', ('kind', 'text', 'comment'))
+LexedLine.__doc__ = """One line of input, as classified by ``lex_line``."""
+
+
+def lex_line(line):
+    """Classify one line of (bytes) input, from which any UTF-8 BOM has already been removed,
+    returning a ``LexedLine``. Trailing whitespace and end-of-line characters are removed, and
+    ``kind`` is one of:
+
+        'directive': a stylesheet directive, beginning with '%%'
+        'comment':   a line containing only a comment
+        'blank':     an empty line
+        'text':      anything else, with tabs expanded and any comment split off into
+                     ``comment``, which is otherwise ``None``
+
+    The ``text`` and ``comment`` are still bytes; information fields are split by
+    ``split_field`` once ``text`` has been decoded."""
+    line = line.rstrip()
+    if not line:
+        return LexedLine('blank', line, None)
+    if line.startswith(b'%%'):
+        return LexedLine('directive', line, None)
+    if b'%' in line:
+        if line.lstrip().startswith(b'%'):
+            return LexedLine('comment', line, None)
+        if b'\t' in line:
+            line = line.expandtabs()
+        line, comment = split_off_comment(line)
+        return LexedLine('text', line, comment)
+    if b'\t' in line:
+        line = line.expandtabs()
+    return LexedLine('text', line, None)
+
+
+ABC_FIELD_TYPES = frozenset('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz+')
+
+
+def split_field(line):
+    """Split a (str) line which is an information field, e.g. 'T: Title', into its field type
+    and data, with leading whitespace removed from the data. Returns ``(None, None)`` for lines
+    which aren't fields."""
+    if line[1:2] == ':' and line[:1] in ABC_FIELD_TYPES:
+        return line[0], line[2:].lstrip()
+    return None, None
+
+
+# The longest line ``parse`` will read at once; longer lines are split. 4k should be enough.
+MAX_LINE_LENGTH = 4096
 
 RE_DECODE_FROM_RAW_CONTROLS = re.compile(r'[\x00-\x1f\x7f-\xa0]')
 
+# Raw input bytes which ``decode_from_raw`` could turn into control characters or non-breaking
+# spaces, when decoding as UTF-8. Tabs are always expanded before decoding, and a carriage return
+# before a newline is stripped along with it.
+RE_RAW_CONTROLS = re.compile(rb'[\x00-\x08\x0b\x0c\x0e-\x1f\x7f]|\r(?!\n)|\xc2[\x80-\xa0]')
+
+
+def _line_spans(buf, final=True, start=0):
+    """Yield the ``(start, end)`` offsets of the lines in ``buf`` (bytes or an ``mmap``) from
+    offset ``start`` on, split the same way ``readline(MAX_LINE_LENGTH)`` would split them. Unless
+    ``final`` is true, an incomplete last line is not yielded."""
+    length = len(buf)
+    while start < length:
+        end = buf.find(b'\n', start, start + MAX_LINE_LENGTH)
+        if end >= 0:
+            end += 1
+        elif length - start >= MAX_LINE_LENGTH:
+            end = start + MAX_LINE_LENGTH
+        elif final:
+            end = length
+        else:
+            break
+        yield start, end
+        start = end
+
+
+def _map_file(filehandle):
+    """Return a read-only ``mmap`` of the regular file underlying ``filehandle``, or ``None`` if
+    it isn't one (e.g. a pipe, a socket, or an in-memory file), or is empty."""
+    try:
+        fileno = filehandle.fileno()
+        if not stat.S_ISREG(os.fstat(fileno).st_mode):
+            return None
+        return mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+    except (AttributeError, OSError, ValueError):  # io.UnsupportedOperation is an OSError;
+        return None                                 # mmap raises ValueError for empty files
+
+
+# The default number of canonicized music code lines to remember.
+MUSIC_CODE_CACHE_SIZE = 65536
+
+# Folk tune collections repeat the same lines of music code many times, so the results of
+# canonicizing them, including failures, are cached for all parsers in the process. The keys are
+# ``(parser, line)`` tuples, since the Python and Rust parsers aren't guaranteed to agree.
+music_code_cache = LRUCache(MUSIC_CODE_CACHE_SIZE)
+
+
+# ========== Music code parser backends ==========
+
+# The backends ``ABCParser`` can use to canonicize music code: 'python' is the Arpeggio PEG parser,
+# 'rust' the (much faster) Rust PEG parser, and 'auto' the Rust parser if it can be loaded, and the
+# Python parser otherwise.
+MUSIC_CODE_BACKENDS = ('auto', 'rust', 'python')
+
+# The shared library built by ``cargo build --release``, found relative to this package rather
+# than the working directory.
+RUST_LIBRARY_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                 'target', 'release', 'libabcparser_peg.so')
+
+
+def batch_records(data):
+    """Return the list of ``(status, text)`` records in ``data``, the contents of a ``BatchResult``
+    from the Rust library (see ``push_record`` in src/abcparser_peg.rs): each record is a status
+    byte, the length of the text as four little-endian bytes, then the UTF-8 text itself. Text
+    which isn't valid UTF-8 is reported as a panic, with a status of 2."""
+    results = []
+    offset = 0
+    while offset < len(data):
+        status = data[offset]
+        length = int.from_bytes(data[offset + 1:offset + 5], 'little')
+        text = data[offset + 5:offset + 5 + length]
+        offset += 5 + length
+        try:
+            text = text.decode('utf-8')
+        except UnicodeDecodeError:
+            status = 2
+            text = "Parser returned illegal UTF_8"
+        results.append((status, text))
+    return results
+
+
+class RustBackend(object):
+    """The Rust PEG parser, loaded from the shared library at ``path``. Use ``get_rust_backend``
+    rather than instantiating this directly, so that each library is only loaded once per process.
+    Raises ``OSError`` if the library can't be loaded."""
+    name = "Rust"
+
+    def __init__(self, path):
+        import ctypes
+        from ctypes import (POINTER, c_char_p, c_int32, c_size_t, c_void_p)
+
+        self.path = path
+        peglib = ctypes.cdll.LoadLibrary(path)
+
+        class CallResult(ctypes.Structure):
+            _fields_ = [("status", c_int32), ("text", c_char_p)]
+
+        try:
+            self._canonify = peglib.canonify_music_code
+            self._free_result = peglib.free_result
+        except AttributeError as err:
+            raise OSError("{}: not an ABC parser library ({})".format(path, err))
+        self._canonify.argtypes = (c_char_p, )
+        self._canonify.restype = POINTER(CallResult)
+        self._free_result.argtypes = (POINTER(CallResult), )
+        self._free_result.restype = None
+
+        class BatchResult(ctypes.Structure):
+            _fields_ = [("len", c_size_t), ("data", c_void_p)]
+
+        def batch_function(name):
+            function = getattr(peglib, name)
+            function.argtypes = (c_char_p, c_size_t)
+            function.restype = POINTER(BatchResult)
+            return function
+
+        # the functions below are missing from libraries built by older versions of this code
+        self.canonify_music_code_batch = None
+        self.decode_abc_text_string = self.decode_abc_text_strings = None
+        try:
+            self._free_batch_result = peglib.free_batch_result
+        except AttributeError:
+            return
+        self._free_batch_result.argtypes = (POINTER(BatchResult), )
+        self._free_batch_result.restype = None
+        self._canonify_batch = batch_function('canonify_music_code_batch')
+        self.canonify_music_code_batch = self._canonify_music_code_batch
+        try:
+            self._decode_text = batch_function('decode_text_string')
+            self._decode_text_batch = batch_function('decode_text_string_batch')
+        except AttributeError:
+            return
+        self.decode_abc_text_string = self._decode_abc_text_string
+        self.decode_abc_text_strings = self._decode_abc_text_strings
+
+
+    def canonify_music_code(self, line):
+        """Canonicize a line of music code. Returns a ``(status, text)`` tuple like
+        ``ABCParser.canonify_music_code_python``, or with a ``status`` of 2 if the parser
+        panicked."""
+        ptr = self._canonify(line.encode('utf-8'))
+        status = ptr[0].status
+        text = None
+        try:
+            text = ptr[0].text.decode('utf-8')
+        except:
+            status = 2
+            text = "Parser returned illegal UTF_8"
+        finally:
+            self._free_result(ptr)
+        return status, text
+
+
+    def _canonify_music_code_batch(self, lines):
+        """Canonicize several lines of music code with one call into the library. Returns a list
+        of ``(status, text)`` tuples, as from ``canonify_music_code``."""
+        return self._call_batch(self._canonify_batch, '\n'.join(lines).encode('utf-8'))
+
+
+    def _decode_abc_text_string(self, text):
+        """``decode_abc_text_string``, with the decoding done by the library."""
+        return decode_abc_text_string(text, self.decode_text_strings)
+
+
+    def _decode_abc_text_strings(self, texts):
+        """``decode_abc_text_strings``, with the decoding done by the library."""
+        return decode_abc_text_strings(texts, self.decode_text_strings)
+
+
+    def decode_text_strings(self, texts):
+        """Decode a list of text strings as ``_decode_abc_text_string`` does, with one call into
+        the library, which leaves the NFC normalization to be done here. Returns a list of the
+        decoded strings."""
+        try:
+            bufs = [text.encode('utf-8') for text in texts]
+        except UnicodeEncodeError:  # e.g. a lone surrogate, which Rust strings can't hold
+            return [_decode_abc_text_string(text) for text in texts]
+        if len(bufs) == 1 or any(b'\n' in buf for buf in bufs):
+            records = [self._call_batch(self._decode_text, buf)[0] for buf in bufs]
+        else:
+            records = self._call_batch(self._decode_text_batch, b'\n'.join(bufs))
+        results = []
+        for text, (status, decoded) in zip(texts, records):
+            if status == 0:  # decoded
+                results.append(unicodedata.normalize('NFC', decoded))
+            elif status == 1:  # nothing to decode
+                results.append(unicodedata.normalize('NFC', text))
+            else:  # the library panicked, so let Python have a go
+                results.append(_decode_abc_text_string(text))
+        return results
+
+
+    def _call_batch(self, function, buf):
+        """Call one of the library's batch functions on ``buf``, and return the list of
+        ``(status, text)`` records from its result."""
+        import ctypes
+        ptr = function(buf, len(buf))
+        try:
+            data = ctypes.string_at(ptr[0].data, ptr[0].len)
+        finally:
+            self._free_batch_result(ptr)
+        return batch_records(data)
+
+
+# Loaded Rust backends, or the error message if loading failed, keyed by library path.
+_rust_backends = {}
+_rust_backends_lock = threading.Lock()
+
+
+def get_rust_backend(path=None):
+    """Return the ``RustBackend`` for the library at ``path`` (by default ``RUST_LIBRARY_PATH``),
+    loading it on first use. Raises ``OSError`` if it can't be loaded; failures are remembered
+    too, so a missing library is only looked for once."""
+    path = os.path.abspath(path or RUST_LIBRARY_PATH)
+    with _rust_backends_lock:
+        backend = _rust_backends.get(path)
+        if backend is None:
+            try:
+                backend = RustBackend(path)
+            except OSError as err:
+                backend = str(err)
+            _rust_backends[path] = backend
+    if isinstance(backend, str):
+        raise OSError(backend)
+    return backend
+
+
+
+LogEvent = collections.namedtuple('LogEvent', ('line_number', 'severity', 'message', 'text'))
+LogEvent.__doc__ = """A single ``ABCParser.log`` call made by the parser, as collected by
+``ABCParser.iter_tunes``."""
+
 
 class ABCParser(metaclass=abc.ABCMeta):
     """A base class for the ABC parser. Subclass this, overriding the ``process_tune`` and ``log``
-    abstract methods. Then, instantiate the parser and invoke ``parse`` with a file-like argument:
+    methods. Then, instantiate the parser and invoke ``parse`` with a file-like argument:
 
     >>> p = MyABCParser()
     >>> p.parse(open('file.abc', 'rb'))
 
     For each individual tune parsed, ``parse`` will create a ``Tune`` instance and invoke the
     subclass' ``process_tune`` on it. Information about the parsing process is logged using
-    ``log``.
+    ``log``. For large files, ``parse_parallel`` spreads the work over several processes.
+
+    Alternatively, ``iter_tunes`` may be used to pull tunes from the parser one at a time, in
+    which case no subclassing is needed:
+
+    >>> for tune, events in ABCParser().iter_tunes(open('file.abc', 'rb')):
+    ...     print(tune.X, len(events))
     """
 
-    def __init__(self):
+    # If true, the raw input of each tune is digested and passed to ``find_known_tune``, so that
+    # tunes seen before need not be parsed again.
+    use_raw_digests = False
+
+    # The budget for canonicizing one line of music code: lines longer than
+    # ``music_code_max_length`` characters aren't parsed at all, and the Python parser gives up on
+    # a line after ``music_code_max_steps`` backtracking steps or ``music_code_time_limit``
+    # seconds (the Rust parser can't be interrupted, but is much less prone to take forever). Such
+    # lines are logged as errors and kept as they are, like lines which fail to parse. ``None``
+    # means no limit.
+    music_code_max_length = None
+    music_code_max_steps = None
+    music_code_time_limit = None
+
+    def __init__(self, backend='auto', library_path=None, music_code_threads=0):
+        """``backend`` selects the music code parser, one of ``MUSIC_CODE_BACKENDS``; 'rust'
+        raises ``OSError`` if the Rust parser library (``library_path``, by default
+        ``RUST_LIBRARY_PATH``) can't be loaded, while 'auto' quietly falls back to Python.
+
+        With ``music_code_threads`` greater than 1, and a backend which can canonicize batches of
+        music code (i.e. Rust, which runs without the GIL), each tune's music code is handed to a
+        pool of that many threads, while parsing continues with the following tunes. Tunes are
+        still completed, and ``log``, ``start_tune``, and ``process_known_tune`` called, in input
+        order. However, ``find_known_tune`` may then be asked about a tune before an identical
+        earlier one has been processed."""
+        if backend not in MUSIC_CODE_BACKENDS:
+            raise ValueError("Unknown music code parser backend: {!r}".format(backend))
+        self.backend = backend
+        self.library_path = library_path
+        self.music_code_threads = music_code_threads
+        self.music_code_executor = None   # created on first use, see ``_flush_music_code``
+        self.stats = None   # set to a ``ParseStats`` to collect timings
+        self.log_events = None   # a list collecting ``LogEvent``s, see ``iter_tunes``
         self.reset()
 
         # default to Python PEG parser
-        self.handle_music_code = self.handle_music_code_python
+        self.canonify_music_code = self.canonify_music_code_python
+        self.canonify_music_code_batch = None
+        self.decode_abc_text_string = decode_abc_text_string
         self.parser = "Python"
 
-        # try to load the Rust PEG parser
-        if os.path.isfile('target/release/libabcparser_peg.so'):
-            import ctypes
-            from ctypes import (POINTER, c_char_p, c_int32)
-
-            peglib = None
+        if backend != 'python':
             try:
-                peglib = ctypes.cdll.LoadLibrary("target/release/libabcparser_peg.so")
-            except:
-                pass
-            if peglib:
-                class CallResult(ctypes.Structure):
-                    _fields_ = [("status", c_int32), ("text", c_char_p)]
-
-                self.canonify_music_code = peglib.canonify_music_code
-                self.canonify_music_code.argtypes = (c_char_p, )
-                self.canonify_music_code.restype = POINTER(CallResult)
-
-                self.free_result = peglib.free_result
-                self.free_result.argtypes = (POINTER(CallResult), )
-                self.free_result.restype = None
-
-                # success, use the Rust parser
-                self.handle_music_code = self.handle_music_code_rust
-                self.parser = "Rust"
+                rust = get_rust_backend(library_path)
+            except OSError:
+                if backend == 'rust':
+                    raise
+            else:
+                self.canonify_music_code = rust.canonify_music_code
+                self.canonify_music_code_batch = rust.canonify_music_code_batch
+                self.decode_abc_text_string = (rust.decode_abc_text_string or
+                                               decode_abc_text_string)
+                self.parser = rust.name
 
 
     def reset(self):
@@ -356,11 +1023,24 @@ class ABCParser(metaclass=abc.ABCMeta):
 
         self.line_number = 0
         self.music_code_parse_time = 0
+        self.music_code_latency = LatencyHistogram()   # time taken by each line parsed
+
+        self.tune = Tune()            # the tune currently being accumulated
+        self.last_field_type = None   # for '+:' field continuations
+        self.feed_buffer = b''        # incomplete line held between calls to ``feed``
+        self.raw_lines = None         # lines held back while ``use_raw_digests``, see
+        self.raw_encoding = None      #     ``_parse_line``
+        self.deferred_music_code = None   # see ``_defer_music_code``
+        self.deferred_events = None
+        self.holding_log = False      # see ``_log``
+        self.pending_music_code = collections.deque()   # see ``_finished_tunes``
+        self.clean_input = False      # if the input contains nothing matching RE_RAW_CONTROLS,
+        self.feed_clean = True        #     see ``_decode_line``
 
 
-    @abc.abstractmethod
     def log(self, severity, message, text):
-        """Abstract method for logging the status and results of a parse run.
+        """Virtual method for logging the status and results of a parse run. The default
+        implementation discards the event.
 
         Parameters
         ----------
@@ -372,7 +1052,23 @@ class ABCParser(metaclass=abc.ABCMeta):
             An explanation of the log event.
         text : str or bytes
             Usually, the input which caused the log event.
+
+        Subclasses should call this, so that ``stats`` counts the event.
         """
+        if self.stats is not None:
+            self.stats.log_counts[severity] += 1
+
+
+    def _log(self, severity, message, text):
+        """Log an event found by the parser: while ``holding_log`` (see ``_defer_music_code``),
+        the call is held back in ``deferred_events``, to be replayed in order later; otherwise it
+        goes straight to ``log``, and is collected in ``log_events`` if that is a list."""
+        if self.holding_log:
+            self.deferred_events.append((self.line_number, ('_log', (severity, message, text))))
+        else:
+            if self.log_events is not None:
+                self.log_events.append(LogEvent(self.line_number, severity, message, text))
+            self.log(severity, message, text)
 
 
     def start_tune(self):
@@ -380,11 +1076,30 @@ class ABCParser(metaclass=abc.ABCMeta):
         pass
 
 
-    @abc.abstractmethod
     def process_tune(self, tune):
-        """Abstract method called when a complete ``Tune`` has been accumulated by the parser. This
-        method should e.g. save the tune to a database.
+        """Virtual method called by ``parse`` when a complete ``Tune`` has been accumulated by the
+        parser. This method should e.g. save the tune to a database.
         """
+        pass
+
+
+    def find_known_tune(self, digest):
+        """Virtual method called, when ``use_raw_digests`` is set, once each tune ending in a blank
+        line has been read, but before any of it after the 'X:' line has been parsed. ``digest``
+        is the SHA1 hex digest of the character encoding in effect after the 'X:' line, a newline,
+        and the raw bytes of the rest of the tune, including the blank line. If this returns
+        anything other than ``None``, the tune is not parsed, and ``process_known_tune`` is called
+        instead of ``process_tune``. The default implementation always returns ``None``.
+        """
+        return None
+
+
+    def process_known_tune(self, tune, known):
+        """Virtual method called instead of ``process_tune`` for a tune which ``find_known_tune``
+        recognized, with ``known`` being whatever it returned. Only the ``X``, ``line_number``, and
+        ``raw_digest`` attributes of ``tune`` are meaningful.
+        """
+        pass
 
 
     def handle_encoding(self, line):
@@ -402,7 +1117,7 @@ class ABCParser(metaclass=abc.ABCMeta):
                     new_encoding = None
                 if new_encoding:
                     self.encoding = new_encoding
-                    self.log('info', "Character encoding set to '%s'" % self.encoding, line)
+                    self._log('info', "Character encoding set to '%s'" % self.encoding, line)
                     return
         elif line[2:10] == b'encoding':  # non-standard, abcm2ps uses it to select
                                          # ISO-8859 encodings
@@ -410,9 +1125,9 @@ class ABCParser(metaclass=abc.ABCMeta):
             if match:
                 if int(match.group(1)) <= 16:
                     self.encoding = 'iso-8859-' + match.group(1).decode('ascii')
-                    self.log('info', "Character encoding set to '%s'" % self.encoding, line)
+                    self._log('info', "Character encoding set to '%s'" % self.encoding, line)
                     return
-        self.log('warn', 'Unrecognized character encoding', line)
+        self._log('warn', 'Unrecognized character encoding', line)
 
 
     def decode_from_raw(self, raw):
@@ -437,6 +1152,18 @@ class ABCParser(metaclass=abc.ABCMeta):
         return RE_DECODE_FROM_RAW_CONTROLS.sub(replacement, unicode)
 
 
+    def _decode_line(self, raw):
+        """Decode (part of) a line of input, with tabs already expanded, like ``decode_from_raw``.
+        When the input is known to contain no raw control characters, any part which is valid
+        UTF-8 can't contain any after decoding either, so the search for them is skipped."""
+        if self.clean_input and self.encoding in ('default', 'utf-8'):
+            try:
+                return raw.decode('utf-8', errors='strict')
+            except UnicodeDecodeError:
+                pass
+        return self.decode_from_raw(raw)
+
+
     def handle_field_K_key_signature(self, tune, line, comment):
         if self.state == 'tuneheader':
             tune.canonical_append('K', line)
@@ -446,7 +1173,7 @@ class ABCParser(metaclass=abc.ABCMeta):
 
 
     def handle_field_T_title(self, tune, field_data, comment):
-        title = decode_abc_text_string(field_data)
+        title = self.decode_abc_text_string(field_data)
         tune.T.append(title)
         tune.full_tune_append('T:' + title + comment)
 
@@ -454,17 +1181,17 @@ class ABCParser(metaclass=abc.ABCMeta):
     def handle_field_X_tune_number(self, tune, field_data, line, comment):
         tune.full_tune_append(line + comment)
         if self.state in ('tuneheader', 'tunebody'):
-            self.log('warn', "Subsequent 'X:' field inside tune", line)
+            self._log('warn', "Subsequent 'X:' field inside tune", line)
         else:
             # set tune.X to the integer at the start of field_data, or zero on failure
             tune.X = int((re.findall(r'^(\d+)', field_data) or ['0'])[0])
             tune.line_number = self.line_number
-            self.log('info', "New tune {:d}".format(tune.X), line)
+            self._log('info', "New tune {:d}".format(tune.X), line)
 
 
     def handle_field_other(self, tune, field_type, line, comment):
         if field_type in 'ABCDEFGHNORrSTWwZ':  # 'abc text string' fields
-            line = decode_abc_text_string(line)
+            line = self.decode_abc_text_string(line)
         # if the "field_type in 'KLM...'" check fails, this is a field we don't want in the
         # canonical version
         if self.state == 'tuneheader' and field_type in 'KLMmPUV':
@@ -474,169 +1201,619 @@ class ABCParser(metaclass=abc.ABCMeta):
         tune.full_tune_append(line + comment)
 
 
-    def handle_music_code_python(self, tune, line, comment):
+    def handle_music_code(self, tune, line, comment):
         tune.full_tune_append(line + comment)
-        try:
-            line = canonify_music_code(line, text_string_decoder=decode_abc_text_string)
-        except NoMatch as err:
-            self.log('error', 'Music code failed to parse', str(err))
-        tune.canonical_append('body', line)
+        if self.music_code_max_length and len(line) > self.music_code_max_length:
+            message = 'Line is {:d} characters long, the limit is {:d}'.format(
+                          len(line), self.music_code_max_length)
+            tune.canonical_append('body', self._music_code_result(line, 3, message))
+            return
+        key = (self.parser, line)
+        result = music_code_cache.get(key)
+        if result is None:
+            if self.canonify_music_code_batch is not None:
+                self._defer_music_code(tune, line)
+                return
+            start = time.perf_counter()
+            result = self.canonify_music_code(line)
+            self.music_code_latency.add(time.perf_counter() - start)
+            if result[0] < 2:  # don't remember panics, or lines over budget
+                music_code_cache.put(key, result)
+            else:
+                tune.raw_digest = None  # nor the tune, so that it is parsed again next time
+        tune.canonical_append('body', self._music_code_result(line, *result))
 
 
-    def handle_music_code_rust(self, tune, line, comment):
-        tune.full_tune_append(line + comment)
-        ptr = self.canonify_music_code(line.encode('utf-8'))
-        status = ptr[0].status
-        text = None
-        try:
-            text = ptr[0].text.decode('utf-8')
-        except:
-            status = 2
-            text = "Parser returned illegal UTF_8"
-        finally:
-            self.free_result(ptr)
-        if status == 2:  # panic
-            self.log('error', 'The Rust parser terminated abnormally', text)
+    def _music_code_result(self, line, status, text):
+        """Log any error from canonicizing music code ``line``, and return the line to put in
+        the canonical tune."""
+        if status == 3:  # over budget
+            self._log('error', 'Music code too costly to parse', text)
+        elif status == 2:  # panic
+            self._log('error', 'The Rust parser terminated abnormally', text)
         elif status == 1:  # failed to parse
-            self.log('error', 'Music code failed to parse', text)
+            self._log('error', 'Music code failed to parse', text)
         else:  # status == 0, normal
             line = text
-        tune.canonical_append('body', line)
+        return line
+
+
+    def _defer_music_code(self, tune, line):
+        """Hold back a line of music code, leaving a placeholder for it in ``tune``, so that all
+        of the tune's music code can be canonicized with one call to ``canonify_music_code_batch``
+        by ``_flush_music_code``. From the first deferred line on, ``log`` calls are also held
+        back, so that they can be replayed in order with any errors from the deferred lines."""
+        if self.deferred_music_code is None:
+            self.deferred_music_code = []
+            self.deferred_events = []
+            self.holding_log = True
+        self.deferred_events.append((self.line_number, len(self.deferred_music_code)))
+        self.deferred_music_code.append((tune.canonical_append_pending(), line))
+
+
+    def _call_in_order(self, method, *args):
+        """Call ``method``, or, while tunes are waiting for their music code in a thread pool,
+        hold the call back to be replayed after theirs."""
+        if self.pending_music_code:
+            self.deferred_events.append((self.line_number, (method, args)))
+        else:
+            getattr(self, method)(*args)
+
+
+    def _flush_music_code(self, tune):
+        """Canonicize the music code deferred by ``_defer_music_code``, filling in the
+        placeholders in ``tune``, and replay the held back ``log`` calls, with ``line_number``
+        set as it was when they were made.
+
+        With ``music_code_threads``, the music code is instead handed to the thread pool, and the
+        tune queued in ``pending_music_code`` to be finished by ``_finished_tunes``; ``log`` calls
+        stay held back until the queue has been emptied."""
+        if self.deferred_music_code is None:
+            return
+        deferred, events = self.deferred_music_code, self.deferred_events
+        lines = list(collections.OrderedDict.fromkeys(line for index, line in deferred))
+
+        if self.music_code_threads > 1:
+            if self.music_code_executor is None:
+                self.music_code_executor = concurrent.futures.ThreadPoolExecutor(
+                    self.music_code_threads)
+            future = None
+            if lines:
+                future = self.music_code_executor.submit(self._canonify_music_code_lines, lines)
+            self.pending_music_code.append((tune, deferred, events, future, self.line_number))
+            self.deferred_music_code, self.deferred_events = [], []
+            return
+
+        self.deferred_music_code = self.deferred_events = None
+        self.holding_log = False
+        start = time.perf_counter()
+        results, parse_time = self._canonify_music_code_lines(lines)
+        self.music_code_parse_time += parse_time
+        if lines:  # a batch's lines are all taken to have taken as long as each other
+            self.music_code_latency.add((time.perf_counter() - start) / len(lines), len(lines))
+        self._replay_music_code(tune, deferred, events, results)
+
+
+    def _canonify_music_code_lines(self, lines):
+        """Canonicize distinct ``lines`` of music code with ``canonify_music_code_batch``,
+        returning a dict of their results, and the time taken. With ``music_code_threads`` this
+        runs in the thread pool, where the process time would include the other threads', so
+        elapsed time is measured instead."""
+        clock = time.perf_counter if self.music_code_threads > 1 else time.process_time
+        tmp = clock()
+        results = dict(zip(lines, self.canonify_music_code_batch(lines))) if lines else {}
+        return results, clock() - tmp
+
+
+    def _replay_music_code(self, tune, deferred, events, results):
+        """Fill in the placeholders in ``tune`` from ``results``, and replay the held back calls in
+        ``events``, for ``_flush_music_code``."""
+        line_number = self.line_number
+        for event_line_number, event in events:
+            self.line_number = event_line_number
+            if isinstance(event, int):  # a deferred line
+                index, line = deferred[event]
+                result = results[line]
+                if result[0] < 2:  # don't remember panics, or lines over budget
+                    music_code_cache.put((self.parser, line), result)
+                else:
+                    tune.raw_digest = None  # nor the tune, so that it is parsed again next time
+                tune.canonical_resolve(index, self._music_code_result(line, *result))
+            else:
+                method, args = event
+                getattr(self, method)(*args)
+        self.line_number = line_number
+
+
+    def _finished_tunes(self, tune, wait=False):
+        """Generator yielding ``tune``, just completed by the parser, and any tunes before it still
+        waiting for their music code in ``pending_music_code``, once they're finished. Unless
+        ``wait`` is true, tunes are only waited for while more than four per thread are queued."""
+        pending = self.pending_music_code
+        if not pending:
+            if tune:
+                yield tune
+            return
+        limit = 0 if wait else self.music_code_threads * 4
+        while pending and (len(pending) > limit or pending[0][3] is None or
+                           pending[0][3].done()):
+            tune, deferred, events, future, line_number = pending.popleft()
+            results = {}
+            if future is not None:
+                results, parse_time = future.result()
+                self.music_code_parse_time += parse_time
+                self.music_code_latency.add(parse_time / len(results), len(results))
+            # the tune's own calls, and any made while it's processed, go straight through
+            held_log, self.holding_log = self.holding_log, False
+            held_line_number = self.line_number
+            try:
+                self._replay_music_code(tune, deferred, events, results)
+                self.line_number = line_number
+                yield tune
+            finally:
+                self.holding_log, self.line_number = held_log, held_line_number
+        if not pending and not self.deferred_music_code:
+            # nothing left waiting, so stop holding back calls
+            events = self.deferred_events
+            self.deferred_music_code = self.deferred_events = None
+            self.holding_log = False
+            self._replay_music_code(None, None, events, None)
+
+
+    def _shutdown_music_code_threads(self):
+        """Shut down the thread pool, if any, at the end of the input."""
+        if self.music_code_executor is not None:
+            self.music_code_executor.shutdown()
+            self.music_code_executor = None
+
+
+    def canonify_music_code_python(self, line):
+        """Canonicize a line of music code using the Python PEG parser. Returns a ``(status,
+        text)`` tuple, where ``status`` is 0 and ``text`` is the canonicized line on success, or
+        ``status`` is 1 and ``text`` is the error message if the line failed to parse, or 3 if
+        parsing it went over the budget set by ``music_code_max_steps`` and
+        ``music_code_time_limit``."""
+        try:
+            return 0, canonify_music_code(line, text_string_decoder=decode_abc_text_string,
+                                          max_steps=self.music_code_max_steps,
+                                          time_limit=self.music_code_time_limit)
+        except NoMatch as err:
+            return 1, str(err)
+        except ParseBudgetExceeded as err:
+            return 3, str(err)
 
 
     def parse(self, filehandle):
-        last_field_type = None  # for '+:' field continuations
-        tune = Tune()
-        while True:
-            line = filehandle.readline(4096)  # limit the amount read -- 4k should be enough
-            if line == b'':  # end-of-file
-                if self.state in ('tuneheader', 'tunebody'):
-                    self.log('warn', 'Unexpected end of file inside tune', '')
-                    tune.full_tune_append('')
-                    tune.canonical_append('body', '')
-                    tune.sort_canonical()
-                    self.process_tune(tune)
-                break
+        """Parse the ABC in ``filehandle`` (a binary file-like object), calling ``process_tune``
+        for each tune found."""
+        for tune in self._parse_tunes(filehandle):
+            self._process_tune(tune)
+
+
+    def _process_tune(self, tune):
+        """Call ``process_tune``, timing it if collecting ``stats``."""
+        stats = self.stats
+        if stats is None:
+            self.process_tune(tune)
+            return
+        previous = stats.enter('process_tune')
+        self.process_tune(tune)
+        stats.enter(previous)
+        stats.finish_tune(tune)
+
+
+    def iter_tunes(self, filehandle):
+        """Parse the ABC in ``filehandle``, yielding a ``(tune, events)`` tuple for each tune
+        found, where ``events`` is a list of the ``LogEvent``s logged since the previous tune was
+        yielded. ``process_tune`` is not called, but ``log`` still is. Since parsing is done lazily,
+        the caller may stop early, or batch tunes as it sees fit, without the whole file being
+        parsed up front."""
+        held_events = self.log_events
+        events = self.log_events = []
+        try:
+            for tune in self._parse_tunes(filehandle):
+                stats = self.stats
+                if stats is None:
+                    yield tune, events
+                else:
+                    previous = stats.enter('process_tune')
+                    yield tune, events
+                    stats.enter(previous)
+                    stats.finish_tune(tune)
+                events = self.log_events = []
+        finally:
+            self.log_events = held_events
+
+
+    def _parse_tunes(self, filehandle):
+        """Generator doing the actual parsing for ``parse`` and ``iter_tunes``, yielding each
+        ``Tune`` as it is completed. On-disk files are memory-mapped, and lines are sliced
+        directly out of the mapping, rather than being read through ``readline``'s buffering;
+        either way, ``filehandle`` is left positioned after the last line parsed."""
+        mapped = _map_file(filehandle)
+        if mapped is not None:
+            with mapped:
+                end = filehandle.tell()
+                self.clean_input = RE_RAW_CONTROLS.search(mapped, end) is None
+                try:
+                    for start, end in _line_spans(mapped, start=end):
+                        tune = self._parse_line(mapped[start:end])
+                        if tune:
+                            yield from self._finished_tunes(tune)
+                finally:
+                    filehandle.seek(end)
+        else:
+            try:  # in-memory files can be checked up front too
+                with filehandle.getbuffer() as view:
+                    self.clean_input = RE_RAW_CONTROLS.search(view, filehandle.tell()) is None
+            except AttributeError:
+                self.clean_input = False
+            while True:
+                line = filehandle.readline(MAX_LINE_LENGTH)
+                if line == b'':  # end-of-file
+                    break
+                tune = self._parse_line(line)
+                if tune:
+                    yield from self._finished_tunes(tune)
+        tune = self._parse_end_of_input()
+        yield from self._finished_tunes(tune, wait=True)
+        self._shutdown_music_code_threads()
+        if self.stats is not None:
+            self.stats.finish()
+
+
+    def feed(self, data):
+        """Incrementally parse ``data``, the next chunk of (bytes) input, calling ``process_tune``
+        for each tune completed. Chunks may be split anywhere, including within a line or a
+        multi-byte character; any incomplete line is held until the next call to ``feed``, or
+        ``close``, which must be called after the last chunk."""
+        buf = self.feed_buffer + data if self.feed_buffer else bytes(data)
+        # the held-back incomplete line is checked again with the next chunk, so a final '\r'
+        # needn't count against the input until it's known whether a '\n' follows
+        if self.feed_clean and RE_RAW_CONTROLS.search(buf, 0, len(buf) - buf.endswith(b'\r')):
+            self.feed_clean = False
+        self.clean_input = self.feed_clean
+        self.feed_buffer = self._feed_lines(buf, final=False)
+
+
+    def close(self):
+        """Finish parsing input given with ``feed``, as though end-of-file had been reached."""
+        buf, self.feed_buffer = self.feed_buffer, b''
+        self._feed_lines(buf, final=True)
+        tune = self._parse_end_of_input()
+        for tune in self._finished_tunes(tune, wait=True):
+            self._process_tune(tune)
+        self._shutdown_music_code_threads()
+        if self.stats is not None:
+            self.stats.finish()
+
+
+    def _feed_lines(self, buf, final):
+        """Parse the lines in ``buf``, and return any incomplete last line (unless ``final`` is
+        true)."""
+        end = 0
+        for start, end in _line_spans(buf, final):
+            tune = self._parse_line(buf[start:end])
+            if tune:
+                for tune in self._finished_tunes(tune):
+                    self._process_tune(tune)
+        return buf[end:]
+
+
+    def parse_parallel(self, filehandle, max_workers=None):
+        """Parse the ABC in ``filehandle`` like ``parse``, but split it into slices at tune
+        boundaries and parse the slices in a pool of ``max_workers`` processes (by default, one per
+        CPU). The ``log``, ``start_tune``, and ``process_tune`` calls made in the workers are
+        replayed here in their original order, with ``line_number`` set as it would have been
+        during a serial parse, so the results are the same as from ``parse``.
+
+        The workers use the ``ABCParser`` base class to parse, so subclasses which override the
+        ``handle_*`` methods should use ``parse`` instead. Nor do the workers look tunes up by
+        their raw digest, so with ``use_raw_digests``, ``find_known_tune`` and
+        ``process_known_tune`` aren't called, and ``raw_digest`` isn't set. With ``stats``, only
+        the time spent here is counted, mostly as 'read' while waiting for the workers."""
+        data = filehandle.read()
+        max_workers = max_workers or os.cpu_count() or 1
+        boundaries = self._find_tune_boundaries(data)
+        if max_workers < 2 or not boundaries:
+            self.parse(io.BytesIO(data))
+            return
+
+        # cut into about four slices per worker, so one slow slice doesn't hold up the rest
+        step = math.ceil(len(boundaries) / (max_workers * 4))
+        cuts = boundaries[step - 1::step]
+        slices = [(0, self.state, self.encoding, self.line_number)]
+        slices.extend((offset, 'freetext', encoding, line_number)
+                      for offset, line_number, encoding in cuts)
+        ends = [offset for offset, _, _, _ in slices[1:]] + [len(data)]
+        budget = (self.music_code_max_length, self.music_code_max_steps,
+                  self.music_code_time_limit)
+        jobs = [(data[start:end], state, encoding, line_number, self.backend, self.library_path,
+                 budget)
+                for (start, state, encoding, line_number), end in zip(slices, ends)]
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+            for calls, state, encoding, parse_time, latency in executor.map(_parse_slice, jobs):
+                for line_number, method, args in calls:
+                    self.line_number = line_number
+                    getattr(self, method)(*args)
+                self.state, self.encoding = state, encoding
+                self.music_code_parse_time += parse_time
+                self.music_code_latency.merge(latency)
+        if self.stats is not None:
+            self.stats.finish()
+
+
+    def _find_tune_boundaries(self, data):
+        """Scan ``data`` for tunes which begin after a blank line, where the parser is in the
+        'freetext' state with no tune pending. Returns a list of ``(offset, line_number,
+        encoding)`` tuples, giving the offset of each such tune's 'X:' line, the line number just
+        before it, and the character encoding in effect there. Only as much of ``_parse_line`` is
+        duplicated as is needed to track the state and encoding."""
+        scanner = ABCParser()  # the base class' ``log`` discards the encoding messages
+        scanner.state = self.state
+        scanner.encoding = self.encoding
+        scanner.clean_input = RE_RAW_CONTROLS.search(data) is None
+        line_number = self.line_number
+        boundaries = []
+        for start, end in _line_spans(data):
+            line = data[start:end]
+            if scanner.state == 'firstline':
+                if line.startswith(codecs.BOM_UTF8):
+                    line = line[3:]
+                scanner.state = 'fileheader'
+            kind, line, _ = lex_line(line)
+            if kind == 'directive':
+                if line.startswith(b'%%abc-charset') or line.startswith(b'%%encoding'):
+                    scanner.handle_encoding(line)
+            elif kind == 'blank':
+                scanner.state = 'freetext'
+            elif kind == 'text' and scanner.state not in ('tuneheader', 'tunebody'):
+                field_type, field_data = split_field(scanner._decode_line(line))
+                if field_type == 'X':
+                    if scanner.state == 'freetext':
+                        boundaries.append((start, line_number, scanner.encoding))
+                    scanner.state = 'tuneheader'
+                elif field_type == 'I' and field_data.startswith('abc-charset'):
+                    scanner.handle_encoding(('I:' + field_data).encode('utf-8'))
+            line_number += 1
+        return boundaries
+
+
+    def _parse_end_of_input(self):
+        """Handle end-of-file, returning the final ``Tune`` if the input ended inside one."""
+        if self.raw_lines is not None:  # a tune ending at end-of-file is always parsed
+            lines, self.raw_lines = self.raw_lines, None
+            for line in lines:
+                self._parse_one_line(line)
+        tune = None
+        if self.state in ('tuneheader', 'tunebody'):
+            self._log('warn', 'Unexpected end of file inside tune', '')
+            self._flush_music_code(self.tune)
+            tune = self.tune
+            tune.full_tune_append('')
+            tune.canonical_append('body', '')
+        self.tune = Tune()
+        self.last_field_type = None
+        return tune
+
+
+    def _parse_line(self, line):
+        """Parse one line of (bytes) input, including its end-of-line character(s), if any.
+        Returns the ``Tune`` which this line completed, or ``None``.
+
+        When ``use_raw_digests`` is set, the lines following a tune's 'X:' line are held back in
+        ``raw_lines`` until the blank line ending the tune, then passed to ``_parse_raw_tune``."""
+        stats = self.stats
+        if stats is not None:
+            stats.enter('lex')
+            tune = self._parse_line_untimed(line)
+            stats.enter('read')
+            return tune
+        return self._parse_line_untimed(line)
+
+
+    def _parse_line_untimed(self, line):
+        """``_parse_line``, less the ``stats`` timing."""
+        if self.raw_lines is not None:
+            self.raw_lines.append(line)
+            if line.rstrip():
+                return None
+            return self._parse_raw_tune()
+        in_tune = self.state in ('tuneheader', 'tunebody')
+        tune = self._parse_one_line(line)
+        if self.use_raw_digests and not in_tune and self.state == 'tuneheader':
+            self.raw_lines = []
+            self.raw_encoding = self.encoding
+        return tune
+
+
+    def _parse_raw_tune(self):
+        """Digest the held-back lines of a tune, and either hand it to ``process_known_tune``, if
+        ``find_known_tune`` recognizes the digest, or parse the lines. Returns the ``Tune`` if it
+        was parsed, or ``None``."""
+        lines, self.raw_lines = self.raw_lines, None
+        digest = hashlib.sha1(self.raw_encoding.encode('utf-8') + b'\n')
+        for line in lines:
+            digest.update(line)
+        tune = self.tune
+        tune.raw_digest = digest.hexdigest()
+        known = self.find_known_tune(tune.raw_digest)
+        if known is None:
+            finished = None
+            for line in lines:
+                finished = self._parse_one_line(line) or finished
+            return finished
+        # only the encoding directives need attention, since they outlast the tune
+        for line in lines:
             self.line_number += 1
+            kind, line, _ = lex_line(line)
+            if kind == 'directive' and (line.startswith(b'%%abc-charset') or
+                                        line.startswith(b'%%encoding')):
+                self.handle_encoding(line)
+        self.state = 'freetext'
+        self.last_field_type = None
+        self.tune = Tune()
+        if self.stats is not None:
+            self.stats.tune_starts.pop(id(tune), None)
+            self.stats.enter('process_tune')
+        self._call_in_order('process_known_tune', tune, known)
+        return None
+
+
+    def _parse_one_line(self, line):
+        """Parse one line of input, as for ``_parse_line``, regardless of ``use_raw_digests``."""
+        tune = self.tune
+        stats = self.stats
+        self.line_number += 1
+
+        if self.state == 'firstline':
+            if line.startswith(codecs.BOM_UTF8):  # trim UTF-8 BOM
+                line = line[3:]
+            self.state = 'fileheader'
+
+        kind, line, comment = lex_line(line)
+
+        if kind == 'directive':  # stylesheet directive
+            if line.startswith(b'%%abc-charset') or line.startswith(b'%%encoding'):
+                self.handle_encoding(line)
+            else:
+                self._log('ignore', 'Stylesheet directive ignored', line)
+            return None
 
-            if self.state == 'firstline':
-                if line.startswith(codecs.BOM_UTF8):  # trim UTF-8 BOM
-                    line = line[3:]
-                self.state = 'fileheader'
+        if kind == 'comment':  # comment line
+            if self.state in ('tuneheader', 'tunebody'):
+                line = line.expandtabs()
+                line = self.decode_abc_text_string(self._decode_line(line))
+                tune.full_tune_append(line)
+            else:
+                self._log('ignore', 'Comment', line)
+            # state and last_field_type are unchanged, since this line doesn't count as a
+            # blank line
+            return None
+
+        if kind == 'blank':  # blank line
+            finished = None
+            if self.state in ('tuneheader', 'tunebody'):
+                if stats is not None:
+                    stats.enter('music code')
+                self._flush_music_code(tune)
+                tune.full_tune_append('')
+                tune.canonical_append('body', '')
+                finished = tune
+                self.tune = Tune()
+            else:
+                self._log('ignore', 'Blank line', '')
+            self.state = 'freetext'
+            self.last_field_type = None
+            return finished
 
-            line = line.rstrip()  # trim tailing space and newline
+        # ==== above here, ``line`` is bytes, with tabs expanded and any comment split off ====
 
-            if re.match(b'^%%', line):  # stylesheet directive
-                if line.startswith(b'%%abc-charset') or line.startswith(b'%%encoding'):
-                    self.handle_encoding(line)
-                else:
-                    self.log('ignore', 'Stylesheet directive ignored', line)
-                continue
-
-            if re.match(rb'^\s*%', line):  # comment line
-                if self.state in ('tuneheader', 'tunebody'):
-                    line = line.expandtabs()
-                    line = decode_abc_text_string(self.decode_from_raw(line))
-                    tune.full_tune_append(line)
-                else:
-                    self.log('ignore', 'Comment', line)
-                # state and last_field_type are unchanged, since this line doesn't count as a
-                # blank line
-                continue
-
-            if line == b'':  # blank line
-                if self.state in ('tuneheader', 'tunebody'):
-                    tune.full_tune_append('')
-                    tune.canonical_append('body', '')
-                    tune.sort_canonical()
-                    self.process_tune(tune)
-                    del tune
-                    tune = Tune()
-                else:
-                    self.log('ignore', 'Blank line', '')
-                self.state = 'freetext'
-                last_field_type = None
-                continue
+        if stats is not None:
+            stats.enter('decode')
+        if comment:
+            comment = ' ' + self._decode_line(comment)
+        else:
+            comment = ''
+        line = self._decode_line(line)
+        if stats is not None:
+            stats.enter('fields')
 
-            # ==== above here, ``line`` is bytes ====
+        # ==== below here, everything is str ====
 
-            # expand tabs, if any
-            if b'\t' in line:
-                line = line.expandtabs()
+        # handle information fields
+        field_type, field_data = split_field(line)
+        if field_type:   # information field
+            line = field_type + ':' + field_data  # normalize (delete) whitespace
+
+            if field_type == '+' and self.last_field_type is not None: # continuation field
+                field_type = self.last_field_type
 
-            # remove comment, if any
-            if b'%' in line:
-                line, comment = split_off_comment(line)
-                if comment:
-                    comment = ' ' + self.decode_from_raw(comment)
+            if (field_type != 'X') and (self.state not in ('tuneheader', 'tunebody')):
+                if line.startswith('I:abc-charset'):
+                    self.handle_encoding(line.encode('utf-8'))
                 else:
-                    comment = ''
+                    self._log('warn', "Field outside of tune", line)
+                return None
+
+            if field_type == 'X':  # start of tune
+                if self.state not in ('tuneheader', 'tunebody'):
+                    if stats is not None:
+                        stats.start_tune(tune)
+                    self._call_in_order('start_tune')
+                self.handle_field_X_tune_number(tune, field_data, line, comment)
+                if self.state not in ('tuneheader', 'tunebody'):
+                    self.state = 'tuneheader'
+
+            elif field_type == 'K':  # key signature, change state to tune body
+                self.handle_field_K_key_signature(tune, line, comment)
+                self.state = 'tunebody'
+
+            elif field_type == 'T':  # title field
+                self.handle_field_T_title(tune, field_data, comment)
+
             else:
-                comment = ''
-            line = self.decode_from_raw(line)
+                self.handle_field_other(tune, field_type, line, comment)
 
-            # ==== below here, everything is str ====
+            self.last_field_type = field_type
+            return None
 
-            # handle information fields
-            m = re.match(r'([A-Za-z+]):\s*(.*)', line)
-            if m:   # information field
-                field_type, field_data = m.group(1), m.group(2)
-                line = field_type + ':' + field_data  # normalize (delete) whitespace
+        if self.last_field_type == 'H':  # history continuation without '+:' (deprecated)
+            if self.state in ('tuneheader', 'tunebody'):
+                if line.startswith('   '):
+                    line = ' ' + line.lstrip()
+                else:
+                    line = line.lstrip()
+                tune.full_tune_append('+:' + line + comment)
+            else:  # pragma: no cover
+                assert(False)  # this should be unreachable
+            return None
 
-                if field_type == '+' and last_field_type is not None: # continuation field
-                    field_type = last_field_type
 
-                if (field_type != 'X') and (self.state not in ('tuneheader', 'tunebody')):
-                    if line.startswith('I:abc-charset'):
-                        self.handle_encoding(line.encode('utf-8'))
-                    else:
-                        self.log('warn', "Field outside of tune", line)
-                    continue
+        # plain line, either freetext or musiccode
+        if self.state == 'tuneheader':
+            self._log('warn', "Non-field found before 'K:' field", line)
+            self.state = 'tunebody'
+        if self.state == 'tunebody':
+            if stats is not None:
+                stats.enter('music code')
+            tmp = time.process_time()
+            self.handle_music_code(tune, line, comment)
+            self.music_code_parse_time += time.process_time() - tmp
+        else:
+            self._log('ignore', self.state.title(), line + comment)
 
-                if field_type == 'X':  # start of tune
-                    if self.state not in ('tuneheader', 'tunebody'):
-                        self.start_tune()
-                    self.handle_field_X_tune_number(tune, field_data, line, comment)
-                    if self.state not in ('tuneheader', 'tunebody'):
-                        self.state = 'tuneheader'
+        self.last_field_type = None
+        return None
 
-                elif field_type == 'K':  # key signature, change state to tune body
-                    self.handle_field_K_key_signature(tune, line, comment)
-                    self.state = 'tunebody'
 
-                elif field_type == 'T':  # title field
-                    self.handle_field_T_title(tune, field_data, comment)
+class _SliceParser(ABCParser):
+    """Parses one slice of the input for ``ABCParser.parse_parallel`` in a worker process,
+    recording each ``log``, ``start_tune``, and ``process_tune`` call along with the line number at
+    which it was made."""
+    def __init__(self, backend='auto', library_path=None):
+        super().__init__(backend, library_path)
+        self.calls = []
+
+    def log(self, severity, message, text):
+        self.calls.append((self.line_number, 'log', (severity, message, text)))
+
+    def start_tune(self):
+        self.calls.append((self.line_number, 'start_tune', ()))
+
+    def process_tune(self, tune):
+        self.calls.append((self.line_number, '_process_tune', (tune, )))
 
-                else:
-                    self.handle_field_other(tune, field_type, line, comment)
-
-                last_field_type = field_type
-                continue
-
-            if last_field_type == 'H':  # history continuation without '+:' (deprecated)
-                if self.state in ('tuneheader', 'tunebody'):
-                    if line.startswith('   '):
-                        line = ' ' + line.lstrip()
-                    else:
-                        line = line.lstrip()
-                    tune.full_tune_append('+:' + line + comment)
-                else:  # pragma: no cover
-                    assert(False)  # this should be unreachable
-                continue
-
-
-            # plain line, either freetext or musiccode
-            if self.state == 'tuneheader':
-                self.log('warn', "Non-field found before 'K:' field", line)
-                self.state = 'tunebody'
-            if self.state == 'tunebody':
-                tmp = time.process_time()
-                self.handle_music_code(tune, line, comment)
-                self.music_code_parse_time += time.process_time() - tmp
-            else:
-                self.log('ignore', self.state.title(), line + comment)
 
-            last_field_type = None
+def _parse_slice(job):
+    """Worker function for ``ABCParser.parse_parallel``."""
+    data, state, encoding, line_number, backend, library_path, budget = job
+    p = _SliceParser(backend, library_path)
+    p.state, p.encoding, p.line_number = state, encoding, line_number
+    (p.music_code_max_length, p.music_code_max_steps, p.music_code_time_limit) = budget
+    p.parse(io.BytesIO(data))
+    return p.calls, p.state, p.encoding, p.music_code_parse_time, p.music_code_latency
 
 
 if __name__ == '__main__':  # pragma: no cover
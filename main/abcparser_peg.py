@@ -26,12 +26,15 @@
 
 from __future__ import print_function, unicode_literals
 import codecs
+import re
+import threading
+import time
 
 from arpeggio import Terminal
 from arpeggio.cleanpeg import ParserPEG, PTNodeVisitor, visit_parse_tree
 
 
-parser = ParserPEG(
+GRAMMAR = (
    # This grammar is based on Henrik Norbeck's ABNF grammar for ABC v2.0, with:
    #  1) corrections for its mistakes (e.g. rests could not be generated),
    #  2) rearrangingment of the rules necessary for PEG ordered-choice parsing, and
@@ -273,17 +276,63 @@ parser = ParserPEG(
    DIGITS = r'\\d+'
    WSP = r'[ \\t]+'  # whitespace
 
-   """,  # --- end of grammar ---
+   """  # --- end of grammar ---
 
    # " ' '''  # compensate for jed's borken syntax highlighting
-
-   'music_code_line',  # default rule
-   ws='',   # don't eat whitespace
-   memoization=True,
-   debug=False
 )
 
 
+# Compiling the grammar takes a noticeable fraction of a second, which every process importing
+# this module would pay, even if it never parses anything with Python (e.g. web workers using the
+# Rust parser, or which never handle an upload), so the parser is only built when first needed.
+# Arpeggio parsers keep the state of the parse in progress on themselves, so each thread gets
+# its own.
+_local = threading.local()
+
+
+class ParseBudgetExceeded(Exception):
+    """Raised by ``BudgetedParserPEG`` when a parse takes too many steps, or too long."""
+    pass
+
+
+class BudgetedParserPEG(ParserPEG):
+    """A ``ParserPEG`` which gives up on its input once it has backtracked more than
+    ``max_steps`` times, or spent more than ``time_limit`` seconds, if either is given to
+    ``parse``. Both grow explosively for some badly broken lines, so this keeps a single line
+    from stalling the parse of a whole file. Every failed match passes through ``_nm_raise``,
+    which makes it the place to count steps. That is a private Arpeggio method, so the version
+    of Arpeggio is pinned in requirements.txt, and ``test_parse_budget_hook`` checks that it is
+    still called."""
+
+    def parse(self, _input, *args, max_steps=None, time_limit=None, **kwargs):
+        self.steps = 0
+        self.max_steps = max_steps
+        self.time_limit = time_limit
+        self.deadline = time.perf_counter() + time_limit if time_limit else None
+        return super().parse(_input, *args, **kwargs)
+
+    def _nm_raise(self, *args):
+        self.steps += 1
+        if self.max_steps and self.steps > self.max_steps:
+            raise ParseBudgetExceeded('Gave up after {:d} steps'.format(self.max_steps))
+        # checking the clock is relatively slow, so only do it every so often
+        if self.deadline and not self.steps % 256 and time.perf_counter() > self.deadline:
+            raise ParseBudgetExceeded('Gave up after {:g} seconds'.format(self.time_limit))
+        super()._nm_raise(*args)
+
+
+def get_parser():
+    """Return the calling thread's Arpeggio parser for ``GRAMMAR``, building it on first use."""
+    parser = getattr(_local, 'parser', None)
+    if parser is None:
+        parser = _local.parser = BudgetedParserPEG(GRAMMAR,
+                                                   'music_code_line',  # default rule
+                                                   ws='',   # don't eat whitespace
+                                                   memoization=True,
+                                                   debug=False)
+    return parser
+
+
 class ABCVisitor(PTNodeVisitor):
     def __init__(self, *args, **kwargs):
         self.abc_debug = kwargs.pop('abc_debug', False)
@@ -324,21 +373,7 @@ class ABCVisitor(PTNodeVisitor):
 
     def visit_note_length(self, node, children):
         if self.abc_debug: self.print_debug(node, children)
-        numerator, denominator = children[0]
-        if denominator == 1:
-            if numerator == 1:
-                return ''
-            else:
-                return str(numerator)
-        else:  # denominator != 1
-            if numerator == 1 and denominator == 2:
-                return '/'
-            elif numerator == 1 and denominator == 4:
-                return '//'
-            elif numerator == 1:
-                return "/%d" % denominator
-            else:
-                return "%d/%d" % (numerator, denominator)
+        return format_note_length(*children[0])
 
     def visit_note_length_bigger(self, node, children):
         if self.abc_debug: self.print_debug(node, children)
@@ -374,9 +409,104 @@ class ABCVisitor(PTNodeVisitor):
         return ' '
 
 
-def canonify_music_code(line, text_string_decoder=None):
-    parse_tree = parser.parse(line)
-    return visit_parse_tree(parse_tree, ABCVisitor(text_string_decoder=text_string_decoder))
+def format_note_length(numerator, denominator):
+    """Return the canonical form of a note length."""
+    if denominator == 1:
+        if numerator == 1:
+            return ''
+        else:
+            return str(numerator)
+    else:  # denominator != 1
+        if numerator == 1 and denominator == 2:
+            return '/'
+        elif numerator == 1 and denominator == 4:
+            return '//'
+        elif numerator == 1:
+            return "/%d" % denominator
+        else:
+            return "%d/%d" % (numerator, denominator)
+
+
+# ========== Fast path for simple music code ==========
+
+# Most lines of music code in the wild hold nothing but notes, rests, ties, whitespace and plain
+# barlines, and these are tokenized with this expression instead of being parsed. Each
+# alternative matches just what the corresponding grammar rule would at that point; anything
+# else (chords, decorations, broken rhythms, tuplets, non-ASCII digits, ...) sends the whole line
+# to the parser.
+RE_SIMPLE_MUSIC_CODE_TOKEN = re.compile(r"""
+      (?P<note> (?: \^\^ | \^ | __ | _ | = )? [A-Ga-g] (?: '+ | ,+ )? )    # pitch
+      (?P<note_length> /[0-9]+ | [0-9]+/[0-9]+ | [0-9]+ | /+ )?
+      (?P<tie> - )?
+    | (?P<rest> [xyz] )
+      (?P<rest_length> /[0-9]+ | [0-9]+/[0-9]+ | [0-9]+ | /+ )?
+    | (?P<barline> :* \|+ (?: \] | :+ )? )
+    | (?P<WSP> [ \t]+ )
+    """, re.VERBOSE)
+
+# abc_eol: an optional line continuation, and any whitespace after it
+RE_SIMPLE_MUSIC_CODE_EOL = re.compile(r'\\?[ \t]*\Z')
+
+
+def _canonify_simple_note_length(text):
+    """Canonicize a note length matched by ``RE_SIMPLE_MUSIC_CODE_TOKEN``, as the ``note_length``
+    rule and ``ABCVisitor.visit_note_length`` would."""
+    if text[0] == '/':
+        if len(text) > 1 and text[1] != '/':  # note_length_smaller
+            return format_note_length(1, int(text[1:]))
+        return format_note_length(1, 2**len(text))  # note_length_slashes
+    numerator, slash, denominator = text.partition('/')
+    if slash:  # note_length_full
+        return format_note_length(int(numerator), int(denominator))
+    return format_note_length(int(numerator), 1)  # note_length_bigger
+
+
+def canonify_simple_music_code(line):
+    """Canonicize ``line`` without the parser, if it is simple enough: only notes, rests, ties,
+    whitespace, plain barlines, and a line continuation. Returns the line exactly as the parser
+    would canonicize it, or ``None`` if the line isn't that simple, or wouldn't parse."""
+    pos, end = 0, len(line)
+    out = []
+    last_kind = None
+    while pos < end:
+        m = RE_SIMPLE_MUSIC_CODE_TOKEN.match(line, pos)
+        if m is None:
+            break
+        pos = m.end()
+        kind = m.lastgroup
+        if kind in ('note', 'note_length', 'tie'):
+            out.append(m.group('note'))
+            if m.group('note_length'):
+                out.append(_canonify_simple_note_length(m.group('note_length')))
+            if m.group('tie'):
+                out.append('-')
+        elif kind in ('rest', 'rest_length'):
+            out.append(m.group('rest'))
+            if m.group('rest_length'):
+                out.append(_canonify_simple_note_length(m.group('rest_length')))
+        elif kind == 'barline':
+            if last_kind == 'barline':  # the grammar doesn't allow two barlines in a row
+                return None
+            out.append(m.group(kind))
+        else:  # WSP
+            out.append(' ')
+        last_kind = kind
+    if not out or RE_SIMPLE_MUSIC_CODE_EOL.match(line, pos) is None:
+        return None
+    if line[pos:pos + 1] == '\\':
+        out.append('\\')
+    return ''.join(out)
+
+
+def canonify_music_code(line, text_string_decoder=None, max_steps=None, time_limit=None):
+    """Return the canonicized ``line`` of music code. Raises ``arpeggio.NoMatch`` if it fails to
+    parse, or ``ParseBudgetExceeded`` if parsing it takes more than ``max_steps`` steps or
+    ``time_limit`` seconds."""
+    text = canonify_simple_music_code(line)
+    if text is None:
+        parse_tree = get_parser().parse(line, max_steps=max_steps, time_limit=time_limit)
+        text = visit_parse_tree(parse_tree, ABCVisitor(text_string_decoder=text_string_decoder))
+    return text
 
 
 if __name__ == '__main__':  # pragma: no cover
@@ -384,7 +514,7 @@ if __name__ == '__main__':  # pragma: no cover
     import sys
     pp = pprint.PrettyPrinter(indent=2)
 
-    result = parser.parse(sys.argv[1])
+    result = get_parser().parse(sys.argv[1])
 
     print(result)  # not useful if one is interested in literal terminals
     pp.pprint(result)
@@ -23,7 +23,7 @@
 
 from django.contrib import admin
 
-from .models import Song, Instance, Title, Collection, CollectionInstance
+from .models import Song, Instance, Title, Collection, CollectionInstance, UploadJob
 
 
 admin.site.site_header = 'ABCdb Administration'
@@ -34,3 +34,4 @@ admin.site.register(Instance)
 admin.site.register(Title)
 admin.site.register(Collection)
 admin.site.register(CollectionInstance)
+admin.site.register(UploadJob)
@@ -0,0 +1,153 @@
+# ABCdb main/bloom.py
+#
+# Copyright © 2017 Sean Bolton.
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""A Bloom filter kept in a memory-mapped file, for telling cheaply that a digest is certainly not
+in the database. It answers "maybe" for everything added to it, and, with probability about
+``error_rate`` once ``capacity`` items have been added, for things which weren't. Items are SHA1
+hex digests, whose bits are already as good as random, so the bit positions are taken straight
+from them by double hashing; other strings are hashed with SHA1 first.
+
+The file is shared by every process which opens it, and ``add`` takes an exclusive lock on it,
+where ``fcntl`` is available, so that concurrent additions aren't lost. Nothing is ever removed,
+so it can only go wrong by missing something which is in the database, e.g. after a database is
+restored; ``rebuild_digest_filter`` builds a new one from the database."""
+
+import hashlib
+import math
+import mmap
+import os
+import struct
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+
+MAGIC = b'ABCBLOOM'
+# magic, version, number of bits, number of hash functions, capacity, count, error rate
+HEADER = struct.Struct('<8sIQIQQd')
+VERSION = 1
+
+HEX_DIGITS = '0123456789abcdefABCDEF'
+
+
+class BloomFilter(object):
+    """A Bloom filter in the file at ``path``, which must have been made by ``create``."""
+
+    def __init__(self, path):
+        self.path = path
+        self.publish_path = None   # where ``publish`` puts a filter made by ``create``
+        self.file = open(path, 'r+b')
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0)
+        except Exception:
+            self.file.close()
+            raise
+        magic, version, self.bits, self.hashes, self.capacity, _, self.error_rate = \
+            HEADER.unpack_from(self.map)
+        if magic != MAGIC or version != VERSION or len(self.map) < HEADER.size + self.bits // 8:
+            self.close()
+            raise ValueError('Not a Bloom filter file: {}'.format(path))
+
+    @classmethod
+    def create(cls, path, capacity, error_rate):
+        """Create an empty filter sized to hold ``capacity`` items with a false positive rate of
+        ``error_rate``, and return it. The file is written alongside ``path``, and only replaces
+        it when ``publish`` is called, once everything has been added, so processes opening
+        ``path`` meanwhile never see a partly built filter, and those with the old one open carry
+        on using it."""
+        capacity = max(1, capacity)
+        bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2 / 64) * 64
+        hashes = max(1, round(bits / capacity * math.log(2)))
+        temp_path = path + '.new'
+        with open(temp_path, 'wb') as fh:
+            fh.write(HEADER.pack(MAGIC, VERSION, bits, hashes, capacity, 0, error_rate))
+            fh.truncate(HEADER.size + bits // 8)
+        bloom = cls(temp_path)
+        bloom.publish_path = path
+        return bloom
+
+    def publish(self):
+        """Rename a filter made by ``create`` into place, at the path given to ``create``."""
+        os.replace(self.path, self.publish_path)
+        self.path, self.publish_path = self.publish_path, None
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def _positions(self, item):
+        if len(item) != 40 or item.strip(HEX_DIGITS):
+            item = hashlib.sha1(item.encode('utf-8')).hexdigest()
+        h1, h2 = int(item[:16], 16), int(item[16:32], 16) | 1
+        bits = self.bits
+        return [(h1 + i * h2) % bits for i in range(self.hashes)]
+
+    def __contains__(self, item):
+        """Return ``False`` if ``item`` has certainly not been added, else ``True``."""
+        data, offset = self.map, HEADER.size
+        for position in self._positions(item):
+            if not data[offset + (position >> 3)] & (1 << (position & 7)):
+                return False
+        return True
+
+    def add(self, items):
+        """Add each of ``items``."""
+        data, offset = self.map, HEADER.size
+        if fcntl is not None:
+            fcntl.flock(self.file, fcntl.LOCK_EX)
+        try:
+            added = 0
+            for item in items:
+                for position in self._positions(item):
+                    data[offset + (position >> 3)] |= 1 << (position & 7)
+                added += 1
+            self.count += added
+        finally:
+            if fcntl is not None:
+                fcntl.flock(self.file, fcntl.LOCK_UN)
+
+    @property
+    def count(self):
+        """The number of items added (counting any added more than once)."""
+        return HEADER.unpack_from(self.map)[5]
+
+    @count.setter
+    def count(self, value):
+        struct.pack_into('<Q', self.map, HEADER.size - 16, value)
+
+    @property
+    def size(self):
+        """The size of the bit array, in bytes."""
+        return self.bits // 8
+
+    def estimated_error_rate(self):
+        """The expected false positive rate with ``count`` items in the filter."""
+        return (1 - math.exp(-self.hashes * self.count / self.bits)) ** self.hashes
+
+    def __str__(self):
+        return ('{:,d} digests in {:,d} bytes ({:d} hashes), sized for {:,d} at a false positive '
+                'rate of {:g}; estimated rate now {:.2g}'.format(
+                    self.count, self.size, self.hashes, self.capacity, self.error_rate,
+                    self.estimated_error_rate()))
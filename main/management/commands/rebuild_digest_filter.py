@@ -0,0 +1,58 @@
+# ABCdb main/management/commands/rebuild_digest_filter.py
+#
+# Copyright © 2017 Sean Bolton.
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from main.bloom import BloomFilter
+from main.upload import DIGEST_FILTER_MODELS
+
+
+class Command(BaseCommand):
+    help = ('Rebuild the Bloom filter of Song, Instance and raw tune digests (ABCDB_DIGEST_FILTER) '
+            'from the database, or with --show, describe the current one.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--capacity', type=int, default=settings.ABCDB_DIGEST_FILTER_CAPACITY,
+                            help='the number of digests to size the filter for (at least twice '
+                                 'the number in the database is used)')
+        parser.add_argument('--error-rate', type=float,
+                            default=settings.ABCDB_DIGEST_FILTER_ERROR_RATE,
+                            help='the false positive rate at capacity')
+        parser.add_argument('--show', action='store_true',
+                            help='describe the current filter, without rebuilding it')
+
+    def handle(self, *args, **options):
+        path = settings.ABCDB_DIGEST_FILTER
+        if options['show']:
+            bloom = BloomFilter(path)
+            self.stdout.write('{}: {}'.format(path, bloom))
+            bloom.close()
+            return
+        rows = sum(model.objects.count() for model in DIGEST_FILTER_MODELS)
+        bloom = BloomFilter.create(path, max(options['capacity'], 2 * rows), options['error_rate'])
+        for model in DIGEST_FILTER_MODELS:
+            bloom.add(model.objects.values_list('digest', flat=True).iterator())
+        bloom.publish()
+        self.stdout.write('{}: {}'.format(path, bloom))
+        bloom.close()
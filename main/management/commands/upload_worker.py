@@ -0,0 +1,62 @@
+# ABCdb main/management/commands/upload_worker.py
+#
+# Copyright © 2017 Sean Bolton.
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import time
+import traceback
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from main.upload import claim_upload_job, run_upload_job
+
+
+class Command(BaseCommand):
+    help = ('Run queued upload jobs (see ABCDB_UPLOAD_JOBS), one at a time, until interrupted. '
+            'Several workers may be run at once.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--burst', action='store_true',
+                            help='exit once no jobs are queued, rather than waiting for more')
+        parser.add_argument('--poll-interval', type=float,
+                            default=settings.ABCDB_UPLOAD_WORKER_POLL_INTERVAL,
+                            help='the seconds to wait between looks for new jobs when idle')
+
+    def handle(self, *args, **options):
+        while True:
+            close_old_connections()
+            job = claim_upload_job()
+            if job is None:
+                if options['burst']:
+                    return
+                time.sleep(options['poll_interval'])
+                continue
+            self.stdout.write('Running {} ({} {})'.format(job, job.method,
+                                                           job.url or job.filename or '-'))
+            try:
+                run_upload_job(job)
+            except Exception:
+                self.stderr.write('{} failed:\n{}'.format(job, traceback.format_exc()))
+            else:
+                self.stdout.write('Finished {}: {} lines, {} tunes'.format(job, job.lines,
+                                                                           job.tunes))
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.2 on 2026-10-17 07:46
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Collection',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(db_index=True, max_length=200, unique=True)),
+                ('date', models.DateTimeField()),
+                ('new_songs', models.IntegerField(default=0)),
+                ('existing_songs', models.IntegerField(default=0)),
+                ('new_instances', models.IntegerField(default=0)),
+                ('existing_instances', models.IntegerField(default=0)),
+                ('error_instances', models.IntegerField(default=0)),
+                ('warning_instances', models.IntegerField(default=0)),
+                ('new_titles', models.IntegerField(default=0)),
+                ('existing_titles', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='CollectionInstance',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('X', models.IntegerField()),
+                ('line_number', models.IntegerField()),
+                ('collection', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='main.Collection')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Instance',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('digest', models.CharField(db_index=True, max_length=40, unique=True)),
+                ('text', models.TextField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='RawDigest',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('digest', models.CharField(db_index=True, max_length=40, unique=True)),
+                ('titles', models.IntegerField(default=0)),
+                ('had_errors', models.BooleanField(default=False)),
+                ('had_warnings', models.BooleanField(default=False)),
+                ('instance', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='main.Instance')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Song',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('digest', models.CharField(db_index=True, max_length=40, unique=True)),
+            ],
+            options={
+                'permissions': (('can_upload', 'Can upload files'),),
+            },
+        ),
+        migrations.CreateModel(
+            name='Title',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('title', models.CharField(db_index=True, max_length=200, unique=True)),
+                ('flat_title', models.CharField(db_index=True, max_length=200)),
+                ('songs', models.ManyToManyField(to='main.Song')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='UploadJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('method', models.CharField(max_length=20)),
+                ('filename', models.CharField(blank=True, max_length=200)),
+                ('url', models.URLField(blank=True)),
+                ('data', models.BinaryField(blank=True)),
+                ('size', models.IntegerField(default=0)),
+                ('state', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed'), ('cancelled', 'Cancelled')], db_index=True, default='queued', max_length=10)),
+                ('cancel_requested', models.BooleanField(default=False)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('started', models.DateTimeField(blank=True, null=True)),
+                ('heartbeat', models.DateTimeField(blank=True, null=True)),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+                ('lines', models.IntegerField(default=0)),
+                ('tunes', models.IntegerField(default=0)),
+                ('results', models.TextField(blank=True)),
+                ('journal', models.TextField(blank=True)),
+                ('error', models.TextField(blank=True)),
+                ('collection', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='main.Collection')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='instance',
+            name='first_title',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='main.Title'),
+        ),
+        migrations.AddField(
+            model_name='instance',
+            name='song',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='main.Song'),
+        ),
+        migrations.AddField(
+            model_name='collectioninstance',
+            name='instance',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='main.Instance'),
+        ),
+        migrations.AddField(
+            model_name='collection',
+            name='instances',
+            field=models.ManyToManyField(through='main.CollectionInstance', to='main.Instance'),
+        ),
+    ]
@@ -21,6 +21,7 @@
 # OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
 # WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+from django.conf import settings
 from django.db import models
 
 
@@ -84,3 +85,60 @@ class CollectionInstance(models.Model):
 
     def __str__(self):
         return 'CollectionInstance {}:{}'.format(self.collection_id, self.instance_id)
+
+
+class RawDigest(models.Model):
+    """This maps the digest of a tune's raw input (see ``ABCParser.find_known_tune``) to the
+    Instance it was saved as, so that an identical tune in a later upload can be recorded without
+    being parsed again. Also held are the number of titles the tune had, and whether parsing it
+    gave errors or warnings."""
+    digest = models.CharField(max_length=40, unique=True, db_index=True)
+    instance = models.ForeignKey(Instance, on_delete=models.CASCADE)
+    titles = models.IntegerField(default=0)
+    had_errors = models.BooleanField(default=False)
+    had_warnings = models.BooleanField(default=False)
+
+    def __str__(self):
+        return 'RawDigest ' + self.digest[:7]
+
+
+class UploadJob(models.Model):
+    """An upload or URL fetch queued to be parsed by ``manage.py upload_worker`` rather than
+    during the request (see ``main.upload.run_upload_job``). ``data`` holds the uploaded ABC until
+    the job is run; ``lines`` and ``tunes`` count its progress; and once it is finished,
+    ``results`` holds a JSON list of the (HTML) result descriptions, ``journal`` the parser's
+    messages, and ``error`` the reason it failed, if it did. The worker running a job updates its
+    ``heartbeat`` as it goes, so a job left running by a worker which died can be recognized."""
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+    STATES = ((QUEUED, 'Queued'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed'),
+              (CANCELLED, 'Cancelled'))
+    FINISHED = (DONE, FAILED, CANCELLED)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    method = models.CharField(max_length=20)
+    filename = models.CharField(max_length=200, blank=True)
+    url = models.URLField(blank=True)
+    data = models.BinaryField(blank=True)
+    size = models.IntegerField(default=0)
+    state = models.CharField(max_length=10, choices=STATES, default=QUEUED, db_index=True)
+    cancel_requested = models.BooleanField(default=False)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True, blank=True)
+    heartbeat = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+    lines = models.IntegerField(default=0)
+    tunes = models.IntegerField(default=0)
+    collection = models.ForeignKey(Collection, null=True, blank=True, on_delete=models.SET_NULL)
+    results = models.TextField(blank=True)
+    journal = models.TextField(blank=True)
+    error = models.TextField(blank=True)
+
+    def __str__(self):
+        return 'UploadJob {} ({})'.format(self.id, self.state)
+
+    @property
+    def is_finished(self):
+        return self.state in self.FINISHED
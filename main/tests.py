@@ -23,9 +23,10 @@
 
 import json
 
-from django.test import TestCase, tag
+from django.test import TestCase, TransactionTestCase, tag
 
 from .models import Song, Instance, Title, Collection, CollectionInstance
+import main.views  # main.upload and main.views import each other; views goes first
 
 
 # ========== Utility Functions to Create Test Data ==========
@@ -176,6 +177,76 @@ class UtilityFunctionTests(TestCase):
         self.assertEqual(remove_diacritics('äbçdèfĝhīj́'), 'abcdefghij')
 
 
+class BloomFilterTests(TestCase):
+    def test_bloom_filter(self):
+        """Test that the Bloom filter finds everything added, rules out most of the rest, and
+        persists in its file, once published."""
+        import hashlib
+        import os
+        import tempfile
+        from main.bloom import BloomFilter
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'test.bloom')
+        digests = [hashlib.sha1(str(i).encode()).hexdigest() for i in range(4000)]
+        bloom = BloomFilter.create(path, 2000, 0.01)
+        self.assertEqual((bloom.size, bloom.hashes, bloom.count), (2400, 7, 0))
+        self.assertNotIn(digests[0], bloom)
+        bloom.add(digests[:2000])
+        bloom.add(['Not a digest', 'x' * 40])
+        self.assertTrue(all(digest in bloom for digest in digests[:2000]))
+        self.assertIn('Not a digest', bloom)
+        self.assertIn('x' * 40, bloom)
+        self.assertNotIn('Also not a digest', bloom)
+        self.assertLess(sum(digest in bloom for digest in digests[2000:]), 40)
+        self.assertAlmostEqual(bloom.estimated_error_rate(), 0.01, places=3)
+        self.assertFalse(os.path.exists(path))
+        bloom.publish()
+        self.assertEqual((bloom.path, os.listdir(directory.name)), (path, ['test.bloom']))
+        bloom.close()
+        bloom = BloomFilter(path)
+        self.assertEqual(bloom.count, 2002)
+        self.assertIn(digests[1999], bloom)
+        bloom.close()
+        with open(path, 'r+b') as fh:
+            fh.write(b'NOTBLOOM')
+        with self.assertRaises(ValueError):
+            BloomFilter(path)
+
+    def test_rebuild_digest_filter(self):
+        """Test that uploads starting while the digest filter is being rebuilt keep using the
+        old one, rather than a partly built one."""
+        import hashlib
+        import io
+        import os
+        import tempfile
+        from unittest import mock
+        from django.core.management import call_command
+        from main.bloom import BloomFilter
+        from main.upload import get_digest_filter
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'digests.bloom')
+        digest = hashlib.sha1(b'song').hexdigest()
+        Song.objects.create(digest=digest)
+        add = BloomFilter.add
+        seen = []
+
+        def add_and_look(bloom, items):
+            seen.append(digest in get_digest_filter(path))
+            add(bloom, items)
+
+        with self.settings(ABCDB_DIGEST_FILTER=path):
+            call_command('rebuild_digest_filter', stdout=io.StringIO())
+            with mock.patch.object(BloomFilter, 'add', add_and_look):
+                call_command('rebuild_digest_filter', stdout=io.StringIO())
+        self.assertEqual(seen, [True] * 3)
+        self.assertIn(digest, get_digest_filter(path))
+        self.assertEqual(os.listdir(directory.name), ['digests.bloom'])
+
+
 class ajax_graph_viewTests(TestCase):
     def decode_json(self, response):
         try:
@@ -459,11 +530,23 @@ class uploadTests(TestCase):
                                     content_type='application/x-www-form-urlencoded')
         self.assertContains(response, "Adding new title '&lt;untitled&gt;'")
         self.assertRegex(response.content, b"Adding new collection 'entry testuser.*:\d\d'")
-        # ...and a tune with more than one title
-        response = self.client.post('/upload/',
-                                    urlencode({'text': 'X:3\nT:Title1\nT:Title2\nK:G\nabc\n\n'}),
-                                    content_type='application/x-www-form-urlencoded')
+        # ...and a tune with more than one title, with the (optional) statistics
+        with self.settings(ABCDB_PARSE_STATS=True):
+            response = self.client.post('/upload/', urlencode(
+                                            {'text': 'X:3\nT:Title1\nT:Title2\nK:G\nabc\n\n'}),
+                                        content_type='application/x-www-form-urlencoded')
         self.assertContains(response, "Adding new title 'Title2'")
+        self.assertContains(response, 'Time by phase: read ')
+        self.assertContains(response, 'Slowest tunes: X:3 &#39;Title1&#39; at line 1 (')
+        # the statistics can trace memory use
+        with self.settings(ABCDB_PARSE_STATS=True, ABCDB_PARSE_STATS_TRACE_MEMORY=True):
+            response = self.client.post('/upload/', urlencode({'text': 'X:1\nK:G\nabc\n\n'}),
+                                        content_type='application/x-www-form-urlencoded')
+        self.assertContains(response, 'Peak traced memory: ')
+        with self.settings(ABCDB_PARSE_STATS=False):
+            response = self.client.post('/upload/', urlencode({'text': 'X:1\nK:G\nabc\n\n'}),
+                                        content_type='application/x-www-form-urlencoded')
+        self.assertNotContains(response, 'Time by phase')
 
     def test_upload_manual_entry_invalid(self):
         """Exercise the manual ABC entry validation code."""
@@ -561,6 +644,39 @@ class uploadTests(TestCase):
                        content_type='application/x-www-form-urlencoded')
         self.assertContains(response, 'The fetched file is too long.')
 
+    def test_upload_url_fetch_first(self):
+        """Test that a fetched file is downloaded in full, outside any transaction, before it
+        is parsed, and that a fetch which fails leaves no collection behind."""
+        from unittest import mock
+        from urllib.parse import urlencode
+        from django.contrib.auth.models import User
+        from django.db import connection
+
+        savepoints = []
+        class Response:
+            def raise_for_status(self):
+                pass
+            def iter_content(self, chunk_size):
+                for chunk in (b'X:1\nT:Fetched\n', b'K:G\nabc|\n\n'):
+                    savepoints.append(len(connection.savepoint_ids))
+                    yield chunk
+
+        self.client.force_login(User.objects.get(username='admin'))
+        with mock.patch('requests.get', return_value=Response()):
+            response = self.client.post('/upload/', urlencode({'url': 'http://example.com/a'}),
+                                        content_type='application/x-www-form-urlencoded')
+            self.assertContains(response, 'processing complete.')
+            self.assertContains(response, "Adding new title 'Fetched'")
+            # no transaction is opened around the fetch, beyond the test's own
+            self.assertEqual(savepoints, [len(connection.savepoint_ids)] * 2)
+            collections = Collection.objects.count()
+            with self.settings(ABCDB_MAX_FETCH_SIZE=20):
+                response = self.client.post('/upload/',
+                                            urlencode({'url': 'http://example.com/a'}),
+                                            content_type='application/x-www-form-urlencoded')
+            self.assertContains(response, 'The fetched file is too long.')
+            self.assertEqual(Collection.objects.count(), collections)
+
     def test_upload_parse_errors_and_warnings(self):
         """Test that parse errors and warnings are reported correctly."""
         from urllib.parse import urlencode
@@ -578,6 +694,370 @@ class uploadTests(TestCase):
         self.assertContains(response, '1 instance with warnings')
         self.assertContains(response, "Adding new collection 'entry testuser")
 
+    def test_upload_known_raw_tunes(self):
+        """Test that tunes uploaded before are recognized by their raw digest, and not parsed."""
+        from urllib.parse import urlencode
+        from django.contrib.auth.models import User
+        from main.models import CollectionInstance, RawDigest
+
+        self.client.force_login(User.objects.get(username='testuser'))
+        TUNES = ('X:1\nT:Tune with error\nT:Second title\nK:F\nab+cd+\n\n'
+                 'X:2\nT:Tune\nK:G\nabcdefg\n\nX:3\nT:Unterminated\nK:G\nabc')
+        response = self.client.post('/upload/', urlencode({'text': TUNES}),
+                                    content_type='application/x-www-form-urlencoded')
+        self.assertContains(response, '3 new songs')
+        self.assertEqual(RawDigest.objects.count(), 2)  # a tune ending at EOF isn't remembered
+        response = self.client.post('/upload/', urlencode({'text': TUNES.replace('X:2', 'X:5')}),
+                                    content_type='application/x-www-form-urlencoded')
+        self.assertContains(response, 'not parsed', count=2)
+        self.assertContains(response, '3 existing songs')
+        self.assertContains(response, '1 instance with errors')
+        self.assertContains(response, '1 instance with warnings')
+        self.assertContains(response, '4 existing titles')
+        self.assertEqual(CollectionInstance.objects.filter(X=5, line_number=7).count(), 1)
+
+    def test_insert_ignoring_conflicts(self):
+        """Test that rows already in the table are skipped, both with the database's own
+        statement and with the row-at-a-time fallback for other databases."""
+        from unittest import mock
+        from django.db import connection
+        from main.models import Title
+        from main.upload import insert_ignoring_conflicts
+
+        for vendor in (connection.vendor, 'other'):
+            with mock.patch.object(connection, 'vendor', vendor):
+                insert_ignoring_conflicts(Title, [Title(title=t, flat_title=t.lower())
+                                                  for t in ('B', 'A ' + vendor, 'B')])
+            self.assertEqual(Title.objects.filter(title='A ' + vendor).count(), 1)
+            self.assertEqual(Title.objects.filter(title='B').count(), 1)
+
+    def test_upload_batched_writes(self):
+        """Test that saving tunes in batches gives the same journal, counts and rows as saving
+        them one at a time, in far fewer queries."""
+        import io
+        from django.db import connection, transaction
+        from django.test.utils import CaptureQueriesContext
+        from main.models import CollectionInstance, Instance, RawDigest, Song, Title
+        from main.upload import UploadParser
+
+        # repeated songs, instances, titles and raw tunes, within and across batches
+        abc = b''.join(b'X:%d\nT:Title %d\nT:Shared title\nK:G\nabc|%s|\n\n'
+                       % (i, i % 7, b'd' * (i % 5)) for i in range(40))
+        abc += b'X:1\nT:Untitled next\nK:G\nabc\n\nX:2\nK:G\nab+c\n\nX:99\nK:G\nabc'
+
+        def upload(batch_size):
+            with self.settings(ABCDB_UPLOAD_BATCH_SIZE=batch_size):
+                p = UploadParser(method='test')
+            with CaptureQueriesContext(connection) as queries:
+                p.parse(io.BytesIO(abc))
+            rows = (sorted(Song.objects.values_list('digest', flat=True)),
+                    sorted(Title.objects.values_list('title', 'flat_title', 'songs__digest')),
+                    sorted(Instance.objects.values_list('digest', 'song__digest', 'text',
+                                                        'first_title__title')),
+                    sorted(RawDigest.objects.values_list('digest', 'instance__digest', 'titles',
+                                                         'had_errors', 'had_warnings')),
+                    list(CollectionInstance.objects.filter(collection=p.collection_inst)
+                         .order_by('id').values_list('instance__digest', 'X', 'line_number')))
+            return p.journal[1:], p.counts, rows, len(queries)
+
+        with transaction.atomic():
+            one_at_a_time = upload(1)
+            transaction.set_rollback(True)
+        batched = upload(1000)
+        self.assertEqual(batched[:3], one_at_a_time[:3])
+        self.assertEqual(batched[1]['new_songs'], 7)
+        self.assertEqual((batched[1]['new_instances'], batched[1]['existing_instances']), (38, 5))
+        self.assertLess(batched[3] * 5, one_at_a_time[3])
+        # and again, now that everything is known
+        again = upload(10)
+        self.assertEqual(again[1]['existing_instances'], 43)
+        self.assertEqual(again[2][1:4], batched[2][1:4])
+
+    def test_upload_final_flush_timed(self):
+        """Test that saving the last batch of tunes counts towards the parse statistics."""
+        import io
+        import time
+        from unittest import mock
+        from main.abcparser import ParseStats
+        from main.upload import UploadParser
+
+        def slow_flush(p):
+            time.sleep(0.05)
+            UploadParser.flush_tunes(p)
+
+        for i, finish in enumerate(('parse', 'close', 'abandon')):
+            abc = b'X:1\nT:Title\nK:G\n%s\n\n' % (b'abc' * (i + 1))
+            with self.settings(ABCDB_UPLOAD_BATCH_SIZE=1000):
+                p = UploadParser(method='test')
+            p.stats = ParseStats()
+            with mock.patch.object(p, 'flush_tunes', lambda: slow_flush(p)):
+                if finish == 'parse':
+                    p.parse(io.BytesIO(abc))
+                else:
+                    p.feed(abc)
+                    getattr(p, finish)()
+            self.assertEqual(p.counts['new_instances'], 1, msg=finish)
+            self.assertGreaterEqual(p.stats.times['process_tune'], 0.05, msg=finish)
+
+    def test_upload_id_caches(self):
+        """Test that the ids of titles and songs are looked up once per upload, or not at all if
+        another upload has already found them, until a row is deleted."""
+        import io
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from main.models import Title
+        from main.upload import UploadParser, id_cache
+
+        self.addCleanup(id_cache.clear)
+        abc = b''.join(b'X:%d\nT:Untitled\nK:G\nabc|%d|\n\n' % (i, i % 3) for i in range(60))
+
+        def title_lookups(p):
+            with CaptureQueriesContext(connection) as queries:
+                p.parse(io.BytesIO(abc))
+            return len([q for q in queries if q['sql'].startswith('SELECT')
+                        and 'FROM "main_title" WHERE' in q['sql']])
+
+        with self.settings(ABCDB_UPLOAD_BATCH_SIZE=10, ABCDB_UPLOAD_ID_CACHE_SIZE=100):
+            p = UploadParser(method='test')
+            self.assertEqual(title_lookups(p), 2)  # before and after inserting it
+            self.assertEqual(p.counts['new_titles'], 1)
+            self.assertEqual(p.counts['existing_titles'], 59)
+            # ids are only shared once committed, which a TestCase never does
+            self.assertIsNone(id_cache.get(('Title', 'Untitled')))
+            id_cache.put(('Title', 'Untitled'), Title.objects.get(title='Untitled').id)
+            p = UploadParser(method='test')
+            self.assertEqual(title_lookups(p), 0)
+            self.assertEqual(p.counts['existing_titles'], 60)
+            # deleting a row (e.g. in the admin) clears the cache
+            unused = Title.objects.create(title='Unused', flat_title='unused')
+            id_cache.put(('Title', 'Unused'), unused.id)
+            unused.delete()
+            self.assertIsNone(id_cache.get(('Title', 'Unused')))
+            self.assertIsNone(id_cache.get(('Title', 'Untitled')))
+
+
+    def test_upload_digest_filter(self):
+        """Test that the digest filter, once built, spares the lookups of new digests, is kept up
+        to date, and changes nothing else."""
+        import io
+        import os
+        import tempfile
+        from django.core.management import call_command
+        from urllib.parse import urlencode
+        from django.contrib.auth.models import User
+        from main.upload import UploadParser
+
+        self.client.force_login(User.objects.get(username='testuser'))
+        TUNES = 'X:1\nT:One\nK:G\nabc\n\nX:2\nT:Two\nK:G\nabd\n\n'
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'digests.bloom')
+        with self.settings(ABCDB_DIGEST_FILTER=path):
+            self.assertIsNone(UploadParser(method='test').digest_filter)  # not built yet
+            response = self.client.post('/upload/', urlencode({'text': TUNES}),
+                                        content_type='application/x-www-form-urlencoded')
+            self.assertNotContains(response, 'Digest filter')
+            output = io.StringIO()
+            call_command('rebuild_digest_filter', capacity=1000, error_rate=0.01, stdout=output)
+            self.assertIn('6 digests in 1,200 bytes (7 hashes)', output.getvalue())
+
+            p = UploadParser(method='test')
+            p.parse(io.BytesIO(TUNES.replace('abd', 'abe').encode()))
+            self.assertEqual(p.counts['existing_instances'], 1)  # known by its raw digest
+            self.assertEqual(p.counts['new_instances'], 1)
+            # the new song and instance, and the new raw digest, before parsing and saving the tune
+            self.assertEqual(p.filter_counts['skipped'], 4)
+            self.assertEqual(p.filter_counts['checked'] - p.filter_counts['found'], 0)
+            self.assertEqual(p.filter_counts['found'], 1)  # the known tune's raw digest
+            self.assertEqual(p.digest_filter.count, 9)
+            response = self.client.post('/upload/', urlencode({'text': TUNES}),
+                                        content_type='application/x-www-form-urlencoded')
+            self.assertContains(response, 'Digest filter: 0 of 2 lookups skipped, '
+                                          '0 false positives')
+            self.assertContains(response, 'not parsed', count=2)
+            output = io.StringIO()
+            call_command('rebuild_digest_filter', show=True, stdout=output)
+            self.assertIn('9 digests in 1,200 bytes', output.getvalue())
+
+    def test_upload_jobs(self):
+        """Test that with ABCDB_UPLOAD_JOBS, uploads are queued for ``manage.py upload_worker``,
+        and their progress and results can be followed."""
+        import datetime
+        import io
+        from unittest import mock
+        from urllib.parse import urlencode
+        from django.contrib.auth.models import Permission, User
+        from django.core.management import call_command
+        from main.models import UploadJob
+        from main.upload import claim_upload_job, run_upload_job
+
+        self.client.force_login(User.objects.get(username='testuser'))
+        TUNES = ''.join('X:{0}\nT:Tune {0}\nK:G\nabc|{1}|\n\n'.format(i, 'd' * i)
+                        for i in range(1, 21))
+        with self.settings(ABCDB_UPLOAD_JOBS=True):
+            self.assertContains(self.client.get('/upload/'), 'URL to Fetch:')
+            response = self.client.post('/upload/', urlencode({'text': TUNES}),
+                                        content_type='application/x-www-form-urlencoded')
+        job = UploadJob.objects.get()
+        self.assertRedirects(response, '/upload/{}/'.format(job.id))
+        self.assertEqual((job.state, job.method, job.filename, job.size),
+                         ('queued', 'entry', 'Tune 1', len(TUNES)))
+        self.assertEqual(Collection.objects.count(), 0)  # nothing parsed yet
+        response = self.client.get('/upload/{}/'.format(job.id))
+        self.assertContains(response, 'Your upload is <span id="job-state">queued</span>.')
+        self.assertRedirects(self.client.get('/ajax/upload/{}/'.format(job.id)),
+                             '/upload/{}/'.format(job.id), target_status_code=200)
+        response = self.client.get('/ajax/upload/{}/'.format(job.id),
+                                   HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(response.json()['state'], 'queued')
+        self.assertNotIn('results', response.json())
+
+        output = io.StringIO()
+        # (closing the connection between jobs would end the test's transaction)
+        with mock.patch('main.management.commands.upload_worker.close_old_connections'):
+            call_command('upload_worker', burst=True, stdout=output)
+        self.assertIn('Finished UploadJob {} (done): 100 lines, 20 tunes'.format(job.id),
+                      output.getvalue())
+        response = self.client.get('/upload/{}/'.format(job.id))
+        self.assertContains(response, 'processing complete.')
+        self.assertContains(response, '20 new songs')
+        self.assertContains(response, "Adding new collection 'entry testuser")
+        status = self.client.get('/ajax/upload/{}/'.format(job.id),
+                                 HTTP_X_REQUESTED_WITH='XMLHttpRequest').json()
+        self.assertEqual((status['state'], status['finished'], status['tunes']), ('done', True, 20))
+        self.assertIn('20 new songs', status['results'])
+        self.assertEqual(status['collection'], Collection.objects.get().id)
+        self.assertEqual(UploadJob.objects.get().data, b'')
+
+        # a queued job is cancelled at once, and a running one after the slice it is parsing
+        job = UploadJob.objects.create(user=User.objects.get(username='testuser'),
+                                       method='entry', data=TUNES.encode())
+        response = self.client.post('/upload/{}/cancel/'.format(job.id))
+        self.assertRedirects(response, '/upload/{}/'.format(job.id), target_status_code=200)
+        self.assertEqual(UploadJob.objects.get(id=job.id).state, 'cancelled')
+        self.assertContains(self.client.get('/upload/{}/'.format(job.id)),
+                            'cancelled before it started')
+        self.assertIsNone(claim_upload_job())
+        job = UploadJob.objects.create(user=User.objects.get(username='testuser'),
+                                       method='entry', data=TUNES.replace('G', 'D').encode())
+        job = claim_upload_job()
+        self.assertEqual(job.state, 'running')
+        self.client.post('/upload/{}/cancel/'.format(job.id))
+        self.assertContains(self.client.get('/upload/{}/'.format(job.id)), 'will be cancelled')
+        with mock.patch('main.upload.JOB_FEED_SIZE', 100):
+            run_upload_job(job)
+        job = UploadJob.objects.get(id=job.id)
+        self.assertEqual(job.state, 'cancelled')
+        self.assertTrue(0 < job.tunes < 20)
+        self.assertEqual(job.collection.new_songs, job.tunes)  # the tunes parsed are all saved
+        self.assertEqual(job.collection.collectioninstance_set.count(), job.tunes)
+        self.assertContains(self.client.get('/upload/{}/'.format(job.id)),
+                            'processing cancelled.')
+
+        # a job left running by a worker which died is failed once its heartbeat is too old
+        def lose(job):
+            """Make ``job``'s heartbeat too old, and have another worker notice."""
+            with self.settings(ABCDB_UPLOAD_JOB_TIMEOUT=60):
+                UploadJob.objects.filter(id=job.id).update(
+                    heartbeat=UploadJob.objects.get(id=job.id).heartbeat -
+                              datetime.timedelta(seconds=61))
+                self.assertIsNone(claim_upload_job())
+
+        UploadJob.objects.create(user=User.objects.get(username='testuser'),
+                                 method='entry', data=TUNES.replace('G', 'A').encode())
+        claimed = claim_upload_job()
+        with self.settings(ABCDB_UPLOAD_JOB_TIMEOUT=60):
+            self.assertIsNone(claim_upload_job())
+        self.assertEqual(UploadJob.objects.get(id=claimed.id).state, 'running')
+        lose(claimed)
+        job = UploadJob.objects.get(id=claimed.id)
+        self.assertEqual((job.state, job.data), ('failed', b''))
+        self.assertContains(self.client.get('/upload/{}/'.format(job.id)),
+                            'Processing the upload stopped unexpectedly.')
+        # ...and stays failed if its worker was only slow: it stops after the slice it is parsing
+        with mock.patch('main.upload.JOB_FEED_SIZE', 100):
+            run_upload_job(claimed)
+        self.assertTrue(0 < claimed.tunes < 20)
+        job = UploadJob.objects.get(id=claimed.id)
+        self.assertEqual((job.state, job.tunes, job.results), ('failed', 0, ''))
+        self.assertIn('stopped unexpectedly', job.error)
+
+        # the heartbeat is kept up while a URL is fetched, and the job stays failed if it stops
+        def slow_fetch(url):
+            yield b'X:1\nT:Fetched\nK:G\nabc\n\n'
+            self.assertGreater(UploadJob.objects.get(id=claimed.id).heartbeat, claimed.heartbeat)
+            lose(claimed)
+            yield b'X:2\nT:Fetched\nK:G\nabd\n\n'
+            yield b'X:3\nT:Fetched\nK:G\nabe\n\n'
+
+        UploadJob.objects.create(user=User.objects.get(username='testuser'), method='fetch',
+                                 url='http://example.com/tunes.abc')
+        claimed = claim_upload_job()
+        with mock.patch('main.upload.fetch_url', slow_fetch), \
+                mock.patch('main.upload.JOB_HEARTBEAT_INTERVAL', 0):
+            run_upload_job(claimed)
+        self.assertEqual(claimed.state, 'failed')
+        job = UploadJob.objects.get(id=claimed.id)
+        self.assertEqual((job.state, job.size, job.collection), ('failed', 0, None))
+        self.assertIn('stopped unexpectedly', job.error)
+
+        # other users can't see a job
+        user = User.objects.create_user('otheruser', password='password')
+        user.user_permissions.add(Permission.objects.get(name='Can upload files'))
+        self.client.force_login(user)
+        self.assertEqual(self.client.get('/upload/{}/'.format(job.id)).status_code, 404)
+
+
+@tag('upload', 'stress')
+class ConcurrentUploadTests(TransactionTestCase):
+    def test_parallel_uploads(self):
+        """Test that uploads of overlapping tunes, running at once against one database, all
+        complete, and save each song, title and instance once."""
+        import io
+        import random
+        import threading
+        from django.db import connection
+        from main.models import RawDigest
+        from main.upload import UploadParser
+
+        tunes = [b'X:%d\nT:Title %d\nT:Shared title\nK:G\nabc|%s|\n\n'
+                 % (i, i % 11, b'd' * (i % 13)) for i in range(60)]
+        uploaders = 6
+        start = threading.Barrier(uploaders)
+        results, errors = [], []
+
+        def upload(seed):
+            try:
+                order = tunes[:]
+                random.Random(seed).shuffle(order)
+                p = UploadParser(method='test', filename='upload {}'.format(seed))
+                start.wait()
+                p.parse(io.BytesIO(b''.join(order)))
+                results.append(p.counts)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        with self.settings(ABCDB_UPLOAD_BATCH_SIZE=7):
+            threads = [threading.Thread(target=upload, args=(seed,)) for seed in range(uploaders)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(Collection.objects.count(), uploaders)
+        self.assertEqual(CollectionInstance.objects.count(), uploaders * 60)
+        self.assertEqual(Song.objects.count(), 13)
+        self.assertEqual(Instance.objects.count(), 60)
+        self.assertEqual(RawDigest.objects.count(), 60)
+        self.assertEqual(Title.objects.count(), 12)
+        self.assertEqual(Title.songs.through.objects.count(), 60 + 13)
+        # a row inserted by another upload meanwhile is counted as new by both
+        self.assertGreaterEqual(sum(counts['new_instances'] for counts in results), 60)
+        self.assertEqual(sum(counts['new_instances'] + counts['existing_instances']
+                             for counts in results), uploaders * 60)
+
 
 # ========== ABC Parser Tests ==========
 
@@ -594,12 +1074,11 @@ class TuneTests(TestCase):
         tune.X = 22
         tune.line_number = 33
         tune.T = ['Title1', 'Title2']
-        tune.canonical = [{'sort': '3K000000', 'line': 'K:G'},
-                          {'sort': '5_000001', 'line': 'abcd'},
-                          {'sort': '5_000002', 'line': ''}]
+        tune.header = {'3K': ['K:G']}
+        tune.body = ['abcd', '']
         self.assertEqual(str(tune),
                          'X: 22\nT: Title1\nT: Title2\nF| T:Title1\nF| T:Title2\n'
-                         'F| K:G\nF| abcd\nF| \nD| 3K000000 K:G\nD| 5_000001 abcd\nD| 5_000002 \n')
+                         'F| K:G\nF| abcd\nF| \nD| K:G\nD| abcd\nD| \n')
 
     def test_Tune_API(self):
         """Test the Tune class methods."""
@@ -620,8 +1099,46 @@ class TuneTests(TestCase):
                 tune.canonical_append(field, line)
         self.assertEqual(str(tune),
                          'X: 44\nT: Title1\nT: Title2\nF| T:Title1\nF| T:Title2\nF| M:4/4\n'
-                         'F| K:G\nF| abcd\nF| \nD| 2M000000 M:4/4\nD| 3K000001 K:G\n'
-                         'D| 5_000002 abcd\nD| 5_000003 \n')
+                         'F| K:G\nF| abcd\nF| \nD| M:4/4\nD| K:G\n'
+                         'D| abcd\nD| \n')
+        # header fields sort into the canonical order, body lines stay in order of appearance
+        tune = Tune()
+        for field, line in [('K', 'K:G'), ('m', 'm:~=Tf'), ('body', 'abc'), ('M', 'M:3/4'),
+                            ('L', 'L:1/8'), ('body', 'K:D'), ('M', 'M:6/8'), ('body', '')]:
+            tune.canonical_append(field, line)
+        self.assertEqual(tune.canonical,
+                         ['L:1/8', 'M:3/4', 'M:6/8', 'm:~=Tf', 'K:G', 'abc', 'K:D', ''])
+
+    def test_digests(self):
+        """Test that the incrementally computed digests match digests of the joined text."""
+        import hashlib
+        import pickle
+        from main.abcparser import Tune
+
+        def sha1(lines):
+            return hashlib.sha1(('\n'.join(lines) + '\n').encode('utf-8')).hexdigest()
+
+        tune = Tune()
+        for field, line in [('X', 'X:22 % number'), ('T', 'T:Café'), ('M', 'M:3/4'),
+                            ('K', 'K:G'), ('body', 'abc'), ('body', 'K:D'), ('body', '')]:
+            tune.full_tune_append(line)
+            if field not in 'XT':
+                tune.canonical_append(field, line)
+        self.assertEqual(tune.digest, sha1(['X:1', 'T:Café', 'M:3/4', 'K:G', 'abc', 'K:D', '']))
+        self.assertEqual(tune.song_digest, sha1(['M:3/4', 'K:G', 'abc', 'K:D', '']))
+        copy = pickle.loads(pickle.dumps(tune))  # hashes are recomputed after unpickling
+        self.assertEqual((copy.digest, copy.song_digest), (tune.digest, tune.song_digest))
+        copy.full_tune_append('% more')
+        copy.canonical_append('body', 'def')
+        self.assertEqual(copy.digest, sha1(['X:1', 'T:Café', 'M:3/4', 'K:G', 'abc', 'K:D', '',
+                                            '% more']))
+        self.assertEqual(copy.song_digest, sha1(['M:3/4', 'K:G', 'abc', 'K:D', '', 'def']))
+        # header lines appended after the body, or direct changes, are still reflected
+        tune.canonical_append('L', 'L:1/4')
+        self.assertEqual(tune.song_digest, sha1(['L:1/4', 'M:3/4', 'K:G', 'abc', 'K:D', '']))
+        tune.full_tune = ['X:3', 'K:A']
+        self.assertEqual(tune.digest, sha1(['X:1', 'K:A']))
+        self.assertEqual(Tune().song_digest, sha1([]))
 
 
 @tag('parser')
@@ -636,6 +1153,48 @@ class ParserUtilityTests(TestCase):
         self.assertEqual(decode_abc_text_string('\\u000A'), '^u000A')    # don't sub controls
         self.assertEqual(decode_abc_text_string('\\"A'), 'Ä')
         self.assertEqual(decode_abc_text_string('\\\\u0041'), '\\u0041') # double backslash
+        self.assertEqual(decode_abc_text_string('\\uD800'), '^uD800')    # nor surrogates,
+        self.assertEqual(decode_abc_text_string('\\U00110000'), '^U00110000')  # nor non-Unicode
+
+    def test_decode_abc_text_string_fast_paths(self):
+        """Test that the pre-check and memo give the same results as full decoding."""
+        from main.abcparser import (_decode_abc_text_string, decode_abc_text_string,
+                                    decode_abc_text_strings, text_string_cache)
+        texts = ['Plain title', "Caf\\'e", 'Cafe\u0301', 'Caf&eacute;', '&', '\\\\', 'Ā',
+                 '\\u00e9t\\u00e9', 'a\\u0000b', '']
+        text_string_cache.clear()
+        for text in texts + texts:
+            self.assertEqual(decode_abc_text_string(text), _decode_abc_text_string(text))
+        self.assertIs(decode_abc_text_string(texts[0]), texts[0])
+        self.assertEqual((text_string_cache.hits, text_string_cache.misses), (8, 8))
+        self.assertEqual(decode_abc_text_strings(texts + texts),
+                         [_decode_abc_text_string(text) for text in texts + texts])
+        batches = []
+        def decode_batch(texts):
+            batches.append(texts)
+            return [_decode_abc_text_string(text) for text in texts]
+        text_string_cache.clear()
+        self.assertEqual(decode_abc_text_strings(texts + texts, decode_batch),
+                         [_decode_abc_text_string(text) for text in texts + texts])
+        self.assertEqual(batches, [texts[1:-1]])
+        self.assertEqual(decode_abc_text_string(texts[1], decode_batch),
+                         _decode_abc_text_string(texts[1]))
+        self.assertEqual(len(batches), 1)
+
+    def test_batch_records(self):
+        """Test reading the records of a Rust ``BatchResult``. The first three are those expected
+        by ``test_batch_result`` in src/abcparser_peg.rs."""
+        from main.abcparser import batch_records
+        data = (b'\x00\x02\x00\x00\x00AB'
+                b'\x01\x00\x00\x00\x00'
+                b'\x00\x03\x00\x00\x00C\xc3\x89'
+                b'\x02\x04\x00\x00\x00boom'
+                b'\x00\x01\x00\x00\x00\xff'
+                b'\x00\x00\x01\x00\x00' + b'x' * 256)
+        self.assertEqual(batch_records(data), [(0, 'AB'), (1, ''), (0, 'CÉ'), (2, 'boom'),
+                                               (2, 'Parser returned illegal UTF_8'),
+                                               (0, 'x' * 256)])
+        self.assertEqual(batch_records(b''), [])
 
     def test_split_off_comment(self):
         from main.abcparser import split_off_comment
@@ -648,6 +1207,67 @@ class ParserUtilityTests(TestCase):
         self.assertEqual(split_off_comment(b'a\\065b'), (b'a\\065b', None))
         self.assertEqual(split_off_comment(b'a\\\\065b'), (b'a\\\\065b', None))
 
+    def test_lex_line(self):
+        """Compare lex_line and split_field against the regular expressions they replaced."""
+        import random
+        import re
+        from main.abcparser import lex_line, split_field
+
+        def old_split_off_comment(line):
+            escaped = re.sub(rb'\\(.)', lambda m: b'\\%03d' % ord(m.group(1)[0:1]), line)
+            m = re.match(rb'^([^%]*?)\s*(%.*)$', escaped)
+            if not m:
+                return line, None
+            unescape = lambda s: re.sub(rb'\\(\d{3})',
+                lambda m: b'\\' + chr(int(m.group(1))).encode('raw_unicode_escape'), s)
+            return unescape(m.group(1)), unescape(m.group(2))
+
+        def old_lex_line(line):
+            line = line.rstrip()
+            if re.match(b'^%%', line):
+                return ('directive', line, None)
+            if re.match(rb'^\s*%', line):
+                return ('comment', line, None)
+            if line == b'':
+                return ('blank', line, None)
+            if b'\t' in line:
+                line = line.expandtabs()
+            if b'%' in line:
+                return ('text', ) + old_split_off_comment(line)
+            return ('text', line, None)
+
+        def old_split_field(line):
+            m = re.match(r'([A-Za-z+]):\s*(.*)', line)
+            return (m.group(1), m.group(2)) if m else (None, None)
+
+        rng = random.Random(5)
+        alphabet = [b'%', b'\\', b' ', b'\t', b'\r', b'\x0b', b'X', b':', b'a', b'\xc3', b'\xa0', b'0']
+        for i in range(20000):
+            line = b''.join(rng.choice(alphabet) for _ in range(rng.randrange(9)))
+            self.assertEqual(tuple(lex_line(line)), old_lex_line(line), msg=repr(line))
+            text = line.decode('cp1252', errors='replace') + rng.choice(['', '\u2003b', ' '])
+            self.assertEqual(split_field(text), old_split_field(text), msg=repr(text))
+
+
+    def test_LRUCache(self):
+        from main.abcparser import LRUCache
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)  # 'b' is now least recently used
+        cache.put('c', 3)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('b', 'missing'), 'missing')
+        self.assertEqual((cache.get('a'), cache.get('c')), (1, 3))
+        self.assertEqual((cache.hits, cache.misses, cache.evictions, len(cache)), (3, 2, 1, 2))
+        cache.resize(1)
+        self.assertEqual((cache.get('c'), cache.evictions, len(cache)), (3, 2, 1))
+        cache.resize(0)
+        cache.put('d', 4)
+        self.assertEqual((len(cache), cache.get('d')), (0, None))
+        cache.clear()
+        self.assertEqual((cache.hits, cache.misses, cache.evictions), (0, 0, 0))
+
 
 @tag('parser')
 class ABCParserTests(TestCase):
@@ -669,6 +1289,19 @@ class ABCParserTests(TestCase):
             import io
             super().parse(io.BytesIO(abc_bytes))
 
+    class RecordingParser(ABCParser):
+        """An ABCParser subclass recording each call to ``log``, ``start_tune``, and
+        ``process_tune``, with the line number at which it was made."""
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.record = []
+        def log(self, severity, message, text):
+            self.record.append((self.line_number, severity, message, text))
+        def start_tune(self):
+            self.record.append((self.line_number, 'start'))
+        def process_tune(self, tune):
+            self.record.append((self.line_number, tune.line_number, str(tune)))
+
     def test_handle_encoding(self):
         p = self.TestParser()
         self.assertEqual(p.encoding, 'default')
@@ -753,12 +1386,12 @@ class ABCParserTests(TestCase):
         p.parse(b'X:1\nT:Title\nK:A\nabc\n\n')
         self.assertEqual(str(p.lasttune),
                          'X: 1\nT: Title\nF| X:1\nF| T:Title\nF| K:A\nF| abc\nF| \n'
-                         'D| 3K000000 K:A\nD| 5_000001 abc\nD| 5_000002 \n')
+                         'D| K:A\nD| abc\nD| \n')
         p.reset()
 
         # the expected str(Tune) for the next few tests
         expected = ('X: 1\nF| X:1\nF| K:G\nF| bagabbb2|\nF| \n'
-                    'D| 3K000000 K:G\nD| 5_000001 bagabbb2|\nD| 5_000002 \n')
+                    'D| K:G\nD| bagabbb2|\nD| \n')
         # extra blank lines at end
         p.parse(b'\nX:1\nK:G\nbagabbb2|\n\n\n')
         self.assertEqual(str(p.lasttune), expected)
@@ -784,41 +1417,41 @@ class ABCParserTests(TestCase):
                          'X: 1\nT: Title with "\%" Character\nF| X:1\n'
                          'F| T:Title with "\%" Character\nF| % tuneheader comment\n'
                          'F| K:G % info field comment\nF| % tunebody comment\n'
-                         'F| bagabbb2| % musiccode comment\nF| \nD| 3K000000 K:G\n'
-                         'D| 5_000001 bagabbb2|\nD| 5_000002 \n')
+                         'F| bagabbb2| % musiccode comment\nF| \nD| K:G\n'
+                         'D| bagabbb2|\nD| \n')
         p.reset()
         # tabs
         p.parse(b'X:1\nT:Title\twith\tTabs\nK:G\nbagabbb2|\n\n')
         self.assertEqual(str(p.lasttune),
                          'X: 1\nT: Title with    Tabs\nF| X:1\nF| T:Title with    Tabs\nF| K:G\n'
                          'F| bagabbb2|\nF| \n'
-                         'D| 3K000000 K:G\nD| 5_000001 bagabbb2|\nD| 5_000002 \n')
+                         'D| K:G\nD| bagabbb2|\nD| \n')
         p.reset()
         # continuation field
         p.parse(b'X:1\nH:history\n+:more history\nK:G\nbagabbb2|\n\n')
         self.assertEqual(str(p.lasttune),
                          'X: 1\nF| X:1\nF| H:history\nF| +:more history\nF| K:G\nF| bagabbb2|\n'
-                         'F| \nD| 3K000000 K:G\nD| 5_000001 bagabbb2|\nD| 5_000002 \n')
+                         'F| \nD| K:G\nD| bagabbb2|\nD| \n')
         p.reset()
         # history continuation without '+'
         # -FIX- leading whitespace handling broken
         p.parse(b'X:1\nH:history\n  more history\n\n and more history\nK:G\nbagabbb2|\n\n')
         self.assertEqual(str(p.lasttune),
-                         'X: 1\nF| X:1\nF| H:history\nF| +:more history\nF| \nD| 5_000000 \n')
+                         'X: 1\nF| X:1\nF| H:history\nF| +:more history\nF| \nD| \n')
         p.reset()
         # fields outside of tune
         p.parse(b'I:abc-version 2.1\n\nI:abc-charset iso-8859-1\nH:file history\n  continuation\n'
                 b'X:1\nK:G\nbagabbb2|\n\n')
         self.assertEqual(str(p.lasttune),
-                         'X: 1\nF| X:1\nF| K:G\nF| bagabbb2|\nF| \nD| 3K000000 K:G\n'
-                         'D| 5_000001 bagabbb2|\nD| 5_000002 \n')
+                         'X: 1\nF| X:1\nF| K:G\nF| bagabbb2|\nF| \nD| K:G\n'
+                         'D| bagabbb2|\nD| \n')
         p.reset()
         # musiccode in tuneheader
         p.parse(b'X:1\ngaba g4|\nK:G\nbagabbb2|\n\n')
         self.assertEqual(str(p.lasttune),
                          'X: 1\nF| X:1\nF| gaba g4|\nF| K:G\nF| bagabbb2|\nF| \n'
-                         'D| 5_000000 gaba g4|\nD| 5_000001 K:G\nD| 5_000002 bagabbb2|\n'
-                         'D| 5_000003 \n')
+                         'D| gaba g4|\nD| K:G\nD| bagabbb2|\n'
+                         'D| \n')
         self.assertEqual(p.lastlog, "Non-field found before 'K:' field")
         p.reset()
 
@@ -828,17 +1461,436 @@ class ABCParserTests(TestCase):
         self.assertEqual(str(p.lasttune),
                          'X: 1\nT: Title\nF| X:1\nF| T:Title\nF| H:Very old.\nF| M:4/4\nF| K:G\n'
                          'F| gbag e2e2|d2d2 g4|\nF| K:A % modulate\nF| acba f2f2|e2e2 a4|\n'
-                         'F| M:3/4 % change meter\nF| a2cbaf|e2e2a2|\nF| \nD| 2M000000 M:4/4\n'
-                         'D| 3K000001 K:G\nD| 5_000002 gbag e2e2|d2d2 g4|\nD| 5_000003 K:A\n'
-                         'D| 5_000004 acba f2f2|e2e2 a4|\nD| 5_000005 M:3/4\n'
-                         'D| 5_000006 a2cbaf|e2e2a2|\nD| 5_000007 \n')
+                         'F| M:3/4 % change meter\nF| a2cbaf|e2e2a2|\nF| \nD| M:4/4\n'
+                         'D| K:G\nD| gbag e2e2|d2d2 g4|\nD| K:A\n'
+                         'D| acba f2f2|e2e2 a4|\nD| M:3/4\n'
+                         'D| a2cbaf|e2e2a2|\nD| \n')
         p.reset()
         # a tune with a bunch of non-standard stuff
         p.start_tune_calls = 0 # second 'X:' in tune should NOT call start_tune() again!
         p.parse(b'X:1\nK:G\nbagabbb2|\nX:2\naaa2 +bdd2|\n\n')
         self.assertEqual(str(p.lasttune),
                          'X: 1\nF| X:1\nF| K:G\nF| bagabbb2|\nF| X:2\nF| aaa2 +bdd2|\nF| \n'
-                         'D| 3K000000 K:G\nD| 5_000001 bagabbb2|\nD| 5_000002 aaa2 +bdd2|\n'
-                         'D| 5_000003 \n')
+                         'D| K:G\nD| bagabbb2|\nD| aaa2 +bdd2|\n'
+                         'D| \n')
         self.assertEqual(p.lastlog, 'Music code failed to parse')
         self.assertEqual(p.start_tune_calls, 1, 'start_tune_calls should be 1')
+
+    def test_iter_tunes(self):
+        """Test that iter_tunes() yields tunes and their log events, and can be stopped early."""
+        import io
+        from main.abcparser import ABCParser
+        p = ABCParser()  # no subclass needed
+        abc = b'%%papersize A4\nX:1\nK:G\nbagabbb2|\n\nX:2\nK:D\nab+cd+\n\nX:3\nK:A\nabc\n'
+        results = list(p.iter_tunes(io.BytesIO(abc)))
+        self.assertEqual([tune.X for tune, events in results], [1, 2, 3])
+        events = results[0][1]
+        self.assertEqual(events[0], (1, 'ignore', 'Stylesheet directive ignored', b'%%papersize A4'))
+        self.assertEqual(events[1].message, 'New tune 1')
+        self.assertEqual(events[1].line_number, 2)
+        self.assertIn(('error', 'Music code failed to parse'),
+                      [(e.severity, e.message) for e in results[1][1]])
+        self.assertEqual(results[2][1][-1].message, 'Unexpected end of file inside tune')
+        self.assertEqual(str(results[0][0]),
+                         'X: 1\nF| X:1\nF| K:G\nF| bagabbb2|\nF| \n'
+                         'D| K:G\nD| bagabbb2|\nD| \n')
+        # log() is still called, and stopping early leaves the rest of the file unparsed
+        p = self.TestParser()
+        tunes = p.iter_tunes(io.BytesIO(abc))
+        tune, events = next(tunes)
+        self.assertEqual(tune.X, 1)
+        self.assertEqual(p.lastlog, 'New tune 1')
+        tunes.close()
+        self.assertEqual(p.line_number, 5)
+        self.assertIsNone(p.lasttune)
+        self.assertIsNone(p.log_events)  # events are only collected while iterating
+        # a log set on the instance is called, and left in place
+        p = ABCParser()
+        p.log = lambda severity, message, text: logged.append(message)
+        logged = []
+        results = list(p.iter_tunes(io.BytesIO(abc)))
+        self.assertEqual(logged, [e.message for tune, events in results for e in events])
+        self.assertIn('log', p.__dict__)
+
+    def test_feed(self):
+        """Test that feeding the input in arbitrary chunks gives the same results as parse()."""
+        import io
+        from main.abcparser import ABCParser
+
+        abc = (b'\xef\xbb\xbf%%abc-charset iso-8859-1\r\nX:1\r\nT:Caf\xe9\r\nK:G\r\n'
+               b'bagabbb2| % comment\r\n\r\n%%encoding 2\nX:2\nT:\xb1\nK:D\n' +
+               b'a' * 5000 + b'\nab+cd+\n\nX:3\nK:A\nabc')
+        expected = self.RecordingParser()
+        expected.parse(io.BytesIO(abc))
+        self.assertTrue(any('T: Café' in str(r) for r in expected.record))
+        for size in (1, 2, 3, 7, 4096, 10000):
+            p = self.RecordingParser()
+            for i in range(0, len(abc), size):
+                p.feed(abc[i:i + size])
+            p.close()
+            self.assertEqual(p.record, expected.record, msg='chunk size {}'.format(size))
+
+    def test_parse_parallel(self):
+        """Test that parse_parallel gives the same results, in the same order, as parse()."""
+        import io
+        from main.abcparser import ABCParser, ParseStats
+
+        abc = b'%%abc-charset iso-8859-1\n\n'
+        for i in range(1, 25):
+            abc += b'X:%d\nT:Caf\xe9 %d\nK:G\nabc|def|\n' % (i, i)
+            if i % 5 == 0:
+                abc += b'%%encoding 2\nX:0\n'  # encoding changes inside a tune still count
+            abc += b'ab+cd+\n' if i % 7 == 0 else b''
+            abc += b'\n'
+            if i == 12:
+                abc += b'Some free text\nI:abc-charset utf-8\n\n'
+        abc += b'X:25\nT:\xc3\xa9\nK:D\nabc'  # unterminated last tune
+        expected = self.RecordingParser()
+        expected.parse(io.BytesIO(abc))
+        p = self.RecordingParser()
+        p.stats = ParseStats(3)
+        p.parse_parallel(io.BytesIO(abc), max_workers=2)
+        self.assertEqual(p.record, expected.record)
+        self.assertGreater(p.stats.times['process_tune'], 0)  # replayed tunes are timed
+        self.assertEqual(len([r for r in p.record if len(r) == 3]), 25)
+        self.assertEqual((p.line_number, p.state, p.encoding),
+                         (expected.line_number, expected.state, expected.encoding))
+        # too few boundaries to split, or a single worker, falls back to a serial parse
+        for workers in (1, 4):
+            p = self.RecordingParser()
+            p.stats = ParseStats(3)
+            p.parse_parallel(io.BytesIO(b'X:1\nK:C\nabc\n' if workers == 4 else abc),
+                             max_workers=workers)
+            self.assertEqual(len([r for r in p.record if len(r) == 3]), 1 if workers == 4 else 25)
+            self.assertEqual(len(p.stats.slowest), 1 if workers == 4 else 3)
+
+    def test_parse_mapped_file(self):
+        """Test that parsing an on-disk (memory-mapped) file gives the same results as parsing
+        the same data from memory, and leaves the file positioned after the data parsed."""
+        import io
+        import tempfile
+        from main.abcparser import ABCParser
+
+        abc = (b'%%abc-charset iso-8859-1\r\nX:1\r\nT:Caf\xe9\r\nK:G\r\nbagabbb2|\r\n\r\n'
+               b'X:2\nK:D\n' + b'a' * 5000 + b'\nab+cd+\n\nX:3\nK:A\nabc')
+        expected = self.RecordingParser()
+        expected.parse(io.BytesIO(abc))
+        with tempfile.TemporaryFile() as fh:
+            fh.write(b'% skipped\n' + abc)
+            fh.seek(0)
+            self.assertEqual(fh.readline(), b'% skipped\n')
+            p = self.RecordingParser()
+            p.parse(fh)
+            self.assertEqual(p.record, expected.record)
+            self.assertEqual(fh.tell(), len(abc) + 10)
+            fh.seek(10)
+            p = ABCParser()
+            tunes = p.iter_tunes(fh)
+            next(tunes)
+            tunes.close()  # stopping early leaves the file positioned after tune 1
+            self.assertEqual(fh.read(4), b'X:2\n')
+        with tempfile.TemporaryFile() as fh:  # empty files can't be mapped
+            p = self.RecordingParser()
+            p.parse(fh)
+            self.assertEqual(p.record, [])
+
+    def test_music_code_cache(self):
+        """Test that canonicized music code, and parse failures, are cached."""
+        from main.abcparser import music_code_cache, MUSIC_CODE_CACHE_SIZE
+        music_code_cache.clear()
+        p = self.TestParser()
+        p.parse(b'X:1\nK:G\nabc|def|\nab+cd+\nabc|def|\n\n')
+        self.assertEqual((music_code_cache.hits, music_code_cache.misses), (1, 2))
+        first = str(p.lasttune)
+        p.parse(b'X:1\nK:G\nabc|def|\nab+cd+\nabc|def|\n\n')
+        self.assertEqual((music_code_cache.hits, music_code_cache.misses), (4, 2))
+        self.assertEqual(str(p.lasttune), first)
+        p.parse(b'X:2\nK:G\nab+cd+\n')
+        self.assertEqual(p.lastlog, 'Unexpected end of file inside tune')
+        p.lastlog = None
+        p.handle_music_code(p.lasttune, 'ab+cd+', '')  # a cached failure is still logged
+        self.assertEqual(p.lastlog, 'Music code failed to parse')
+        music_code_cache.resize(0)
+        p = self.TestParser()
+        p.parse(b'X:1\nK:G\nabc|def|\nab+cd+\nabc|def|\n\n')
+        self.assertEqual(str(p.lasttune), first)
+        self.assertEqual(len(music_code_cache), 0)
+        music_code_cache.resize(MUSIC_CODE_CACHE_SIZE)
+
+    def test_raw_digests(self):
+        """Test skipping the parsing of tunes recognized by ``find_known_tune``."""
+        from main.abcparser import ABCParser
+
+        class KnownTuneParser(self.TestParser):
+            use_raw_digests = True
+            known = {}
+            def __init__(self):
+                super().__init__()
+                self.found = []
+            def find_known_tune(self, digest):
+                return self.known.get(digest)
+            def process_known_tune(self, tune, known):
+                self.found.append((tune.X, tune.line_number, known))
+
+        abc = b'X:1\nT:One\nK:G\nabc\n%%encoding 2\n\nX:2\nT:Two\nK:G\nabc\n\n'
+        p = KnownTuneParser()
+        p.parse(abc)
+        self.assertEqual(p.found, [])
+        digest = p.lasttune.raw_digest
+        self.assertEqual(len(digest), 40)
+        KnownTuneParser.known[digest] = 'second'  # tune 2, in encoding 'iso-8859-2'
+        p = KnownTuneParser()
+        p.parse(abc + abc.replace(b'X:1', b'X:3'))
+        self.assertEqual(p.found, [(2, 7, 'second'), (2, 18, 'second')])
+        self.assertEqual((p.lasttune.X, p.line_number, p.encoding), (3, 22, 'iso-8859-2'))
+        p = KnownTuneParser()  # different encoding, different digest
+        p.parse(abc.replace(b'%%encoding 2', b'%%encoding 3'))
+        self.assertEqual(p.found, [])
+        self.assertEqual(p.lasttune.X, 2)
+
+    def test_clean_input(self):
+        """Test that skipping the control character search for input found to contain none
+        makes no difference to the results."""
+        import io
+        from main.abcparser import ABCParser
+
+        def results(abc, how):
+            p = self.RecordingParser()
+            if how == 'parse':
+                p.parse(io.BytesIO(abc))
+            elif how == 'readline':  # no getbuffer(), so never checked
+                p.parse(io.BufferedReader(io.BytesIO(abc)))
+            else:
+                for i in range(0, len(abc), 3):
+                    p.feed(abc[i:i + 3])
+                p.close()
+            return p.clean_input, p.record
+
+        clean = (b'X:1\r\nT:Caf\xc3\xa9\tau lait\r\nT:Caf\xe9\r\nK:G\r\n"\xc3\xa9"abc % \xc3\r\n\n'
+                 b'X:2\nT:x' + b'\xc3\xa9' * 2049 + b'\nK:D\n%%abc-charset utf-8\nT:\xc3\xa9\xe9\nabc')
+        expected = results(clean, 'readline')
+        self.assertEqual(expected[0], False)
+        self.assertEqual(results(clean, 'parse'), (True, ) + expected[1:])
+        self.assertEqual(results(clean, 'feed'), (True, ) + expected[1:])
+        for dirty in (b'\x7f', b'\xc2\x85', b'\xc2\xa0', b'\r', b'\x0b'):
+            abc = clean.replace(b'au lait', b'au' + dirty + b'lait')
+            expected = results(abc, 'readline')
+            self.assertEqual(results(abc, 'parse'), expected)
+            self.assertEqual(results(abc, 'feed'), expected)
+
+    def test_batched_music_code(self):
+        """Test that deferring a tune's music code to ``canonify_music_code_batch`` makes no
+        difference to the results, or to the order of log events."""
+        import io
+        from main.abcparser import ABCParser, music_code_cache
+
+        class BatchParser(ABCParser):
+            def __init__(self, batch):
+                super().__init__()
+                self.parser = 'Batch test'  # keep out of the way of the real parsers' cache
+                if batch:
+                    self.batches = []
+                    self.canonify_music_code_batch = self.batch
+            def batch(self, lines):
+                self.batches.append(lines)
+                return [self.canonify_music_code(line) for line in lines]
+
+        abc = (b'X:1\nT:One\nK:G\nabc|def|\nab+cd+\nM:3/4\nabc|def|\nfoo\n\n'
+               b'X:2\nK:D\nabc|def|\nab+cd+ % again\nW:words\nxyz|\nab++\n')
+        expected = []
+        for tune, events in BatchParser(False).iter_tunes(io.BytesIO(abc)):
+            expected.append((str(tune), tune.song_digest, events))
+        music_code_cache.clear()
+        p = BatchParser(True)
+        results = []
+        for tune, events in p.iter_tunes(io.BytesIO(abc)):
+            results.append((str(tune), tune.song_digest, events))
+        self.assertEqual(results, expected)
+        self.assertEqual(p.batches, [['abc|def|', 'ab+cd+', 'foo'], ['xyz|', 'ab++']])
+        self.assertNotIn('log', p.__dict__)  # log calls are held back without rebinding log
+        self.assertFalse(p.holding_log)
+        self.assertEqual(p.deferred_music_code, None)
+
+
+    def test_backends(self):
+        """Test choosing the music code parser backend, and that the Rust library is looked for
+        relative to the package, once."""
+        import os
+        from main import abcparser
+        from main.abcparser import ABCParser, RUST_LIBRARY_PATH, get_rust_backend
+        from main.upload import UploadParser
+
+        self.assertTrue(os.path.isabs(RUST_LIBRARY_PATH))
+        self.assertEqual(ABCParser(backend='python').parser, 'Python')
+        self.assertEqual(ABCParser(backend='python').canonify_music_code_batch, None)
+        with self.assertRaises(ValueError):
+            ABCParser(backend='java')
+
+        missing = '/nonexistent/libabcparser_peg.so'
+        p = ABCParser(backend='auto', library_path=missing)
+        self.assertEqual(p.parser, 'Python')
+        with self.assertRaises(OSError):
+            ABCParser(backend='rust', library_path=missing)
+        self.assertIsInstance(abcparser._rust_backends[missing], str)
+        if os.path.isfile(RUST_LIBRARY_PATH):
+            self.assertIs(get_rust_backend(), get_rust_backend(RUST_LIBRARY_PATH))
+            self.assertEqual(ABCParser(backend='rust').parser, 'Rust')
+            self.assertEqual(ABCParser().parser, 'Rust')
+
+        with self.settings(ABCDB_MUSIC_CODE_BACKEND='python'):
+            self.assertEqual(UploadParser().parser, 'Python')
+        with self.settings(ABCDB_MUSIC_CODE_BACKEND='auto', ABCDB_RUST_LIBRARY=missing):
+            self.assertEqual(UploadParser().parser, 'Python')
+
+
+    def test_music_code_threads(self):
+        """Test that canonicizing music code in a thread pool makes no difference to the results,
+        or to the order of calls to ``log``, ``start_tune``, and ``process_tune``."""
+        import io
+        import random
+        import time
+        from main.abcparser import ABCParser, music_code_cache
+
+        class ThreadParser(ABCParser):
+            def __init__(self, threads):
+                super().__init__(backend='python', music_code_threads=threads)
+                self.parser = 'Thread test'  # keep out of the way of the real parsers' cache
+                self.calls = []
+                if threads:
+                    self.canonify_music_code_batch = self.batch
+            def batch(self, lines):
+                time.sleep(random.random() / 100)  # finish out of order
+                return [self.canonify_music_code(line) for line in lines]
+            def log(self, severity, message, text):
+                self.calls.append((self.line_number, severity, message, text))
+            def start_tune(self):
+                self.calls.append((self.line_number, 'start_tune'))
+            def process_tune(self, tune):
+                self.calls.append((self.line_number, str(tune), tune.song_digest))
+
+        abc = b''.join(b'X:%d\nT:Tune\nK:G\nabc|d%de|\nab+cd+\n%%%%foo\n\nfree text\n\n' % (i, i)
+                       for i in range(20)) + b'X:20\nK:D\nabc|\nab++\n'
+        serial = ThreadParser(0)
+        serial.parse(io.BytesIO(abc))
+        music_code_cache.clear()
+        threaded = ThreadParser(3)
+        threaded.parse(io.BytesIO(abc))
+        self.assertEqual(threaded.calls, serial.calls)
+        self.assertEqual(len([c for c in threaded.calls if len(c) == 3]), 21)
+        self.assertNotIn('log', threaded.__dict__)
+        self.assertFalse(threaded.pending_music_code)
+        self.assertIsNone(threaded.music_code_executor)
+
+        music_code_cache.clear()
+        threaded = ThreadParser(3)
+        for start in range(0, len(abc), 100):
+            threaded.feed(abc[start:start + 100])
+        threaded.close()
+        self.assertEqual(threaded.calls, serial.calls)
+
+    def test_music_code_budget(self):
+        """Test that music code lines too long, or too costly, to parse are logged as errors and
+        kept uncanonicized, that the time taken per line is recorded, and that a tune with a line
+        over budget isn't remembered by its raw digest."""
+        import io
+        from main.abcparser import ABCParser, music_code_cache
+
+        music_code_cache.clear()
+
+        class BudgetParser(ABCParser):
+            def __init__(self):
+                super().__init__(backend='python')
+                self.use_raw_digests = True
+                self.logs = []
+                self.tunes = []
+            def log(self, severity, message, text):
+                if severity == 'error':
+                    self.logs.append(message)
+            def process_tune(self, tune):
+                self.tunes.append(tune)
+
+        long_line = 'abc' * 400
+        costly_line = 'a' * 300 + '"'
+        p = BudgetParser()
+        p.music_code_max_length = 1000
+        p.music_code_max_steps = 500
+        p.parse(io.BytesIO(('X:1\nK:G\nabc|\n%s\n%s\n\n' % (long_line, costly_line)).encode()))
+        self.assertEqual(p.logs, ['Music code too costly to parse'] * 2)
+        self.assertEqual(p.tunes[0].body[:3], ['abc|', long_line, costly_line])
+        self.assertEqual(p.music_code_latency.total, 2)  # the long line isn't parsed
+        self.assertIsNone(p.tunes[0].raw_digest)
+
+        p = BudgetParser()
+        p.parse(io.BytesIO(('X:1\nK:G\nabc|\n%s\n\n' % costly_line).encode()))
+        self.assertEqual(p.logs, ['Music code failed to parse'])
+        self.assertIsNotNone(p.tunes[0].raw_digest)
+
+    def test_latency_histogram(self):
+        """Test LatencyHistogram's percentiles."""
+        from main.abcparser import LatencyHistogram
+        h = LatencyHistogram()
+        self.assertEqual(h.percentile(99), 0)
+        h.add(0.000003, 98)
+        h.add(0.000100)
+        h.add(0.1)
+        self.assertEqual((h.total, h.max), (100, 0.1))
+        self.assertEqual(h.percentile(50), 4e-6)
+        self.assertEqual(h.percentile(99), 128e-6)
+        self.assertEqual(h.percentile(100), 131072e-6)
+        other = LatencyHistogram()
+        other.add(0.2)
+        h.merge(other)
+        self.assertEqual((h.total, h.max), (101, 0.2))
+        self.assertEqual(str(h), '< 0.004 ms: 98, < 0.128 ms: 1, < 131.072 ms: 1, < 262.144 ms: 1')
+
+    def test_parse_stats(self):
+        """Test that ParseStats is filled in by each way of parsing, without changing the
+        results."""
+        import io
+        from main.abcparser import ABCParser, ParseStats, music_code_cache
+        from main.abcparser_peg import get_parser
+
+        get_parser()  # so the first tune doesn't include compiling the grammar
+
+        class StatsParser(ABCParser):
+            def __init__(self):
+                super().__init__(backend='python')
+                self.tunes = []
+            def process_tune(self, tune):
+                self.tunes.append(str(tune))
+
+        abc = (b'%abc\n\nX:1\nT:One\nK:G\nabc|\n% comment\n\nfree text\n\n'
+               b'X:2\nT:Two\nK:D\nab+c\n\nX:3\nT:Three\nK:A\n"C"' + b'a>b' * 100 + b'\n')
+        plain = StatsParser()
+        plain.parse(io.BytesIO(abc))
+        self.assertIsNone(plain.stats)
+
+        music_code_cache.clear()
+        p = StatsParser()
+        p.stats = ParseStats(slowest_tunes=2)
+        p.parse(io.BytesIO(abc))
+        self.assertEqual(p.tunes, plain.tunes)
+        self.assertEqual(set(p.stats.times), set(ParseStats.PHASES))
+        self.assertTrue(all(p.stats.times[phase] > 0 for phase in ParseStats.PHASES))
+        self.assertAlmostEqual(p.stats.total, sum(p.stats.times.values()))
+        self.assertEqual(p.stats.log_counts['error'], 1)
+        self.assertEqual(p.stats.log_counts['warn'], 1)  # end of file inside tune
+        self.assertEqual(p.stats.log_counts['info'], 3)
+        self.assertEqual([(x, title) for _, _, x, title in sorted(p.stats.slowest)[1:]],
+                         [(3, 'Three')])
+        self.assertFalse(p.stats.tune_starts)
+        report = p.stats.report()
+        self.assertTrue(report[0].startswith('Time by phase: read '))
+        self.assertTrue(report[1].startswith('Log messages: 1 error, 1 warn, 3 info, '))
+        self.assertTrue(report[2].startswith("Slowest tunes: X:3 'Three' at line 16 ("))
+        self.assertEqual(len(report), 3)
+
+        p = StatsParser()
+        p.stats = ParseStats()
+        for start in range(0, len(abc), 10):
+            p.feed(abc[start:start + 10])
+        p.close()
+        self.assertEqual(p.tunes, plain.tunes)
+        self.assertGreater(p.stats.times['process_tune'], 0)
+        self.assertEqual(p.stats.slowest, [])
+        self.assertEqual(len(p.stats.report()), 2)
@@ -161,6 +161,74 @@ class ArpeggioTests(TestCase):
         for (test_in, expected, message) in TESTS:
             self.check(test_in, expected, message)
 
+    def test_simple_music_code(self):
+        """Test that the fast path for simple music code agrees with the parser, and knows when to
+        leave a line to it."""
+        import random
+        from arpeggio import NoMatch
+        from .abcparser_peg import (ABCVisitor, canonify_simple_music_code, get_parser,
+                                    visit_parse_tree)
+
+        def parse(line):
+            try:
+                return visit_parse_tree(get_parser().parse(line), ABCVisitor())
+            except NoMatch:
+                return None
+
+        self.assertEqual(canonify_simple_music_code("a1 B2/1 c1/2 d/// ^^e'- x4/2|:z//:|] \\ "),
+                         "a B2 c/ d/8 ^^e'- x4/2|:z//:|] \\")
+        for line in ('', '"C"abc', 'a>b', '(3abc', 'a2/', '|]|', 'abc|1', 'a٣', 'a\\b', 'z-'):
+            self.assertIsNone(canonify_simple_music_code(line), msg=line)
+        lines = [test_in for (test_in, _, _) in TESTS]
+        tokens = ['a', 'B,', "c'", '^', '_', '=', 'x', 'z', '1', '2', '/', '//', '-', '|', ':',
+                  ']', ' ', '\t', '\\', '[', '>', '.']
+        rnd = random.Random(0)
+        lines.extend(''.join(rnd.choice(tokens) for _ in range(rnd.randint(1, 8)))
+                     for _ in range(2000))
+        for line in lines:
+            simple = canonify_simple_music_code(line)
+            if simple is not None:
+                self.assertEqual(simple, parse(line), msg='Fast path: ' + repr(line))
+
+    def test_get_parser(self):
+        """Test that the grammar is compiled once per thread, when first needed."""
+        import threading
+        from . import abcparser_peg
+        parser = abcparser_peg.get_parser()
+        self.assertIs(abcparser_peg.get_parser(), parser)
+        self.assertEqual(parser.parse('abc').rule_name, 'music_code_line')
+        parsers = []
+        thread = threading.Thread(target=lambda: parsers.append(abcparser_peg.get_parser()))
+        thread.start()
+        thread.join()
+        self.assertIsNot(parsers[0], parser)
+
+    def test_parse_budget(self):
+        """Test that the parser gives up on lines which take too many steps, or too long."""
+        from .abcparser_peg import ParseBudgetExceeded, canonify_music_code
+        line = 'a' * 300 + '"'
+        with self.assertRaises(ParseBudgetExceeded):
+            canonify_music_code(line, max_steps=1000)
+        with self.assertRaises(ParseBudgetExceeded):
+            canonify_music_code(line, time_limit=1e-6)
+        self.assertEqual(canonify_music_code('a1 [b2c2]', max_steps=1000, time_limit=1),
+                         'a [b2c2]')
+
+    def test_parse_budget_hook(self):
+        """Test that Arpeggio still calls the private ``_nm_raise`` method which
+        ``BudgetedParserPEG`` overrides to count steps, and that the budget is per call."""
+        from arpeggio import NoMatch
+        from .abcparser_peg import BudgetedParserPEG, ParseBudgetExceeded, get_parser
+        parser = get_parser()
+        self.assertIsInstance(parser, BudgetedParserPEG)
+        with self.assertRaises(NoMatch):
+            parser.parse('abc"')
+        self.assertGreater(parser.steps, 0)
+        with self.assertRaises(ParseBudgetExceeded):
+            parser.parse('abc"', max_steps=parser.steps - 1)
+        with self.assertRaises(NoMatch):
+            parser.parse('abc"')  # no budget left over from the previous call
+
 
 # ========== Rust Parser Tests ==========
 
@@ -284,3 +352,16 @@ class ComparisonTests(TestCase):
             self.assertEquals(self.python_canonify_music_code(test_input),
                               self.rust_canonify_music_code(test_input),
                               msg='Comparison testing: ' + message)
+
+    def test_decode_text_strings(self):
+        """Verify that the Rust text string decoder gives the same results as the Python one."""
+        from .abcparser import _decode_abc_text_string, get_rust_backend
+
+        rust = get_rust_backend()
+        texts = ['Plain title', "Caf\\'e", 'Café', 'Caf&eacute;', '&unknown;', '& ;',
+                 '\\\\', '\\&amp;', 'Ā', '\\u00e9t\\u00e9', '\\U0001F3B5', '\\u00A0', 'a\\u0000b',
+                 '\\u009f', '\\uD800', '\\uDB00', '\\U00110000', '\\xx', '\\u12', 'end\\', '']
+        expected = [_decode_abc_text_string(text) for text in texts]
+        self.assertEqual(rust.decode_text_strings(texts), expected)
+        self.assertEqual([rust.decode_text_strings([text])[0] for text in texts], expected)
+        self.assertEqual([rust.decode_abc_text_string(text) for text in texts], expected)
@@ -23,35 +23,171 @@
 
 import collections
 import datetime
-import hashlib
-import io
-import operator
+import json
+import os
 import re
 import time
+import tracemalloc
 import urllib.parse
 
-from django.db import transaction
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models.signals import post_delete
 from django.db.utils import IntegrityError
+from django.dispatch import receiver
+from django.http import HttpResponseRedirect
 from django.shortcuts import render
-from django.utils.html import format_html
+from django.utils.html import escape, format_html
 
-from main.abcparser import ABCParser
+from main.abcparser import ABCParser, LRUCache, ParseStats, music_code_cache
+from main.bloom import BloomFilter
 from main.forms import UploadForm, FetchForm, ABCEntryForm
-from main.models import Collection, CollectionInstance, Instance, Song, Title
+from main.models import (Collection, CollectionInstance, Instance, RawDigest, Song, Title,
+                         UploadJob)
 import main.views
 
 
 # ========== ABCParser Subclass ==========
 
+# The most values put in one ``__in`` lookup (SQLite allows 999 parameters per query).
+LOOKUP_CHUNK_SIZE = 500
+
+
+def chunks(values, size=LOOKUP_CHUNK_SIZE):
+    """Yield successive slices of at most ``size`` of the list ``values``."""
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def ids_by_field(model, field, values):
+    """Return a dict mapping each of ``values`` found in ``field`` of ``model`` to the id of its
+    row, for a ``field`` which is unique."""
+    ids = {}
+    for chunk in chunks(list(values)):
+        ids.update(model.objects.filter(**{field + '__in': chunk}).values_list(field, 'id'))
+    return ids
+
+
+def insert_ignoring_conflicts(model, objs):
+    """Insert the unsaved instances ``objs`` of ``model``, as ``bulk_create`` does, but skip any
+    which would repeat a unique value already in the table, with ``INSERT OR IGNORE`` on SQLite and
+    ``INSERT ... ON CONFLICT DO NOTHING`` on PostgreSQL. On other databases, each row is inserted
+    on its own, in a savepoint, and any which fails with an ``IntegrityError`` is skipped. Another
+    upload may have inserted the same song, title or instance since it was looked up, so the ids
+    must be looked up again afterwards. Rows are inserted in the order given, so callers sort them
+    to lock index entries in the same order in every upload."""
+    objs = list(objs)
+    if not objs:
+        return
+    if connection.vendor == 'sqlite':
+        template = 'INSERT OR IGNORE INTO {} ({}) VALUES {}'
+    elif connection.vendor == 'postgresql':
+        template = 'INSERT INTO {} ({}) VALUES {} ON CONFLICT DO NOTHING'
+    elif connection.vendor == 'mysql':
+        template = 'INSERT IGNORE INTO {} ({}) VALUES {}'
+    else:
+        for obj in objs:
+            try:
+                with transaction.atomic():
+                    obj.save(force_insert=True)
+            except IntegrityError:
+                pass  # already in the table
+        return
+    fields = [field for field in model._meta.concrete_fields if not field.primary_key]
+    quote = connection.ops.quote_name
+    columns = ', '.join(quote(field.column) for field in fields)
+    row = '(' + ', '.join(['%s'] * len(fields)) + ')'
+    with connection.cursor() as cursor:
+        for chunk in chunks(objs, LOOKUP_CHUNK_SIZE // len(fields)):
+            params = [field.get_db_prep_save(getattr(obj, field.attname), connection)
+                      for obj in chunk for field in fields]
+            cursor.execute(template.format(quote(model._meta.db_table), columns,
+                                           ', '.join([row] * len(chunk))), params)
+
+
+# Ids of Songs, Titles and Instances, by digest or title, shared by the uploads made in this
+# process (see ``UploadParser.cached_ids``); ABCDB_UPLOAD_ID_CACHE_SIZE sets its size. Ids are only
+# added once the transaction which found or inserted them has committed, and uploads never
+# delete these rows, but they can be deleted (e.g. in the admin), so the cache is cleared
+# whenever one is.
+id_cache = LRUCache(0)
+
+
+@receiver(post_delete, sender=Song)
+@receiver(post_delete, sender=Title)
+@receiver(post_delete, sender=Instance)
+def clear_id_cache(sender, **kwargs):
+    """Forget the cached ids once a Song, Title or Instance has been deleted."""
+    id_cache.clear()
+
+
+# The models whose digests are kept in the digest filter, a ``BloomFilter`` which lets uploads
+# skip looking up digests which are certainly new (see ``get_digest_filter``).
+DIGEST_FILTER_MODELS = (Song, Instance, RawDigest)
+
+_digest_filters = {}   # path: (inode, BloomFilter)
+
+
+def get_digest_filter(path):
+    """Return the digest filter at ``path``, opened once per process, and again if the file is
+    replaced, or None if there is no such file (e.g. until the ``rebuild_digest_filter`` command
+    has made one), or ``path`` is None."""
+    if not path:
+        return None
+    try:
+        inode = os.stat(path).st_ino
+    except OSError:
+        return None
+    cached = _digest_filters.get(path)
+    if cached is None or cached[0] != inode:
+        cached = _digest_filters[path] = (inode, BloomFilter(path))
+    return cached[1]
+
+
+class PendingTune(object):
+    """A parsed tune waiting in ``UploadParser.pending_tunes`` to be saved, with whether parsing
+    it gave errors or warnings, and the index of its place in the journal."""
+    __slots__ = ('tune', 'had_errors', 'had_warnings', 'journal_index')
+
+    def __init__(self, tune, had_errors, had_warnings, journal_index):
+        self.tune = tune
+        self.had_errors = had_errors
+        self.had_warnings = had_warnings
+        self.journal_index = journal_index
+
+
 class UploadParser(ABCParser):
     """Extends ABCParser to save tunes to the database, convert logging information to HTML, and
     gather statistics."""
+    use_raw_digests = True
+
     def __init__(self, username=None, filename=None, method=None):
-        super().__init__()
+        super().__init__(settings.ABCDB_MUSIC_CODE_BACKEND, settings.ABCDB_RUST_LIBRARY,
+                         settings.ABCDB_MUSIC_CODE_THREADS)
+        self.music_code_max_length = settings.ABCDB_MUSIC_CODE_MAX_LENGTH
+        self.music_code_max_steps = settings.ABCDB_MUSIC_CODE_MAX_STEPS
+        self.music_code_time_limit = settings.ABCDB_MUSIC_CODE_TIME_LIMIT
+        if settings.ABCDB_PARSE_STATS:
+            self.stats = ParseStats(settings.ABCDB_PARSE_STATS_SLOWEST_TUNES)
+        self.tracing_memory = (settings.ABCDB_PARSE_STATS_TRACE_MEMORY and
+                               not tracemalloc.is_tracing())
+        if self.tracing_memory:
+            tracemalloc.start()
         self.process_time_start = time.process_time()
+        music_code_cache.resize(settings.ABCDB_MUSIC_CODE_CACHE_SIZE)
+        self.cache_hits_start = music_code_cache.hits
+        self.cache_misses_start = music_code_cache.misses
         self.music_code_parse_time = 0
-        self.journal = ''
+        self.journal = []   # HTML, joined by ``get_journal``
         self.counts = collections.Counter()
+        self.batch_size = settings.ABCDB_UPLOAD_BATCH_SIZE
+        self.pending_tunes = []        # ``PendingTune``s, and ``(tune, raw_digest)`` tuples
+        self.pending_raw_digests = {}  #     for known tunes, see ``flush_tunes``
+        id_cache.resize(settings.ABCDB_UPLOAD_ID_CACHE_SIZE)
+        self.known_ids = {Song: {}, Title: {}, Instance: {}}   # see ``cached_ids``
+        self.known_links = set()   # (title id, song id) pairs known to be in the database
+        self.digest_filter = get_digest_filter(settings.ABCDB_DIGEST_FILTER)
+        self.filter_counts = collections.Counter()   # see ``maybe_present``
         self.tune_had_errors = False
         self.tune_had_warnings = False
         # create Collection
@@ -73,11 +209,42 @@ class UploadParser(ABCParser):
                 time_format = '%Y/%m/%d %H:%M:%S.%f'  # try again with microseconds
             else:
                 break
-        self.journal += format_html("Adding new collection '{}'<br>\n", source)
+        self.journal.append(format_html("Adding new collection '{}'<br>\n", source))
 
     def parse(self, filehandle):
         """Parse ABC upload, then save statistics to the collection."""
         super().parse(filehandle)
+        self.flush_final_tunes()
+        self.save_collection_statistics()
+
+    def close(self):
+        """Finish parsing ABC upload given with ``feed``, then save statistics to the
+        collection."""
+        super().close()
+        self.flush_final_tunes()
+        self.save_collection_statistics()
+
+    def abandon(self):
+        """Stop parsing ABC given with ``feed`` part way through, as when an upload job is
+        cancelled: the tunes completed so far are saved, and statistics to the collection, but the
+        tune being parsed, and any input not yet parsed, are dropped."""
+        for tune in self._finished_tunes(None, wait=True):
+            self._process_tune(tune)
+        self._shutdown_music_code_threads()
+        self.feed_buffer = b''
+        self.flush_final_tunes()
+        self.save_collection_statistics()
+
+    def flush_final_tunes(self):
+        """Save the tunes still queued once parsing has finished. With ``stats``, the time is
+        charged to the 'process_tune' phase, like that of the batches saved during the parse."""
+        if self.stats is not None:
+            self.stats.enter('process_tune')
+        self.flush_tunes()
+        if self.stats is not None:
+            self.stats.finish()
+
+    def save_collection_statistics(self):
         self.collection_inst.new_songs = self.counts['new_songs']
         self.collection_inst.existing_songs = self.counts['existing_songs']
         self.collection_inst.new_instances = self.counts['new_instances']
@@ -87,6 +254,9 @@ class UploadParser(ABCParser):
         self.collection_inst.new_titles = self.counts['new_titles']
         self.collection_inst.existing_titles = self.counts['existing_titles']
         self.collection_inst.save()
+        if self.tracing_memory:  # ``stats`` has noted the peak by now
+            tracemalloc.stop()
+            self.tracing_memory = False
 
 
     def start_tune(self):
@@ -94,104 +264,372 @@ class UploadParser(ABCParser):
         self.tune_had_warnings = False
 
 
-    @transaction.atomic
     def process_tune(self, tune):
-        # create the SHA1 digest of the canonical tune, and save it in a Song
-        song_digest = hashlib.sha1()
-        song_digest.update('\n'.join(map(operator.itemgetter('line'),
-                                         tune.canonical)).encode('utf-8') + b'\n')
-        song_digest = song_digest.hexdigest()
-        song_inst, new = Song.objects.get_or_create(digest=song_digest)
-        if new:
-            self.journal += format_html("Adding new song {}<br>\n", song_digest[:7])
-            self.counts['new_songs'] += 1
-        else:
-            self.journal += format_html("Found existing song {}<br>\n", song_digest[:7])
-            self.counts['existing_songs'] += 1
-        # save Titles
-        first_title_inst = None
+        """Queue ``tune`` to be saved by ``flush_tunes``, leaving a place in the journal for its
+        messages."""
         if not tune.T:
             tune.T = ('<untitled>', )
-        for t in tune.T:
-            title_inst, new = Title.objects.update_or_create(title=t,
-                                 defaults={'flat_title': main.views.remove_diacritics(t).lower()})
-            if new:
-                self.journal += format_html("Adding new title '{}'<br>\n", t)
-                self.counts['new_titles'] += 1
-            else:
-                self.journal += format_html("Found existing title '{}'<br>\n", t)
-                self.counts['existing_titles'] += 1
-            title_inst.songs.add(song_inst)
-            if not first_title_inst:
-                first_title_inst = title_inst
-        # digest the full tune, and save the tune in an Instance
-        tune.full_tune[0] = 'X:1'  # make X fields all 1 for deduplication
-        full_tune = '\n'.join(tune.full_tune) + '\n'
-        tune_digest = hashlib.sha1()
-        tune_digest.update(full_tune.encode('utf-8'))
-        tune_digest = tune_digest.hexdigest()
-        instance_inst, new = Instance.objects.update_or_create(digest=tune_digest,
-                                 defaults={'song': song_inst, 'text': full_tune,
-                                           'first_title': first_title_inst})
-        if new:
-            self.journal += format_html("Adding new instance {}<br>\n", tune_digest[:7])
-            self.counts['new_instances'] += 1
+        pending = PendingTune(tune, self.tune_had_errors, self.tune_had_warnings,
+                              len(self.journal))
+        self.journal.append('')  # filled in by ``flush_tunes``
+        self.pending_tunes.append(pending)
+        if tune.raw_digest:
+            self.pending_raw_digests[tune.raw_digest] = pending
+        self._count_instance(pending.had_errors, pending.had_warnings)
+        if len(self.pending_tunes) >= self.batch_size:
+            self.flush_tunes()
+
+
+    def find_known_tune(self, digest):
+        # a tune waiting in ``pending_tunes`` will be in the database by the time it matters
+        pending = self.pending_raw_digests.get(digest)
+        if pending is not None:
+            return pending
+        if not self.maybe_present((digest, )):
+            return None
+        known = RawDigest.objects.filter(digest=digest).select_related('instance').first()
+        self.filter_counts['found'] += known is not None
+        return known
+
+
+    def process_known_tune(self, tune, raw_digest):
+        """Queue the recording of ``tune`` as the Instance already saved for ``raw_digest`` (a
+        ``RawDigest``, or the ``PendingTune`` which will save it)."""
+        if isinstance(raw_digest, PendingTune):
+            digest = raw_digest.tune.digest
+            titles = len(raw_digest.tune.T)
         else:
-            self.journal += format_html("Found existing instance {}<br>\n", tune_digest[:7])
-            self.counts['existing_instances'] += 1
-        # add instance to collection
-        collinst_inst = CollectionInstance.objects.create(instance=instance_inst,
-                                                          collection=self.collection_inst,
-                                                          X=tune.X, line_number=tune.line_number)
-        collinst_inst.save()
-        # note warning status
-        if self.tune_had_errors:
+            digest = raw_digest.instance.digest
+            titles = raw_digest.titles
+        self.journal.append(format_html("Found existing instance {} (unchanged, not parsed)<br>\n",
+                                        digest[:7]))
+        self.counts['existing_songs'] += 1
+        self.counts['existing_instances'] += 1
+        self.counts['existing_titles'] += titles
+        self.pending_tunes.append((tune, raw_digest))
+        self._count_instance(raw_digest.had_errors, raw_digest.had_warnings)
+        if len(self.pending_tunes) >= self.batch_size:
+            self.flush_tunes()
+
+
+    def _count_instance(self, had_errors, had_warnings):
+        if had_errors:
             self.counts['error_instances'] +=1
-        elif self.tune_had_warnings:
+        elif had_warnings:
             self.counts['warning_instances'] +=1
         else:
             self.counts['good_instances'] +=1
 
 
+    @transaction.atomic
+    def flush_tunes(self):
+        """Save the tunes queued by ``process_tune`` and ``process_known_tune`` to the database,
+        with a handful of queries in all, rather than a dozen or so for each tune: existing Songs,
+        Titles and Instances are looked up with ``__in`` queries, and new ones, and the rows
+        linking them, are inserted with ``insert_ignoring_conflicts``. The journal and counts come
+        out as they would have if each tune had been saved as it was parsed.
+
+        Any number of uploads may be saving at once. Each first updates its own Collection row,
+        which on SQLite takes the database's write lock, so batches are saved one at a time; on
+        PostgreSQL they run side by side, a row inserted by another upload meanwhile is skipped
+        (and counted here as new), and the tables and the rows in each are always written in the
+        same order, so no two uploads can deadlock."""
+        queue, self.pending_tunes = self.pending_tunes, []
+        self.pending_raw_digests = {}
+        if not queue:
+            return
+        Collection.objects.filter(id=self.collection_inst.id).update(date=self.collection_inst.date)
+        parsed = [pending for pending in queue if isinstance(pending, PendingTune)]
+        song_ids = self.cached_ids(Song, 'digest', {p.tune.song_digest for p in parsed})
+        title_ids = self.cached_ids(Title, 'title', {t for p in parsed for t in p.tune.T})
+        instance_ids = self.cached_ids(Instance, 'digest', {p.tune.digest for p in parsed})
+        raw_digest_ids = ids_by_field(RawDigest, 'digest', self.maybe_present(
+                                          {p.tune.raw_digest for p in parsed if p.tune.raw_digest}))
+        self.filter_counts['found'] += len(raw_digest_ids)
+
+        # decide what is new, in input order, as saving each tune in turn would have
+        new_songs, new_titles, new_instances = {}, {}, {}
+        for pending in parsed:
+            tune = pending.tune
+            song_digest = tune.song_digest
+            journal = []
+            if song_digest in song_ids or song_digest in new_songs:
+                journal.append(format_html("Found existing song {}<br>\n", song_digest[:7]))
+                self.counts['existing_songs'] += 1
+            else:
+                new_songs[song_digest] = Song(digest=song_digest)
+                journal.append(format_html("Adding new song {}<br>\n", song_digest[:7]))
+                self.counts['new_songs'] += 1
+            for t in tune.T:
+                if t in title_ids or t in new_titles:
+                    journal.append(format_html("Found existing title '{}'<br>\n", t))
+                    self.counts['existing_titles'] += 1
+                else:
+                    new_titles[t] = Title(title=t,
+                                          flat_title=main.views.remove_diacritics(t).lower())
+                    journal.append(format_html("Adding new title '{}'<br>\n", t))
+                    self.counts['new_titles'] += 1
+            tune_digest = tune.digest
+            if tune_digest in instance_ids or tune_digest in new_instances:
+                journal.append(format_html("Found existing instance {}<br>\n", tune_digest[:7]))
+                self.counts['existing_instances'] += 1
+            else:
+                new_instances[tune_digest] = pending
+                journal.append(format_html("Adding new instance {}<br>\n", tune_digest[:7]))
+                self.counts['new_instances'] += 1
+            self.journal[pending.journal_index] = ''.join(journal)
+
+        # insert the new rows, then look up their ids
+        insert_ignoring_conflicts(Song, (new_songs[d] for d in sorted(new_songs)))
+        self.add_to_digest_filter(new_songs)
+        song_ids.update(self.cached_ids(Song, 'digest', new_songs, inserted=True))
+        insert_ignoring_conflicts(Title, (new_titles[t] for t in sorted(new_titles)))
+        title_ids.update(self.cached_ids(Title, 'title', new_titles, inserted=True))
+        TitleSongs = Title.songs.through
+        links = {(title_ids[t], song_ids[p.tune.song_digest])
+                 for p in parsed for t in p.tune.T} - self.known_links
+        existing_links = set()
+        # look for the pairs themselves, since a common title may have thousands of songs
+        for chunk in chunks(sorted(links), LOOKUP_CHUNK_SIZE // 2):
+            existing_links.update(TitleSongs.objects.filter(
+                                      title_id__in={title_id for title_id, _ in chunk},
+                                      song_id__in={song_id for _, song_id in chunk})
+                                  .values_list('title_id', 'song_id'))
+        new_links = sorted(links - existing_links)
+        insert_ignoring_conflicts(TitleSongs, (TitleSongs(title_id=title_id, song_id=song_id)
+                                               for title_id, song_id in new_links))
+        self.known_links.update(links)
+        instances = []
+        for tune_digest, pending in sorted(new_instances.items()):
+            tune = pending.tune
+            tune.full_tune[0] = 'X:1'  # make X fields all 1 for deduplication, as in the digest
+            instances.append(Instance(digest=tune_digest, song_id=song_ids[tune.song_digest],
+                                      text='\n'.join(tune.full_tune) + '\n',
+                                      first_title_id=title_ids[tune.T[0]]))
+        insert_ignoring_conflicts(Instance, instances)
+        self.add_to_digest_filter(new_instances)
+        instance_ids.update(self.cached_ids(Instance, 'digest', new_instances,
+                                              inserted=True))
+
+        # remember the raw tunes, so they needn't be parsed again
+        new_raw_digests, updated_raw_digests = {}, {}
+        for pending in parsed:
+            raw_digest = pending.tune.raw_digest
+            if not raw_digest:
+                continue
+            fields = {'instance_id': instance_ids[pending.tune.digest],
+                      'titles': len(pending.tune.T), 'had_errors': pending.had_errors,
+                      'had_warnings': pending.had_warnings}
+            if raw_digest in raw_digest_ids:
+                updated_raw_digests[raw_digest_ids[raw_digest]] = fields
+            else:
+                new_raw_digests[raw_digest] = RawDigest(digest=raw_digest, **fields)
+        for raw_digest_id, fields in sorted(updated_raw_digests.items()):
+            RawDigest.objects.filter(id=raw_digest_id).update(**fields)
+        insert_ignoring_conflicts(RawDigest, (new_raw_digests[d] for d in sorted(new_raw_digests)))
+        self.add_to_digest_filter(new_raw_digests)
+
+        # add the instances to the collection
+        collection_instances = []
+        for pending in queue:
+            if isinstance(pending, PendingTune):
+                tune, instance_id = pending.tune, instance_ids[pending.tune.digest]
+            else:
+                tune, raw_digest = pending
+                if isinstance(raw_digest, PendingTune):
+                    instance_id = instance_ids[raw_digest.tune.digest]
+                else:
+                    instance_id = raw_digest.instance_id
+            collection_instances.append(CollectionInstance(instance_id=instance_id,
+                                                           collection=self.collection_inst,
+                                                           X=tune.X, line_number=tune.line_number))
+        CollectionInstance.objects.bulk_create(collection_instances)
+
+
+    def cached_ids(self, model, field, values, inserted=False):
+        """Return a dict mapping each of ``values`` found in ``field`` of ``model`` to the id of
+        its row, like ``ids_by_field``, but looking first in this upload's ``known_ids``, then in
+        the process-wide ``id_cache``, and only querying the database for the rest. With
+        ``inserted``, ``values`` have just been inserted, so they are certainly present: the
+        digest filter isn't consulted, and the lookups aren't counted in ``filter_counts``."""
+        known = self.known_ids[model]
+        ids = {}
+        missing = []
+        for value in values:
+            row_id = known.get(value)
+            if row_id is None:
+                row_id = id_cache.get((model.__name__, value))
+            if row_id is None:
+                missing.append(value)
+            else:
+                ids[value] = row_id
+        filtered = model in DIGEST_FILTER_MODELS and not inserted
+        if filtered:
+            missing = self.maybe_present(missing)
+        found = ids_by_field(model, field, missing)
+        if filtered:
+            self.filter_counts['found'] += len(found)
+        ids.update(found)
+        known.update(ids)
+        if found and id_cache.maxsize > 0:
+            def share():
+                for value, row_id in found.items():
+                    id_cache.put((model.__name__, value), row_id)
+            transaction.on_commit(share)
+        return ids
+
+
+    def maybe_present(self, digests):
+        """Return the list of ``digests`` which the digest filter says may be in the database,
+        i.e. all of them if there is no filter. ``filter_counts`` counts the digests the filter let
+        through ('checked') and those it ruled out ('skipped'); the callers count those which
+        turned out to be there ('found'), so the rest were false positives."""
+        digests = list(digests)
+        if self.digest_filter is None:
+            return digests
+        maybe = [digest for digest in digests if digest in self.digest_filter]
+        self.filter_counts['skipped'] += len(digests) - len(maybe)
+        self.filter_counts['checked'] += len(maybe)
+        return maybe
+
+
+    def add_to_digest_filter(self, digests):
+        """Add the newly inserted ``digests`` to the digest filter, if there is one."""
+        if self.digest_filter is not None and digests:
+            self.digest_filter.add(digests)
+
+
     def log(self, severity, message, text):
+        super().log(severity, message, text)
         if isinstance(text, bytes):
             text = text.decode('utf-8', errors='backslashreplace')
         if severity == 'error':
-            self.journal += format_html("Error, line {}: {}: {}<br>\n", str(self.line_number),
-                                       message, text)
+            self.journal.append(format_html("Error, line {}: {}: {}<br>\n",
+                                            str(self.line_number), message, text))
             self.tune_had_errors = True
         elif severity == 'warn':
-            self.journal += format_html("Warning, line {}: {}: {}<br>\n", str(self.line_number),
-                                       message, text)
+            self.journal.append(format_html("Warning, line {}: {}: {}<br>\n",
+                                            str(self.line_number), message, text))
             self.tune_had_warnings = True
         elif severity == 'info':
             if 'New tune' in message:
                 x = re.sub('\D', '', message) # get tune number
-                self.journal += format_html("Found start of new tune #{} at line {}<br>\n",
-                                        x, str(self.line_number))
+                self.journal.append(format_html("Found start of new tune #{} at line {}<br>\n",
+                                                x, str(self.line_number)))
         else:  # severity == 'ignore'
             #print(severity + ' | ' + str(self.line_number) + ' | ' + message + ' | ' + text)
             pass
 
 
     def append_journal(self, text):
-        self.journal += text
+        self.journal.append(text)
 
 
     def get_journal(self):
-        return self.journal
+        return ''.join(self.journal)
 
 
 # ========== ABC Upload POST View ==========
 
+class UploadAborted(Exception):
+    """Raised to abandon an upload, e.g. when a URL fetch fails."""
+    def __init__(self, reason, severity=''):
+        super().__init__(reason)
+        self.reason = reason
+        self.severity = severity
+
+
+def alert_box(reason, severity=''):
+    return format_html('<div data-alert class="alert-box {} radius">{}</div>', severity, reason)
+
+
 def upload_failed(request, reason, severity=''):
-    message = format_html('<div data-alert class="alert-box {} radius">{}</div>',
-                          severity, reason)
-    return render(request, 'main/upload-post.html', { 'error': message })
+    return render(request, 'main/upload-post.html', { 'error': alert_box(reason, severity) })
+
+
+def fetch_url(url):
+    """Generator yielding the file at ``url`` in chunks as it is fetched, raising
+    ``UploadAborted`` if the fetch fails or the file grows longer than ABCDB_MAX_FETCH_SIZE."""
+    import requests  # -FIX- this will move when ready for production
+    def fetch_failed(e):
+        return "URL fetch failed with '{}'".format(str(e))  # -FIX- reveals too much?
+    try:
+        r = requests.get(url, timeout=5, stream=True)
+        r.raise_for_status()  # convert any non-200 status response to an exception, could
+                              # handle 404 more gracefully
+    except requests.exceptions.RequestException as e:
+        raise UploadAborted(fetch_failed(e), severity='warning')
+    file_length = 0
+    try:
+        for chunk in r.iter_content(4096):
+            file_length += len(chunk)
+            if file_length > settings.ABCDB_MAX_FETCH_SIZE:
+                raise UploadAborted('The fetched file is too long. Please download it '
+                                    'yourself, break it into smaller pieces, and upload '
+                                    'them.', severity='info')
+            yield chunk
+    except requests.exceptions.RequestException as e:
+        raise UploadAborted(fetch_failed(e), severity='warning')
+
+
+def upload_status(method, filename, size):
+    """Return the first line of the journal of an upload, describing what is being processed."""
+    if method == 'upload':
+        return format_html("Processing uploaded file '{}', size {} bytes<br>\n", filename, size)
+    elif method == 'fetch':
+        return format_html("Processing file fetched from '{}'<br>\n", filename)
+    else:
+        return format_html("Processing ABC notation, size {} bytes<br>\n", size)
+
+
+def upload_results(p):
+    """Return a list of natural-language (HTML) descriptions of the results of the upload parsed
+    by UploadParser ``p``."""
+    results = []
+    for key, text in (
+            ('new_songs', '{} new song{}'),
+            ('existing_songs', '{} existing song{}'),
+            ('new_instances', '{} new song instance{}'),
+            ('existing_instances', '{} existing song instance{}'),
+            ('error_instances', '{} instance{} with errors'),
+            ('warning_instances', '{} instance{} with warnings'),
+            ('good_instances', '{} instance{} with no errors or warnings'),
+            ('new_titles', '{} new title{}'),
+            ('existing_titles', '{} existing title{}')):
+        result = text.format(p.counts[key], 's' if p.counts[key] != 1 else '')
+        if ('warning' in key or 'error' in key) and p.counts[key] > 0:
+            result = '<div style="color:red">' + result + '</div>'
+        results.append(result)
+    elapsed = datetime.datetime.now(datetime.timezone.utc) - p.collection_inst.date
+    elapsed = elapsed.total_seconds()
+    results.append('Processed {} lines in {:.2f} seconds'.format(p.line_number, elapsed))
+    results.append('Process CPU time: {:.2f} seconds'.format(time.process_time() -
+                                                             p.process_time_start))
+    results.append('Low-level (music code) ABC parse time (using {} parser): {:.2f} seconds'
+                       .format(p.parser, p.music_code_parse_time))
+    results.append('Music code cache: {} hits, {} misses'.format(
+                       music_code_cache.hits - p.cache_hits_start,
+                       music_code_cache.misses - p.cache_misses_start))
+    if p.music_code_latency.total:
+        results.append('Music code parse time per line: median < {:.2f} ms, 99th percentile < '
+                       '{:.2f} ms, slowest {:.2f} ms'.format(
+                           p.music_code_latency.percentile(50) * 1000,
+                           p.music_code_latency.percentile(99) * 1000,
+                           p.music_code_latency.max * 1000))
+    if p.digest_filter is not None:
+        counts = p.filter_counts
+        results.append('Digest filter: {} of {} lookups skipped, {} false positive{}'.format(
+                           counts['skipped'], counts['skipped'] + counts['checked'],
+                           counts['checked'] - counts['found'],
+                           's' if counts['checked'] - counts['found'] != 1 else ''))
+    if p.stats is not None:
+        results.extend(escape(line) for line in p.stats.report())
+    return results
 
 
 def handle_upload(request):
-    """Handle an upload POST request."""
+    """Handle an upload POST request. With ABCDB_UPLOAD_JOBS set, the upload is only queued as an
+    UploadJob, and the browser redirected to the page showing its progress."""
 
     # ---- file upload ----
     if request.FILES and 'file' in request.FILES:
@@ -202,14 +640,15 @@ def handle_upload(request):
             return upload_failed(request, 'The file upload was invalid. Contact the site '
                                  'administrator if this problem persists', severity='warning')
         file = request.FILES['file']
-        status = format_html("Processing uploaded file '{}', size {} bytes<br>\n", file.name,
-                             file.size)
+        input_chunks = file.chunks()
+        size = file.size
         method = 'upload'
         filename = file.name
 
     # ---- URL fetch ----
     elif 'url' in request.POST:
-        if not request.user.is_active or not request.user.is_staff:
+        if (not settings.ABCDB_UPLOAD_JOBS and
+                (not request.user.is_active or not request.user.is_staff)):
             return upload_failed(request, 'Sorry, but until the URL fetch is implemented in a '
                                  'background process, it is only available to administrators.',
                                  severity='info')
@@ -217,26 +656,8 @@ def handle_upload(request):
         if not form.is_valid():
             return upload_failed(request, 'No URL fetch attempted. Please enter a valid URL.')
         url = form.cleaned_data['url']
-        file = io.BytesIO()
-        file_length = 0
-        TOO_LONG = 512 * 1024
-        import requests  # -FIX- this will move when ready for production
-        try:
-            r = requests.get(url, timeout=5, stream=True)
-            for chunk in r.iter_content(4096):
-                file_length += file.write(chunk)
-                if file_length > TOO_LONG:
-                    return upload_failed(request, 'The fetched file is too long. Please download '
-                                         'it yourself, break it into smaller pieces, and upload '
-                                         'them.', severity='info')
-            r.raise_for_status()  # convert any non-200 status response to an exception, could
-                                  # handle 404 more gracefully
-        except requests.exceptions.RequestException as e:
-            message = "URL fetch failed with '{}'".format(str(e))  # -FIX- reveals too much?
-            return upload_failed(request, message, severity='warning')
-        file.seek(0)
-        status = format_html("Processing file fetched from '{}', size {} bytes<br>\n", url,
-                             file_length)
+        input_chunks = None  # fetched below, or by the upload worker
+        size = None
         method = 'fetch'
         filename = url
 
@@ -256,10 +677,10 @@ def handle_upload(request):
                 break
         if not text:
             return upload_failed(request, 'The submitted form was invalid (2).', severity='warning')
-        file = io.BytesIO(text)
+        input_chunks = (text, )
         # We could look in request.content_params for a hint as to the encoding, but apparently
         # browsers are a bit rubbish at setting this correctly?
-        status = format_html("Processing ABC notation, size {} bytes<br>\n", len(text))
+        size = len(text)
         method = 'entry'
         # Use the first title in the submission as the 'filename'
         match = re.search(b'T:\\s*([ -~\\w\\d]+)', text)
@@ -271,32 +692,148 @@ def handle_upload(request):
     else:
         return upload_failed(request, 'Bad form, dude.', severity='warning')
 
-    # create parser instance and parse file
+    if settings.ABCDB_UPLOAD_JOBS:
+        job = UploadJob(user=request.user, method=method, filename=filename or '')
+        if method == 'fetch':
+            job.url = url
+        else:
+            job.data = b''.join(input_chunks)
+            job.size = size
+        job.save()
+        return HttpResponseRedirect('/upload/{}/'.format(job.id))
+
+    # A fetched file is read in full before parsing starts, so that no transaction is held open
+    # while waiting on the remote server, and a fetch which fails leaves nothing behind.
+    if method == 'fetch':
+        try:
+            input_chunks = (b''.join(fetch_url(url)), )
+        except UploadAborted as e:
+            return upload_failed(request, e.reason, severity=e.severity)
+
+    # Create parser instance and feed it the file as it arrives.
     p = UploadParser(username=request.user.username, filename=filename, method=method)
-    p.append_journal(status)
-    p.parse(file)
-    # build a list of natural-language descriptions of the results
-    results = []
-    for key, text in (
-            ('new_songs', '{} new song{}'),
-            ('existing_songs', '{} existing song{}'),
-            ('new_instances', '{} new song instance{}'),
-            ('existing_instances', '{} existing song instance{}'),
-            ('error_instances', '{} instance{} with errors'),
-            ('warning_instances', '{} instance{} with warnings'),
-            ('good_instances', '{} instance{} with no errors or warnings'),
-            ('new_titles', '{} new title{}'),
-            ('existing_titles', '{} existing title{}')):
-        result = text.format(p.counts[key], 's' if p.counts[key] != 1 else '')
-        if ('warning' in key or 'error' in key) and p.counts[key] > 0:
-            result = '<div style="color:red">' + result + '</div>'
-        results.append(result)
-    elapsed = datetime.datetime.now(datetime.timezone.utc) - p.collection_inst.date
-    elapsed = elapsed.total_seconds()
-    results.append('Processed {} lines in {:.2f} seconds'.format(p.line_number, elapsed))
-    results.append('Process CPU time: {:.2f} seconds'.format(time.process_time() -
-                                                             p.process_time_start))
-    results.append('Low-level (music code) ABC parse time (using {} parser): {:.2f} seconds'
-                       .format(p.parser, p.music_code_parse_time))
-    return render(request, 'main/upload-post.html', { 'results': results,
+    p.append_journal(upload_status(method, filename, size))
+    for chunk in input_chunks:
+        p.feed(chunk)
+    p.close()
+    return render(request, 'main/upload-post.html', { 'results': upload_results(p),
                                                       'status': p.get_journal() })
+
+
+# ========== Upload Jobs ==========
+
+# The size of the slices in which an upload job's ABC is fed to the parser; its progress is
+# saved, and cancellation checked for, after each.
+JOB_FEED_SIZE = 64 * 1024
+
+# The most seconds between updates of a job's heartbeat while its URL is being fetched.
+JOB_HEARTBEAT_INTERVAL = 1.0
+
+# The error given to a job whose worker stopped updating its heartbeat (see ``claim_upload_job``).
+JOB_LOST_REASON = ('Processing the upload stopped unexpectedly. Contact the site administrator '
+                   'if this problem persists.')
+
+
+def claim_upload_job():
+    """Return the oldest queued UploadJob, marked as running, or None if none are queued. Any
+    number of workers may be claiming jobs at once: each job goes to the one whose update marks
+    it running first. Running jobs whose heartbeat is more than ABCDB_UPLOAD_JOB_TIMEOUT seconds
+    old are first marked failed, since the worker running them must have died. They aren't
+    queued again, as whatever killed the worker would likely kill the next one too."""
+    now = datetime.datetime.now(datetime.timezone.utc)
+    UploadJob.objects.filter(
+        state=UploadJob.RUNNING,
+        heartbeat__lt=now - datetime.timedelta(seconds=settings.ABCDB_UPLOAD_JOB_TIMEOUT)).update(
+            state=UploadJob.FAILED, data=b'', finished=now,
+            error=alert_box(JOB_LOST_REASON, severity='alert'))
+    queued = UploadJob.objects.filter(state=UploadJob.QUEUED)
+    while True:
+        job_ids = list(queued.order_by('id').values_list('id', flat=True)[:10])
+        if not job_ids:
+            return None
+        for job_id in job_ids:
+            now = datetime.datetime.now(datetime.timezone.utc)
+            if queued.filter(id=job_id).update(state=UploadJob.RUNNING, started=now,
+                                               heartbeat=now):
+                return UploadJob.objects.get(id=job_id)
+
+
+def cancel_upload_job(job):
+    """Cancel UploadJob ``job``: at once if it is still queued, or else by asking the worker
+    running it to stop, which it does before parsing its next slice of input."""
+    jobs = UploadJob.objects.filter(id=job.id)
+    if not jobs.filter(state=UploadJob.QUEUED).update(
+            state=UploadJob.CANCELLED, data=b'',
+            finished=datetime.datetime.now(datetime.timezone.utc)):
+        jobs.filter(state=UploadJob.RUNNING).update(cancel_requested=True)
+
+
+def run_upload_job(job):
+    """Parse the ABC of UploadJob ``job``, claimed by ``claim_upload_job``, saving its progress
+    and heartbeat as it goes, and its results once finished. A cancelled job keeps the tunes saved
+    before it stopped, in a collection of their own, as does one which ``claim_upload_job`` has
+    meanwhile marked failed for a stale heartbeat; that stays failed. Any exception other than
+    ``UploadAborted`` marks the job failed, and is raised again for the worker to report."""
+    jobs = UploadJob.objects.filter(id=job.id)
+    running = jobs.filter(state=UploadJob.RUNNING)
+
+    def heartbeat(**fields):
+        """Save ``fields`` and a new heartbeat, unless the job is no longer running, in which
+        case return 0."""
+        return running.update(heartbeat=datetime.datetime.now(datetime.timezone.utc), **fields)
+
+    p = None
+    try:
+        if job.method == 'fetch':
+            data = []
+            last_beat = time.perf_counter()
+            for chunk in fetch_url(job.url):
+                data.append(chunk)
+                if time.perf_counter() - last_beat >= JOB_HEARTBEAT_INTERVAL:
+                    if not heartbeat():
+                        raise UploadAborted(JOB_LOST_REASON, severity='alert')
+                    last_beat = time.perf_counter()
+            data = b''.join(data)
+        else:
+            data = bytes(job.data)
+        job.size = len(data)
+        p = UploadParser(username=job.user.username, filename=job.filename or None,
+                         method=job.method)
+        p.append_journal(upload_status(job.method, job.filename, len(data)))
+        job.collection = p.collection_inst
+        job.state = UploadJob.DONE
+        for start in range(0, len(data), JOB_FEED_SIZE):
+            p.feed(data[start:start + JOB_FEED_SIZE])
+            job.lines = p.line_number
+            job.tunes = sum(p.counts[key] for key in ('error_instances', 'warning_instances',
+                                                      'good_instances'))
+            if not heartbeat(lines=job.lines, tunes=job.tunes, collection=job.collection):
+                job.state = UploadJob.FAILED
+                break
+            if jobs.filter(cancel_requested=True).exists():
+                job.state = UploadJob.CANCELLED
+                break
+        if job.state == UploadJob.DONE:
+            p.close()
+        else:
+            p.abandon()
+        job.lines = p.line_number
+        job.results = json.dumps(upload_results(p))
+        job.journal = p.get_journal()
+    except UploadAborted as e:
+        job.state = UploadJob.FAILED
+        job.error = alert_box(e.reason, e.severity)
+    except Exception:
+        job.state = UploadJob.FAILED
+        job.error = alert_box('Processing the upload failed. Contact the site administrator if '
+                              'this problem persists.', severity='alert')
+        raise
+    finally:
+        if p is not None and p.tracing_memory:
+            tracemalloc.stop()
+        job.data = b''
+        job.finished = datetime.datetime.now(datetime.timezone.utc)
+        # only if still running, so as not to overwrite the error of a job failed meanwhile
+        running.update(state=job.state, data=job.data, size=job.size, finished=job.finished,
+                       lines=job.lines, tunes=job.tunes, collection=job.collection,
+                       results=job.results, journal=job.journal, error=job.error)
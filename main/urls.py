@@ -28,6 +28,7 @@ from . import views
 
 urlpatterns = [
     url(r'^ajax/graph/(?P<tune_id>[tsi][0-9]{1,9})/$', views.ajax_graph_view),
+    url(r'^ajax/upload/(?P<pk>[0-9]{1,9})/$', views.ajax_upload_job_view),
     url(r'^collection/(?P<pk>[0-9]{1,9})/$', views.CollectionView.as_view()),
     url(r'^collections/$', views.CollectionsView.as_view()),
     url(r'^download/(?P<pk>[0-9]{1,9})/$', views.download),
@@ -39,6 +40,8 @@ urlpatterns = [
     url(r'^title/(?P<pk>[0-9]{1,9})/$', views.TitleView.as_view()),
     url(r'^titles/$', views.TitlesView.as_view()),
     url(r'^upload/$', views.upload, name='upload'),
+    url(r'^upload/(?P<pk>[0-9]{1,9})/$', views.upload_job_view),
+    url(r'^upload/(?P<pk>[0-9]{1,9})/cancel/$', views.cancel_upload_job_view),
     # temporary
     url(r'^temp_songs/$', views.SongsView.as_view()),
     url(r'^temp_instances/$', views.InstancesView.as_view()),
@@ -25,21 +25,22 @@ import json
 import re
 import unicodedata
 
-from graphviz import Digraph
-
+from django.conf import settings
 from django.db import connection
 from django.db.models import F, Q, Sum
 from django.contrib.auth.decorators import permission_required
 from django.core.exceptions import ObjectDoesNotExist
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
-from django.http import HttpResponse, HttpResponseRedirect, JsonResponse
+from django.http import (Http404, HttpResponse, HttpResponseNotAllowed, HttpResponseRedirect,
+                         JsonResponse)
 from django.shortcuts import get_object_or_404, render
 from django.utils.html import format_html
+from django.utils.safestring import mark_safe
 from django.views import generic
 
 from main.forms import TitleSearchForm, UploadForm, FetchForm, ABCEntryForm
-from main.models import Collection, CollectionInstance, Instance, Song, Title
-from main.upload import handle_upload
+from main.models import Collection, CollectionInstance, Instance, Song, Title, UploadJob
+from main.upload import cancel_upload_job, handle_upload
 
 
 # ========== Utility Functions ==========
@@ -254,6 +255,8 @@ def song_view(request, pk=None):
         return render(request, 'main/song.html', { 'song': { 'id': pk }, 'error': True })
     context = { 'song': song }
 
+    from graphviz import Digraph  # only needed here, so not imported with the URLconf
+
     # initialize graph with a node for this song
     dot = Digraph(format='svg', name=format_html('Song {} Graph', pk),
                   node_attr={'fontsize': '10'})
@@ -374,12 +377,58 @@ def upload(request):
         return handle_upload(request)
 
     context = { 'form': UploadForm, 'entry_form': ABCEntryForm }
-    if request.user.is_active and request.user.is_staff:
-        # for now, URL fetch is only available to administrators
+    if settings.ABCDB_UPLOAD_JOBS or (request.user.is_active and request.user.is_staff):
+        # URL fetch is only available to administrators, unless done by an upload worker
         context.update(fetch_form=FetchForm)
     return render(request, 'main/upload.html', context)
 
 
+def _get_upload_job(request, pk):
+    """Return the UploadJob ``pk``, if it belongs to the user making ``request``, or they are
+    staff, else raise Http404."""
+    job = get_object_or_404(UploadJob, pk=pk)
+    if job.user_id != request.user.id and not request.user.is_staff:
+        raise Http404('No UploadJob matches the given query.')
+    return job
+
+
+@permission_required('main.can_upload', login_url="/login/")
+def upload_job_view(request, pk):
+    """Show the results of a finished upload job, or until then, its progress, which the page
+    polls ``ajax_upload_job_view`` for."""
+    job = _get_upload_job(request, pk)
+    context = { 'job': job }
+    if job.state == UploadJob.FAILED:
+        context.update(error=mark_safe(job.error))
+    elif job.is_finished and job.results:
+        context.update(results=json.loads(job.results), status=job.journal)
+    return render(request, 'main/upload-post.html', context)
+
+
+@permission_required('main.can_upload', login_url="/login/")
+def ajax_upload_job_view(request, pk):
+    """Return JSON describing the state and progress of an upload job, and its results once it
+    has finished."""
+    if not request.is_ajax():
+        return HttpResponseRedirect('/upload/{}/'.format(pk))
+    job = _get_upload_job(request, pk)
+    status = { 'id': job.id, 'state': job.state, 'finished': job.is_finished,
+               'cancel_requested': job.cancel_requested, 'size': job.size, 'lines': job.lines,
+               'tunes': job.tunes, 'collection': job.collection_id }
+    if job.is_finished:
+        status.update(results=json.loads(job.results) if job.results else [], error=job.error)
+    return JsonResponse(status)
+
+
+@permission_required('main.can_upload', login_url="/login/")
+def cancel_upload_job_view(request, pk):
+    """Cancel an upload job (on POST only), then show it again."""
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    cancel_upload_job(_get_upload_job(request, pk))
+    return HttpResponseRedirect('/upload/{}/'.format(pk))
+
+
 # ========== Database Statistics View ==========
 
 def stats(request):
@@ -28,14 +28,17 @@ extern crate pest;
 mod grammar;
 mod visitors;
 
-use std::panic::catch_unwind;
+use std::any::Any;
+use std::panic::{catch_unwind, RefUnwindSafe};
 use std::ffi::{CStr,CString};
 use std::os::raw::c_char;
+use std::slice;
+use std::str;
 
 use pest::prelude::*;
 
 use grammar::Rdp;
-use visitors::canonify_abc_visitor;
+use visitors::{canonify_abc_visitor, decode_abc_text_string};
 
 fn parse_get_error_message(parser: &mut Rdp<pest::StringInput>) -> String {
     let expected = parser.expected();
@@ -61,38 +64,57 @@ pub struct ParseResult {
    text: *mut c_char  // parsed, canonicized text, or error message
 }
 
+// Parse one line of music code, returning a status (0: success, 1: parse error) and either the
+// canonicized text or an error message.
+fn parse_music_code_line(input: &str) -> (i32, String) {
+    let mut parser = Rdp::new(StringInput::new(input));
+    if parser.music_code_line() {                       // if parse succeeded
+        (0, canonify_abc_visitor(&parser))              // get canonical result
+    } else {                                            // else
+        (1, parse_get_error_message(&mut parser))       // get error message
+    }
+}
+
+// Decode the ABC character encodings in one text string, returning a status (0: decoded, 1: no
+// character encodings found, so there's nothing to decode) and the decoded text (empty if the
+// status is 1). Unicode NFC normalization is left to the caller.
+fn decode_text_string_line(input: &str) -> (i32, String) {
+    match decode_abc_text_string(input) {
+        Some(text) => (0, text),
+        None => (1, String::new()),
+    }
+}
+
+// Try to get an error message from a panic caught by catch_unwind().
+fn panic_message<'a>(e: &'a Box<Any + Send + 'static>) -> &'a str {
+    // why does catch_unwind() throw away the location information?
+    //   -> libstd/panicking.rs:try()
+    //   -> src/libpanic_unwind/lib.rs:__rust_maybe_catch_panic() discards the location
+    //      (file and line) information (if it was ever valid), so the cause is the most
+    //      we can retreive:
+    if let Some(rs) = e.downcast_ref::<&'static str>() {
+        *rs
+    } else if let Some(rs) = e.downcast_ref::<String>() {
+        &rs[..]
+    } else {
+        "Panic!"
+    }
+}
+
 #[no_mangle]
 pub extern fn canonify_music_code(raw_input: *const c_char) -> *mut ParseResult {
     let result: Result<ParseResult, _> = catch_unwind(|| {
         assert!(!raw_input.is_null());
         let c_str = unsafe { CStr::from_ptr(raw_input) };
         let input = c_str.to_str().unwrap();  // Python should have sent valid UTF-8, panic if not
-        let mut parser = Rdp::new(StringInput::new(input));
-        let (status, text) = if parser.music_code_line() {  // if parse succeeded
-            (0, canonify_abc_visitor(&parser))              // get canonical result
-        } else {                                            // else
-            (1, parse_get_error_message(&mut parser))       // get error message
-        };
+        let (status, text) = parse_music_code_line(input);
         ParseResult { status: status, text: CString::new(text).unwrap().into_raw() }
     });
     let pr: ParseResult;
     match result {
         Ok(r) => { pr = r; }
         Err(e) => {  // the closure panicked, so try to get an error message
-            let s: &str;
-            // why does catch_unwind() throw away the location information?
-            //   -> libstd/panicking.rs:try()
-            //   -> src/libpanic_unwind/lib.rs:__rust_maybe_catch_panic() discards the location
-            //      (file and line) information (if it was ever valid), so the cause is the most
-            //      we can retreive:
-            if let Some(rs) = e.downcast_ref::<&'static str>() {
-                s = *rs;
-            } else if let Some(rs) = e.downcast_ref::<String>() {
-                s = &rs[..];
-            } else {
-                s = "Panic!";
-            }
-            pr = ParseResult { status: 2, text: CString::new(s).unwrap().into_raw() };
+            pr = ParseResult { status: 2, text: CString::new(panic_message(&e)).unwrap().into_raw() };
         }
     }
     Box::into_raw(Box::new(pr))
@@ -107,3 +129,119 @@ pub extern fn free_result(p: *mut ParseResult) {
         }
     }
 }
+
+#[derive(Debug)]
+#[repr(C)]
+pub struct BatchResult {
+   len: usize,    // length of data, in bytes
+   data: *mut u8  // for each line, a record of: the status (as for ParseResult) as one byte, the
+                  // length of the text as four little-endian bytes, then the UTF-8 text itself
+}
+
+// Apply ``f`` to one line of UTF-8, catching any panic, and append its result record to ``data``.
+fn push_record<F>(data: &mut Vec<u8>, line: &[u8], f: &F)
+    where F: Fn(&str) -> (i32, String) + RefUnwindSafe
+{
+    let result = catch_unwind(|| {
+        let line = str::from_utf8(line).unwrap();  // Python should have sent valid UTF-8
+        f(line)
+    });
+    let (status, text) = match result {
+        Ok(r) => r,
+        Err(e) => (2, panic_message(&e).to_string()),
+    };
+    let len = text.len() as u32;
+    data.push(status as u8);
+    data.extend_from_slice(&[len as u8, (len >> 8) as u8, (len >> 16) as u8, (len >> 24) as u8]);
+    data.extend_from_slice(text.as_bytes());
+}
+
+// Apply ``f`` to each newline-separated line of the ``input_len`` bytes at ``raw_input``, or, if
+// ``split`` is false, to the whole input as one line, returning the records in a BatchResult.
+fn batch_result<F>(raw_input: *const u8, input_len: usize, split: bool, f: F) -> *mut BatchResult
+    where F: Fn(&str) -> (i32, String) + RefUnwindSafe
+{
+    assert!(!raw_input.is_null());
+    let input = unsafe { slice::from_raw_parts(raw_input, input_len) };
+    let mut data: Vec<u8> = Vec::with_capacity(input_len * 2);
+    if split {
+        for line in input.split(|&b| b == b'\n') {
+            push_record(&mut data, line, &f);
+        }
+    } else {
+        push_record(&mut data, input, &f);
+    }
+    let mut data = data.into_boxed_slice();
+    let br = BatchResult { len: data.len(), data: data.as_mut_ptr() };
+    std::mem::forget(data);
+    Box::into_raw(Box::new(br))
+}
+
+// Canonicize several lines of music code in one call: ``raw_input`` holds ``input_len`` bytes
+// of UTF-8, being one or more lines separated by newlines. The result holds a record for each
+// line, in order, and must be released with free_batch_result().
+#[no_mangle]
+pub extern fn canonify_music_code_batch(raw_input: *const u8, input_len: usize) -> *mut BatchResult {
+    batch_result(raw_input, input_len, true, parse_music_code_line)
+}
+
+// Decode the ABC character encodings (TeX-style mnemonics, named entities, and \uXXXX and
+// \UXXXXXXXX escapes) in the text string of ``input_len`` bytes of UTF-8 at ``raw_input``. The
+// result holds one record, with a status of 0 (decoded), 1 (nothing to decode), or 2 (panic
+// caught), and must be released with free_batch_result().
+#[no_mangle]
+pub extern fn decode_text_string(raw_input: *const u8, input_len: usize) -> *mut BatchResult {
+    batch_result(raw_input, input_len, false, decode_text_string_line)
+}
+
+// Decode several newline-separated text strings in one call, as for decode_text_string(), with a
+// record for each.
+#[no_mangle]
+pub extern fn decode_text_string_batch(raw_input: *const u8, input_len: usize) -> *mut BatchResult {
+    batch_result(raw_input, input_len, true, decode_text_string_line)
+}
+
+#[no_mangle]
+pub extern fn free_batch_result(p: *mut BatchResult) {
+    if !p.is_null() {
+        unsafe {
+            let b = Box::from_raw(p);
+            Box::from_raw(slice::from_raw_parts_mut(b.data, b.len) as *mut [u8]);
+        }
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    fn records(input: &[u8], split: bool) -> Vec<u8> {
+        let br = batch_result(input.as_ptr(), input.len(), split, |line: &str| {
+            if line == "boom" {
+                panic!("boom");
+            } else if line.is_empty() {
+                (1, String::new())
+            } else {
+                (0, line.to_uppercase())
+            }
+        });
+        let data = unsafe { slice::from_raw_parts((*br).data, (*br).len).to_vec() };
+        free_batch_result(br);
+        data
+    }
+
+    // The same records are read by ParserUtilityTests.test_batch_records in main/tests.py.
+    #[test]
+    fn test_batch_result() {
+        assert_eq!(records("ab\n\nc\u{e9}".as_bytes(), true),
+                   b"\x00\x02\x00\x00\x00AB\
+                     \x01\x00\x00\x00\x00\
+                     \x00\x03\x00\x00\x00C\xc3\x89".to_vec());
+        assert_eq!(records(b"a\nb", false), b"\x00\x03\x00\x00\x00A\nB".to_vec());
+        assert_eq!(records(b"boom", true), b"\x02\x04\x00\x00\x00boom".to_vec());
+        let long = vec![b'x'; 256];
+        let mut expected = b"\x00\x00\x01\x00\x00".to_vec();
+        expected.extend(vec![b'X'; 256]);
+        assert_eq!(records(&long, true), expected);
+    }
+}
@@ -353,7 +353,7 @@ fn ruler_decode_abc_text_string(context: &Context) -> (RString, usize) {
     }
 }
 
-fn decode_abc_text_string(text: &str) -> Option<String> {
+pub fn decode_abc_text_string(text: &str) -> Option<String> {
     let mut parser = Rdp::new(StringInput::new(text));
     if parser.text_string() {
         Some(visit_parse_tree(&parser, &ruler_decode_abc_text_string))
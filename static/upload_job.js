@@ -0,0 +1,65 @@
+/* ABCdb static/upload_job.js - upload job progress
+ *
+ * Copyright © 2017 Sean Bolton.
+ *
+ * Permission is hereby granted, free of charge, to any person obtaining
+ * a copy of this software and associated documentation files (the
+ * "Software"), to deal in the Software without restriction, including
+ * without limitation the rights to use, copy, modify, merge, publish,
+ * distribute, sublicense, and/or sell copies of the Software, and to
+ * permit persons to whom the Software is furnished to do so, subject to
+ * the following conditions:
+ *
+ * The above copyright notice and this permission notice shall be
+ * included in all copies or substantial portions of the Software.
+ *
+ * THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+ * EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+ * MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+ * NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+ * LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+ * OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+ * WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+ */
+
+/* Requires: a reasonably modern browser. Expects `upload_job_id` to be set by the page. */
+
+var poll_interval = 2000;  /* milliseconds */
+
+/* request_status()
+ *
+ * Make an Ajax request for the state and progress of the upload job.
+ */
+function request_status() {
+    var request = new XMLHttpRequest();
+    request.open("GET", "/ajax/upload/" + upload_job_id + "/");
+    request.setRequestHeader("X-Requested-With", "XMLHttpRequest");
+    request.responseType = "json";
+    request.onload = show_status;
+    request.onerror = function() { window.setTimeout(request_status, poll_interval); };
+    request.send();
+}
+
+/* show_status()
+ *
+ * Callback for the Ajax request. Update the progress shown, or once the job has finished,
+ * reload the page to show its results.
+ */
+function show_status() {
+    var status = this.response;
+    if (this.status !== 200 || !status) {
+        window.setTimeout(request_status, poll_interval);
+        return;
+    }
+    if (status.finished) {
+        window.location.reload();
+        return;
+    }
+    document.getElementById("job-state").textContent =
+        status.state + (status.cancel_requested ? ", and will be cancelled" : "");
+    document.getElementById("job-lines").textContent = status.lines;
+    document.getElementById("job-tunes").textContent = status.tunes;
+    window.setTimeout(request_status, poll_interval);
+}
+
+window.setTimeout(request_status, poll_interval);